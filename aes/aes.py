@@ -13,6 +13,10 @@ Although this is an exercise, the `encrypt` and `decrypt` functions should
 provide reasonable security to encrypted messages.
 """
 
+import struct
+import threading
+from collections import OrderedDict
+
 
 s_box = (
     0x63, 0x7C, 0x77, 0x7B, 0xF2, 0x6B, 0x6F, 0xC5, 0x30, 0x01, 0x67, 0x2B, 0xFE, 0xD7, 0xAB, 0x76,
@@ -86,6 +90,24 @@ def add_round_key(s, k):
 xtime = lambda a: (((a << 1) ^ 0x1B) & 0xFF) if (a & 0x80) else (a << 1)
 
 
+def gmul(a, b):
+    """ Multiplies two bytes in GF(2^8) using repeated `xtime`. """
+    p = 0
+    while b:
+        if b & 1:
+            p ^= a
+        a = xtime(a)
+        b >>= 1
+    return p
+
+
+# Multiplication tables for the InvMixColumns coefficients.
+mul_9 = tuple(gmul(a, 9) for a in range(256))
+mul_11 = tuple(gmul(a, 11) for a in range(256))
+mul_13 = tuple(gmul(a, 13) for a in range(256))
+mul_14 = tuple(gmul(a, 14) for a in range(256))
+
+
 def mix_single_column(a):
     # see Sec 4.1.2 in The Design of Rijndael
     t = a[0] ^ a[1] ^ a[2] ^ a[3]
@@ -102,16 +124,15 @@ def mix_columns(s):
 
 
 def inv_mix_columns(s):
-    # see Sec 4.1.3 in The Design of Rijndael
-    for i in range(4):
-        u = xtime(xtime(s[i][0] ^ s[i][2]))
-        v = xtime(xtime(s[i][1] ^ s[i][3]))
-        s[i][0] ^= u
-        s[i][1] ^= v
-        s[i][2] ^= u
-        s[i][3] ^= v
-
-    mix_columns(s)
+    # Multiply each column by the [0e, 0b, 0d, 09] circulant matrix directly,
+    # in a single pass (Sec 4.1.3 in The Design of Rijndael factors this into
+    # a cheap pre-step followed by a full mix_columns instead).
+    for c in s:
+        a0, a1, a2, a3 = c
+        c[0] = mul_14[a0] ^ mul_11[a1] ^ mul_13[a2] ^ mul_9[a3]
+        c[1] = mul_9[a0] ^ mul_14[a1] ^ mul_11[a2] ^ mul_13[a3]
+        c[2] = mul_13[a0] ^ mul_9[a1] ^ mul_14[a2] ^ mul_11[a3]
+        c[3] = mul_11[a0] ^ mul_13[a1] ^ mul_9[a2] ^ mul_14[a3]
 
 
 r_con = (
@@ -122,6 +143,28 @@ r_con = (
 )
 
 
+def _make_tables(box, coefficients):
+    """
+    Builds four 256-entry tables of 32-bit words combining `box` with one
+    column of the (Inv)MixColumns matrix. Each table is the previous one
+    rotated right by one byte, so a full round is 16 lookups and 16 XORs.
+    """
+    c0, c1, c2, c3 = coefficients
+    t0 = []
+    for x in range(256):
+        s = box[x]
+        t0.append(gmul(s, c0) << 24 | gmul(s, c1) << 16 | gmul(s, c2) << 8 | gmul(s, c3))
+    t1 = [(w >> 8) | ((w & 0xFF) << 24) for w in t0]
+    t2 = [(w >> 8) | ((w & 0xFF) << 24) for w in t1]
+    t3 = [(w >> 8) | ((w & 0xFF) << 24) for w in t2]
+    return tuple(t0), tuple(t1), tuple(t2), tuple(t3)
+
+# Combined SubBytes + MixColumns tables for the "table" engine (see Sec 4.2 in
+# The Design of Rijndael), and their InvSubBytes + InvMixColumns counterparts.
+Te0, Te1, Te2, Te3 = _make_tables(s_box, (2, 1, 1, 3))
+Td0, Td1, Td2, Td3 = _make_tables(inv_s_box, (14, 9, 13, 11))
+
+
 def bytes2matrix(text):
     """ Converts a 16-byte array into a 4x4 matrix.  """
     return [list(text[i:i+4]) for i in range(0, len(text), 4)]
@@ -130,6 +173,16 @@ def matrix2bytes(matrix):
     """ Converts a 4x4 matrix into a 16-byte array.  """
     return bytes(sum(matrix, []))
 
+_block_struct = struct.Struct('>4I')
+
+def unpack_block(block):
+    """ Converts a 16-byte array into four big-endian 32-bit column words. """
+    return _block_struct.unpack(block)
+
+def pack_block(s0, s1, s2, s3):
+    """ Converts four 32-bit column words back into a 16-byte array. """
+    return _block_struct.pack(s0, s1, s2, s3)
+
 def xor_bytes(a, b):
     """ Returns a new byte array with the elements xor'ed. """
     return bytes(i^j for i, j in zip(a, b))
@@ -145,6 +198,18 @@ def inc_bytes(a):
             break
     return bytes(out)
 
+def add_counter(a, n):
+    """ Returns the 16-byte counter block `n` increments after `a`. """
+    return ((int.from_bytes(a, 'big') + n) % (1 << 128)).to_bytes(16, 'big')
+
+def xor_long(a, b):
+    """
+    Returns `a` xor'ed with `b`, which must have the same length. Much faster
+    than `xor_bytes` for long inputs, since it works on whole integers.
+    """
+    assert len(a) == len(b)
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
 def pad(plaintext):
     """
     Pads the given plaintext with PKCS#7 padding to a multiple of 16 bytes.
@@ -170,6 +235,142 @@ def split_blocks(message, block_size=16, require_padding=True):
         assert len(message) % block_size == 0 or not require_padding
         return [message[i:i+16] for i in range(0, len(message), block_size)]
 
+CTR_MASK = (1 << 128) - 1
+
+def output_buffer(out, size):
+    """
+    Returns (buffer, view): `out`, or a new bytearray if it is None, and a
+    writable byte view of it, checked to hold at least `size` bytes.
+    """
+    buffer = bytearray(size) if out is None else out
+    view = memoryview(buffer).cast('B')
+    assert not view.readonly, 'Output buffer must be writable.'
+    assert len(view) >= size, 'Output buffer too small, {} bytes needed.'.format(size)
+    return buffer, view
+
+def finish_output(out, buffer, size):
+    """
+    Returns the result of a mode method: the first `size` bytes as a new
+    bytes object, or `size`, the number of bytes written, if `out` was given.
+    """
+    if out is not None:
+        return size
+    return bytes(buffer) if len(buffer) == size else bytes(memoryview(buffer)[:size])
+
+def store_output(out, data):
+    """ Returns `data`, or copies it into `out` and returns its length. """
+    if out is None:
+        return data
+    _, view = output_buffer(out, len(data))
+    view[:len(data)] = data
+    return len(data)
+
+def unpadded_size(buffer, size):
+    """
+    Checks the PKCS#7 padding that ends the first `size` bytes of `buffer`
+    and returns the length of the message before it, without copying.
+    """
+    assert size > 0, 'Ciphertext must not be empty.'
+    view = memoryview(buffer).cast('B')
+    padding_len = view[size - 1]
+    assert 0 < padding_len <= min(size, 16)
+    assert all(p == padding_len for p in view[size - padding_len:size])
+    return size - padding_len
+
+
+# GHASH works in GF(2^128) with the bits of each block reflected: the most
+# significant bit of the big-endian integer is the coefficient of x^0, so
+# multiplying by x is a right shift, reduced by R = x^128 + x^7 + x^2 + x + 1.
+GHASH_R = 0xE1 << 120
+
+def ghash_tables(h):
+    """
+    Precomputes, for each of the 16 byte positions, the product of H with
+    every possible byte value at that position. Multiplying a block by H is
+    then 16 table lookups XOR'ed together instead of 128 shift-and-adds.
+    """
+    # powers[j] = H * x^j, the contribution of bit j (counting from the MSB).
+    powers = [h]
+    for _ in range(127):
+        v = powers[-1]
+        powers.append((v >> 1) ^ GHASH_R if v & 1 else v >> 1)
+
+    tables = []
+    for i in range(16):
+        table = [0] * 256
+        for b in range(1, 256):
+            low = b & -b
+            table[b] = table[b ^ low] ^ powers[8 * i + 8 - low.bit_length()]
+        tables.append(tuple(table))
+    return tuple(tables)
+
+def ghash(tables, data, y=0):
+    """
+    Returns the GHASH of `data` (a whole number of 16-byte blocks) for the H
+    given by `tables`, continuing from the running value `y`.
+    """
+    t = tables
+    for i in range(0, len(data), 16):
+        y ^= int.from_bytes(data[i:i+16], 'big')
+        y = (t[0][y >> 120] ^ t[1][(y >> 112) & 0xFF] ^ t[2][(y >> 104) & 0xFF] ^ t[3][(y >> 96) & 0xFF] ^
+             t[4][(y >> 88) & 0xFF] ^ t[5][(y >> 80) & 0xFF] ^ t[6][(y >> 72) & 0xFF] ^ t[7][(y >> 64) & 0xFF] ^
+             t[8][(y >> 56) & 0xFF] ^ t[9][(y >> 48) & 0xFF] ^ t[10][(y >> 40) & 0xFF] ^ t[11][(y >> 32) & 0xFF] ^
+             t[12][(y >> 24) & 0xFF] ^ t[13][(y >> 16) & 0xFF] ^ t[14][(y >> 8) & 0xFF] ^ t[15][y & 0xFF])
+    return y
+
+def zero_pad(data):
+    """ Pads `data` with zero bytes to a multiple of 16 bytes (GCM style). """
+    return bytes(data) + bytes(-len(data) % 16)
+
+# Blocks of keystream generated per call in GCM, to bound temporary memory.
+GCM_CHUNK_BLOCKS = 65536
+
+
+class KeySchedule:
+    """
+    Round keys expanded from one master key, shared by every `AES` object
+    using that key. Besides the encryption round keys, it holds the round
+    keys of the equivalent inverse cipher (FIPS-197 Sec 5.3.5), which lets
+    decryption run its rounds in the same order as encryption.
+    """
+    def __init__(self, key_matrices):
+        self.key_matrices = key_matrices
+        # Decryption keys: last round key first, with InvMixColumns applied
+        # to the middle ones so it commutes with AddRoundKey.
+        dec_key_matrices = [key_matrices[-1]]
+        for matrix in reversed(key_matrices[1:-1]):
+            matrix = [list(column) for column in matrix]
+            inv_mix_columns(matrix)
+            dec_key_matrices.append(matrix)
+        dec_key_matrices.append(key_matrices[0])
+        self.dec_key_matrices = dec_key_matrices
+        self._words = None
+
+    def words(self):
+        """
+        Returns the encryption and decryption round keys packed as 32-bit
+        words for the table engine, computing them on first use.
+        """
+        if self._words is None:
+            pack = lambda matrices: tuple(int.from_bytes(bytes(column), 'big')
+                                          for matrix in matrices for column in matrix)
+            self._words = (pack(self.key_matrices), pack(self.dec_key_matrices))
+        return self._words
+
+
+# Process-wide cache of key schedules by master key, so short-lived AES
+# objects for the same key (one per request, say) skip key expansion. Only
+# `AES(key, cache=True)` uses it: one-time keys would just push out
+# reusable ones and keep key material in memory.
+SCHEDULE_CACHE_SIZE = 128
+_schedule_cache = OrderedDict()
+_schedule_cache_lock = threading.Lock()
+
+def clear_schedule_cache():
+    """ Drops every cached key schedule (and the key material in it). """
+    with _schedule_cache_lock:
+        _schedule_cache.clear()
+
 
 class AES:
     """
@@ -179,13 +380,55 @@ class AES:
     management. Unless you need that, please use `encrypt` and `decrypt`.
     """
     rounds_by_key_size = {16: 10, 24: 12, 32: 14}
-    def __init__(self, master_key):
+    engines = ('matrix', 'table', 'numpy')
+    def __init__(self, master_key, engine='matrix', cache=False):
         """
         Initializes the object with a given key.
+
+        `engine` selects the round implementation: 'matrix' works on a 4x4
+        list of bytes, one step at a time, while 'table' keeps the state as
+        four 32-bit words and uses the precomputed Te/Td lookup tables.
+        'numpy' (requires NumPy) uses the table engine for single blocks and
+        processes ECB, CTR and CBC/CFB decryption as whole arrays of blocks.
+        All engines produce the same output.
+
+        With `cache=True` the key schedule is shared through the process-wide
+        schedule cache; use it for keys that will be seen again.
         """
         assert len(master_key) in AES.rounds_by_key_size
+        assert engine in AES.engines
         self.n_rounds = AES.rounds_by_key_size[len(master_key)]
-        self._key_matrices = self._expand_key(master_key)
+        self.engine = engine
+        if cache:
+            schedule = self._get_schedule(bytes(master_key))
+        else:
+            schedule = KeySchedule(self._expand_key(bytes(master_key)))
+        self._key_matrices = schedule.key_matrices
+        self._dec_key_matrices = schedule.dec_key_matrices
+        self._batch = None
+        if engine != 'matrix':
+            self._enc_words, self._dec_words = schedule.words()
+        if engine == 'numpy':
+            from aes_numpy import BatchEngine
+            self._batch = BatchEngine(self._key_matrices, self._dec_key_matrices)
+
+    def _get_schedule(self, master_key):
+        """
+        Returns the key schedule for master_key from the process-wide cache,
+        expanding and caching it on a miss.
+        """
+        with _schedule_cache_lock:
+            schedule = _schedule_cache.get(master_key)
+            if schedule is not None:
+                _schedule_cache.move_to_end(master_key)
+                return schedule
+
+        schedule = KeySchedule(self._expand_key(master_key))
+        with _schedule_cache_lock:
+            _schedule_cache[master_key] = schedule
+            while len(_schedule_cache) > SCHEDULE_CACHE_SIZE:
+                _schedule_cache.popitem(last=False)
+        return schedule
 
     def _expand_key(self, master_key):
         """
@@ -221,12 +464,73 @@ class AES:
         # Group key words in 4x4 byte matrices.
         return [key_columns[4*i : 4*(i+1)] for i in range(len(key_columns) // 4)]
 
-    def encrypt_block(self, plaintext):
+    def _encrypt_words(self, s0, s1, s2, s3):
         """
-        Encrypts a single block of 16 byte long plaintext.
+        Encrypts one block given as four big-endian 32-bit column words and
+        returns four words. The mode loops work on words, so blocks are read
+        from and written to buffers without intermediate bytes objects.
+        """
+        if self.engine == 'matrix':
+            return unpack_block(self._encrypt_block_matrix(pack_block(s0, s1, s2, s3)))
+
+        w = self._enc_words
+        s0 ^= w[0]
+        s1 ^= w[1]
+        s2 ^= w[2]
+        s3 ^= w[3]
+
+        for i in range(4, 4 * self.n_rounds, 4):
+            s0, s1, s2, s3 = (
+                Te0[s0 >> 24] ^ Te1[(s1 >> 16) & 0xFF] ^ Te2[(s2 >> 8) & 0xFF] ^ Te3[s3 & 0xFF] ^ w[i],
+                Te0[s1 >> 24] ^ Te1[(s2 >> 16) & 0xFF] ^ Te2[(s3 >> 8) & 0xFF] ^ Te3[s0 & 0xFF] ^ w[i+1],
+                Te0[s2 >> 24] ^ Te1[(s3 >> 16) & 0xFF] ^ Te2[(s0 >> 8) & 0xFF] ^ Te3[s1 & 0xFF] ^ w[i+2],
+                Te0[s3 >> 24] ^ Te1[(s0 >> 16) & 0xFF] ^ Te2[(s1 >> 8) & 0xFF] ^ Te3[s2 & 0xFF] ^ w[i+3],
+            )
+
+        # Final round has no MixColumns, so use the plain S-box.
+        i = 4 * self.n_rounds
+        return (
+            (s_box[s0 >> 24] << 24 | s_box[(s1 >> 16) & 0xFF] << 16 | s_box[(s2 >> 8) & 0xFF] << 8 | s_box[s3 & 0xFF]) ^ w[i],
+            (s_box[s1 >> 24] << 24 | s_box[(s2 >> 16) & 0xFF] << 16 | s_box[(s3 >> 8) & 0xFF] << 8 | s_box[s0 & 0xFF]) ^ w[i+1],
+            (s_box[s2 >> 24] << 24 | s_box[(s3 >> 16) & 0xFF] << 16 | s_box[(s0 >> 8) & 0xFF] << 8 | s_box[s1 & 0xFF]) ^ w[i+2],
+            (s_box[s3 >> 24] << 24 | s_box[(s0 >> 16) & 0xFF] << 16 | s_box[(s1 >> 8) & 0xFF] << 8 | s_box[s2 & 0xFF]) ^ w[i+3],
+        )
+
+    def _decrypt_words(self, s0, s1, s2, s3):
+        """
+        Decrypts one block given as four 32-bit words, see `_encrypt_words`.
+        The table engine uses the equivalent inverse cipher so every round
+        has the same shape as encryption.
+        """
+        if self.engine == 'matrix':
+            return unpack_block(self._decrypt_block_matrix(pack_block(s0, s1, s2, s3)))
+
+        w = self._dec_words
+        s0 ^= w[0]
+        s1 ^= w[1]
+        s2 ^= w[2]
+        s3 ^= w[3]
+
+        for i in range(4, 4 * self.n_rounds, 4):
+            s0, s1, s2, s3 = (
+                Td0[s0 >> 24] ^ Td1[(s3 >> 16) & 0xFF] ^ Td2[(s2 >> 8) & 0xFF] ^ Td3[s1 & 0xFF] ^ w[i],
+                Td0[s1 >> 24] ^ Td1[(s0 >> 16) & 0xFF] ^ Td2[(s3 >> 8) & 0xFF] ^ Td3[s2 & 0xFF] ^ w[i+1],
+                Td0[s2 >> 24] ^ Td1[(s1 >> 16) & 0xFF] ^ Td2[(s0 >> 8) & 0xFF] ^ Td3[s3 & 0xFF] ^ w[i+2],
+                Td0[s3 >> 24] ^ Td1[(s2 >> 16) & 0xFF] ^ Td2[(s1 >> 8) & 0xFF] ^ Td3[s0 & 0xFF] ^ w[i+3],
+            )
+
+        i = 4 * self.n_rounds
+        return (
+            (inv_s_box[s0 >> 24] << 24 | inv_s_box[(s3 >> 16) & 0xFF] << 16 | inv_s_box[(s2 >> 8) & 0xFF] << 8 | inv_s_box[s1 & 0xFF]) ^ w[i],
+            (inv_s_box[s1 >> 24] << 24 | inv_s_box[(s0 >> 16) & 0xFF] << 16 | inv_s_box[(s3 >> 8) & 0xFF] << 8 | inv_s_box[s2 & 0xFF]) ^ w[i+1],
+            (inv_s_box[s2 >> 24] << 24 | inv_s_box[(s1 >> 16) & 0xFF] << 16 | inv_s_box[(s0 >> 8) & 0xFF] << 8 | inv_s_box[s3 & 0xFF]) ^ w[i+2],
+            (inv_s_box[s3 >> 24] << 24 | inv_s_box[(s2 >> 16) & 0xFF] << 16 | inv_s_box[(s1 >> 8) & 0xFF] << 8 | inv_s_box[s0 & 0xFF]) ^ w[i+3],
+        )
+
+    def _encrypt_block_matrix(self, plaintext):
+        """
+        Encrypts a single block with the matrix engine.
         """
-        assert len(plaintext) == 16
-
         plain_state = bytes2matrix(plaintext)
 
         add_round_key(plain_state, self._key_matrices[0])
@@ -243,203 +547,413 @@ class AES:
 
         return matrix2bytes(plain_state)
 
-    def decrypt_block(self, ciphertext):
+    def _decrypt_block_matrix(self, ciphertext):
         """
-        Decrypts a single block of 16 byte long ciphertext.
+        Decrypts a single block with the matrix engine.
         """
-        assert len(ciphertext) == 16
-
         cipher_state = bytes2matrix(ciphertext)
 
-        add_round_key(cipher_state, self._key_matrices[-1])
-        inv_shift_rows(cipher_state)
-        inv_sub_bytes(cipher_state)
+        # Equivalent inverse cipher, using the precomputed decryption keys.
+        add_round_key(cipher_state, self._dec_key_matrices[0])
 
-        for i in range(self.n_rounds - 1, 0, -1):
-            add_round_key(cipher_state, self._key_matrices[i])
-            inv_mix_columns(cipher_state)
-            inv_shift_rows(cipher_state)
+        for i in range(1, self.n_rounds):
             inv_sub_bytes(cipher_state)
+            inv_shift_rows(cipher_state)
+            inv_mix_columns(cipher_state)
+            add_round_key(cipher_state, self._dec_key_matrices[i])
 
-        add_round_key(cipher_state, self._key_matrices[0])
+        inv_sub_bytes(cipher_state)
+        inv_shift_rows(cipher_state)
+        add_round_key(cipher_state, self._dec_key_matrices[-1])
 
         return matrix2bytes(cipher_state)
 
-    def encrypt_cbc(self, plaintext, iv):
+    def encrypt_block(self, plaintext, out=None):
+        """
+        Encrypts a single block of 16 byte long plaintext.
+
+        Like every `encrypt_*`/`decrypt_*` method, it returns a new bytes
+        object, or writes into the writable buffer `out` (a bytearray,
+        memoryview or mmap) and returns the number of bytes written.
+        """
+        assert len(plaintext) == 16
+
+        if self.engine == 'matrix' and out is None:
+            return self._encrypt_block_matrix(plaintext)
+
+        buffer, view = output_buffer(out, 16)
+        _block_struct.pack_into(view, 0, *self._encrypt_words(*unpack_block(plaintext)))
+        return finish_output(out, buffer, 16)
+
+    def decrypt_block(self, ciphertext, out=None):
+        """
+        Decrypts a single block of 16 byte long ciphertext.
+        """
+        assert len(ciphertext) == 16
+
+        if self.engine == 'matrix' and out is None:
+            return self._decrypt_block_matrix(ciphertext)
+
+        buffer, view = output_buffer(out, 16)
+        _block_struct.pack_into(view, 0, *self._decrypt_words(*unpack_block(ciphertext)))
+        return finish_output(out, buffer, 16)
+
+    def encrypt_ecb(self, plaintext, out=None):
+        """
+        Encrypts `plaintext`, a whole number of blocks, as independent blocks
+        (raw ECB, no padding). Meant for batches of blocks, not messages.
+        """
+        assert len(plaintext) % 16 == 0
+
+        if self._batch is not None:
+            return store_output(out, self._batch.encrypt_ecb(plaintext))
+
+        size = len(plaintext)
+        buffer, view = output_buffer(out, size)
+        encrypt, pack_into, unpack_from = self._encrypt_words, _block_struct.pack_into, _block_struct.unpack_from
+        for i in range(0, size, 16):
+            pack_into(view, i, *encrypt(*unpack_from(plaintext, i)))
+        return finish_output(out, buffer, size)
+
+    def decrypt_ecb(self, ciphertext, out=None):
+        """
+        Decrypts `ciphertext`, a whole number of blocks, as independent
+        blocks (raw ECB, no padding).
+        """
+        assert len(ciphertext) % 16 == 0
+
+        if self._batch is not None:
+            return store_output(out, self._batch.decrypt_ecb(ciphertext))
+
+        size = len(ciphertext)
+        buffer, view = output_buffer(out, size)
+        decrypt, pack_into, unpack_from = self._decrypt_words, _block_struct.pack_into, _block_struct.unpack_from
+        for i in range(0, size, 16):
+            pack_into(view, i, *decrypt(*unpack_from(ciphertext, i)))
+        return finish_output(out, buffer, size)
+
+    def encrypt_cbc(self, plaintext, iv, out=None):
         """
         Encrypts `plaintext` using CBC mode and PKCS#7 padding, with the given
-        initialization vector (iv).
+        initialization vector (iv). `out` needs room for the padded length,
+        len(plaintext) // 16 * 16 + 16 bytes.
         """
         assert len(iv) == 16
 
-        plaintext = pad(plaintext)
+        full = len(plaintext) - len(plaintext) % 16
+        size = full + 16
+        buffer, view = output_buffer(out, size)
+        encrypt, pack_into, unpack_from = self._encrypt_words, _block_struct.pack_into, _block_struct.unpack_from
+        # Only the last block is padded, so the message itself is not copied.
+        last = pad(bytes(plaintext[full:]))
 
-        blocks = []
-        previous = iv
-        for plaintext_block in split_blocks(plaintext):
+        c0, c1, c2, c3 = unpack_block(iv)
+        for i in range(0, size, 16):
             # CBC mode encrypt: encrypt(plaintext_block XOR previous)
-            block = self.encrypt_block(xor_bytes(plaintext_block, previous))
-            blocks.append(block)
-            previous = block
+            p0, p1, p2, p3 = unpack_from(plaintext, i) if i < full else unpack_block(last)
+            c0, c1, c2, c3 = encrypt(p0 ^ c0, p1 ^ c1, p2 ^ c2, p3 ^ c3)
+            pack_into(view, i, c0, c1, c2, c3)
 
-        return b''.join(blocks)
+        return finish_output(out, buffer, size)
 
-    def decrypt_cbc(self, ciphertext, iv):
+    def decrypt_cbc(self, ciphertext, iv, out=None):
         """
         Decrypts `ciphertext` using CBC mode and PKCS#7 padding, with the given
-        initialization vector (iv).
+        initialization vector (iv). `out` needs room for len(ciphertext)
+        bytes; the padding is written too, but not counted in the result.
         """
         assert len(iv) == 16
 
-        blocks = []
-        previous = iv
-        for ciphertext_block in split_blocks(ciphertext):
-            # CBC mode decrypt: previous XOR decrypt(ciphertext)
-            blocks.append(xor_bytes(previous, self.decrypt_block(ciphertext_block)))
-            previous = ciphertext_block
+        if self._batch is not None:
+            assert len(ciphertext) % 16 == 0
+            plaintext = self._batch.decrypt_cbc(ciphertext, iv)
+            if out is None:
+                return unpad(plaintext)
+            return unpadded_size(out, store_output(out, plaintext))
+
+        assert len(ciphertext) % 16 == 0
+        size = len(ciphertext)
+        buffer, view = output_buffer(out, size)
+        self._decrypt_cbc_into(ciphertext, iv, view)
+        return finish_output(out, buffer, unpadded_size(view, size))
+
+    def decrypt_cbc_blocks(self, ciphertext, iv, out=None):
+        """
+        Decrypts whole CBC blocks without removing padding, for one piece
+        of a longer message: `iv` is the ciphertext block before this piece.
+        `out` may be `ciphertext` itself, to decrypt in place.
+        """
+        assert len(iv) == 16
+        assert len(ciphertext) % 16 == 0
+
+        if self._batch is not None:
+            return store_output(out, self._batch.decrypt_cbc(ciphertext, iv))
 
-        return unpad(b''.join(blocks))
+        size = len(ciphertext)
+        buffer, view = output_buffer(out, size)
+        self._decrypt_cbc_into(ciphertext, iv, view)
+        return finish_output(out, buffer, size)
 
-    def encrypt_pcbc(self, plaintext, iv):
+    def _decrypt_cbc_into(self, ciphertext, iv, view):
+        """
+        CBC decryption of every block of `ciphertext` into `view`. Each
+        block is read before its output is written, so they may overlap.
+        """
+        decrypt, pack_into, unpack_from = self._decrypt_words, _block_struct.pack_into, _block_struct.unpack_from
+
+        c0, c1, c2, c3 = unpack_block(iv)
+        for i in range(0, len(ciphertext), 16):
+            # CBC mode decrypt: previous XOR decrypt(ciphertext)
+            b0, b1, b2, b3 = unpack_from(ciphertext, i)
+            p0, p1, p2, p3 = decrypt(b0, b1, b2, b3)
+            pack_into(view, i, p0 ^ c0, p1 ^ c1, p2 ^ c2, p3 ^ c3)
+            c0, c1, c2, c3 = b0, b1, b2, b3
+
+    def encrypt_pcbc(self, plaintext, iv, out=None):
         """
         Encrypts `plaintext` using PCBC mode and PKCS#7 padding, with the given
-        initialization vector (iv).
+        initialization vector (iv). `out` needs room for the padded length.
         """
         assert len(iv) == 16
 
-        plaintext = pad(plaintext)
+        full = len(plaintext) - len(plaintext) % 16
+        size = full + 16
+        buffer, view = output_buffer(out, size)
+        encrypt, pack_into, unpack_from = self._encrypt_words, _block_struct.pack_into, _block_struct.unpack_from
+        last = pad(bytes(plaintext[full:]))
 
-        blocks = []
-        prev_ciphertext = iv
-        prev_plaintext = bytes(16)
-        for plaintext_block in split_blocks(plaintext):
+        # prev_ciphertext XOR prev_plaintext, with prev_plaintext = 0 at first.
+        m0, m1, m2, m3 = unpack_block(iv)
+        for i in range(0, size, 16):
             # PCBC mode encrypt: encrypt(plaintext_block XOR (prev_ciphertext XOR prev_plaintext))
-            ciphertext_block = self.encrypt_block(xor_bytes(plaintext_block, xor_bytes(prev_ciphertext, prev_plaintext)))
-            blocks.append(ciphertext_block)
-            prev_ciphertext = ciphertext_block
-            prev_plaintext = plaintext_block
+            p0, p1, p2, p3 = unpack_from(plaintext, i) if i < full else unpack_block(last)
+            c0, c1, c2, c3 = encrypt(p0 ^ m0, p1 ^ m1, p2 ^ m2, p3 ^ m3)
+            pack_into(view, i, c0, c1, c2, c3)
+            m0, m1, m2, m3 = c0 ^ p0, c1 ^ p1, c2 ^ p2, c3 ^ p3
 
-        return b''.join(blocks)
+        return finish_output(out, buffer, size)
 
-    def decrypt_pcbc(self, ciphertext, iv):
+    def decrypt_pcbc(self, ciphertext, iv, out=None):
         """
         Decrypts `ciphertext` using PCBC mode and PKCS#7 padding, with the given
-        initialization vector (iv).
+        initialization vector (iv). `out` needs room for len(ciphertext) bytes.
         """
         assert len(iv) == 16
 
-        blocks = []
-        prev_ciphertext = iv
-        prev_plaintext = bytes(16)
-        for ciphertext_block in split_blocks(ciphertext):
+        assert len(ciphertext) % 16 == 0
+        size = len(ciphertext)
+        buffer, view = output_buffer(out, size)
+        decrypt, pack_into, unpack_from = self._decrypt_words, _block_struct.pack_into, _block_struct.unpack_from
+
+        m0, m1, m2, m3 = unpack_block(iv)
+        for i in range(0, size, 16):
             # PCBC mode decrypt: (prev_plaintext XOR prev_ciphertext) XOR decrypt(ciphertext_block)
-            plaintext_block = xor_bytes(xor_bytes(prev_ciphertext, prev_plaintext), self.decrypt_block(ciphertext_block))
-            blocks.append(plaintext_block)
-            prev_ciphertext = ciphertext_block
-            prev_plaintext = plaintext_block
+            b0, b1, b2, b3 = unpack_from(ciphertext, i)
+            d0, d1, d2, d3 = decrypt(b0, b1, b2, b3)
+            p0, p1, p2, p3 = d0 ^ m0, d1 ^ m1, d2 ^ m2, d3 ^ m3
+            pack_into(view, i, p0, p1, p2, p3)
+            m0, m1, m2, m3 = b0 ^ p0, b1 ^ p1, b2 ^ p2, b3 ^ p3
 
-        return unpad(b''.join(blocks))
+        return finish_output(out, buffer, unpadded_size(view, size))
 
-    def encrypt_cfb(self, plaintext, iv):
+    def _keystream_tail(self, data, full, view, keystream_words):
+        """
+        XORs the partial block after the `full` whole-block bytes of `data`
+        with the first bytes of one keystream block.
+        """
+        tail = bytes(data[full:])
+        view[full:full + len(tail)] = xor_long(tail, pack_block(*keystream_words)[:len(tail)])
+
+    def _crypt_cfb(self, data, iv, out, decrypting):
+        """ CFB mode; the feedback is the ciphertext, whichever side it is on. """
+        size = len(data)
+        full = size - size % 16
+        buffer, view = output_buffer(out, size)
+        encrypt, pack_into, unpack_from = self._encrypt_words, _block_struct.pack_into, _block_struct.unpack_from
+
+        f0, f1, f2, f3 = unpack_block(iv)
+        for i in range(0, full, 16):
+            # CFB mode: data_block XOR encrypt(prev_ciphertext)
+            k0, k1, k2, k3 = encrypt(f0, f1, f2, f3)
+            d0, d1, d2, d3 = unpack_from(data, i)
+            c0, c1, c2, c3 = d0 ^ k0, d1 ^ k1, d2 ^ k2, d3 ^ k3
+            pack_into(view, i, c0, c1, c2, c3)
+            f0, f1, f2, f3 = (d0, d1, d2, d3) if decrypting else (c0, c1, c2, c3)
+
+        if full < size:
+            self._keystream_tail(data, full, view, encrypt(f0, f1, f2, f3))
+        return finish_output(out, buffer, size)
+
+    def encrypt_cfb(self, plaintext, iv, out=None):
         """
         Encrypts `plaintext` with the given initialization vector (iv).
         """
         assert len(iv) == 16
+        return self._crypt_cfb(plaintext, iv, out, decrypting=False)
 
-        blocks = []
-        prev_ciphertext = iv
-        for plaintext_block in split_blocks(plaintext, require_padding=False):
-            # CFB mode encrypt: plaintext_block XOR encrypt(prev_ciphertext)
-            ciphertext_block = xor_bytes(plaintext_block, self.encrypt_block(prev_ciphertext))
-            blocks.append(ciphertext_block)
-            prev_ciphertext = ciphertext_block
-
-        return b''.join(blocks)
-
-    def decrypt_cfb(self, ciphertext, iv):
+    def decrypt_cfb(self, ciphertext, iv, out=None):
         """
         Decrypts `ciphertext` with the given initialization vector (iv).
         """
         assert len(iv) == 16
 
-        blocks = []
-        prev_ciphertext = iv
-        for ciphertext_block in split_blocks(ciphertext, require_padding=False):
-            # CFB mode decrypt: ciphertext XOR decrypt(prev_ciphertext)
-            plaintext_block = xor_bytes(ciphertext_block, self.encrypt_block(prev_ciphertext))
-            blocks.append(plaintext_block)
-            prev_ciphertext = ciphertext_block
+        if self._batch is not None:
+            return store_output(out, self._batch.decrypt_cfb(ciphertext, iv))
+
+        return self._crypt_cfb(ciphertext, iv, out, decrypting=True)
 
-        return b''.join(blocks)
+    def _crypt_ofb(self, data, iv, out):
+        """ OFB keystream XOR, shared by encryption and decryption. """
+        size = len(data)
+        full = size - size % 16
+        buffer, view = output_buffer(out, size)
+        encrypt, pack_into, unpack_from = self._encrypt_words, _block_struct.pack_into, _block_struct.unpack_from
 
-    def encrypt_ofb(self, plaintext, iv):
+        k0, k1, k2, k3 = unpack_block(iv)
+        for i in range(0, full, 16):
+            # OFB mode: data_block XOR encrypt(previous)
+            k0, k1, k2, k3 = encrypt(k0, k1, k2, k3)
+            d0, d1, d2, d3 = unpack_from(data, i)
+            pack_into(view, i, d0 ^ k0, d1 ^ k1, d2 ^ k2, d3 ^ k3)
+
+        if full < size:
+            self._keystream_tail(data, full, view, encrypt(k0, k1, k2, k3))
+        return finish_output(out, buffer, size)
+
+    def encrypt_ofb(self, plaintext, iv, out=None):
         """
         Encrypts `plaintext` using OFB mode initialization vector (iv).
         """
         assert len(iv) == 16
+        return self._crypt_ofb(plaintext, iv, out)
 
-        blocks = []
-        previous = iv
-        for plaintext_block in split_blocks(plaintext, require_padding=False):
-            # OFB mode encrypt: plaintext_block XOR encrypt(previous)
-            block = self.encrypt_block(previous)
-            ciphertext_block = xor_bytes(plaintext_block, block)
-            blocks.append(ciphertext_block)
-            previous = block
-
-        return b''.join(blocks)
-
-    def decrypt_ofb(self, ciphertext, iv):
+    def decrypt_ofb(self, ciphertext, iv, out=None):
         """
         Decrypts `ciphertext` using OFB mode initialization vector (iv).
         """
         assert len(iv) == 16
-
-        blocks = []
-        previous = iv
-        for ciphertext_block in split_blocks(ciphertext, require_padding=False):
-            # OFB mode decrypt: ciphertext XOR encrypt(previous)
-            block = self.encrypt_block(previous)
-            plaintext_block = xor_bytes(ciphertext_block, block)
-            blocks.append(plaintext_block)
-            previous = block
-
-        return b''.join(blocks)
-
-    def encrypt_ctr(self, plaintext, iv):
+        return self._crypt_ofb(ciphertext, iv, out)
+
+    def _ctr_keystream(self, data, iv, out):
+        """ CTR keystream XOR, shared by encryption and decryption. """
+        size = len(data)
+        full = size - size % 16
+        buffer, view = output_buffer(out, size)
+        encrypt, pack_into, unpack_from = self._encrypt_words, _block_struct.pack_into, _block_struct.unpack_from
+
+        counter = int.from_bytes(iv, 'big')
+        for i in range(0, full, 16):
+            # CTR mode: data_block XOR encrypt(nonce)
+            k0, k1, k2, k3 = encrypt(counter >> 96, (counter >> 64) & 0xFFFFFFFF,
+                                     (counter >> 32) & 0xFFFFFFFF, counter & 0xFFFFFFFF)
+            d0, d1, d2, d3 = unpack_from(data, i)
+            pack_into(view, i, d0 ^ k0, d1 ^ k1, d2 ^ k2, d3 ^ k3)
+            counter = (counter + 1) & CTR_MASK
+
+        if full < size:
+            self._keystream_tail(data, full, view, encrypt(*unpack_block(counter.to_bytes(16, 'big'))))
+        return finish_output(out, buffer, size)
+
+    def encrypt_ctr(self, plaintext, iv, out=None):
         """
         Encrypts `plaintext` using CTR mode with the given nounce/IV.
         """
         assert len(iv) == 16
 
-        blocks = []
-        nonce = iv
-        for plaintext_block in split_blocks(plaintext, require_padding=False):
-            # CTR mode encrypt: plaintext_block XOR encrypt(nonce)
-            block = xor_bytes(plaintext_block, self.encrypt_block(nonce))
-            blocks.append(block)
-            nonce = inc_bytes(nonce)
+        if self._batch is not None:
+            return store_output(out, self._batch.crypt_ctr(plaintext, iv))
 
-        return b''.join(blocks)
+        return self._ctr_keystream(plaintext, iv, out)
 
-    def decrypt_ctr(self, ciphertext, iv):
+    def decrypt_ctr(self, ciphertext, iv, out=None):
         """
         Decrypts `ciphertext` using CTR mode with the given nounce/IV.
         """
         assert len(iv) == 16
 
-        blocks = []
-        nonce = iv
-        for ciphertext_block in split_blocks(ciphertext, require_padding=False):
-            # CTR mode decrypt: ciphertext XOR encrypt(nonce)
-            block = xor_bytes(ciphertext_block, self.encrypt_block(nonce))
-            blocks.append(block)
-            nonce = inc_bytes(nonce)
+        if self._batch is not None:
+            return store_output(out, self._batch.crypt_ctr(ciphertext, iv))
 
-        return b''.join(blocks)
+        return self._ctr_keystream(ciphertext, iv, out)
+
+    def _gcm_setup(self, iv):
+        """
+        Returns the GHASH tables for this key and the pre-counter block J0
+        for the given IV (NIST SP 800-38D, Sec 7.1).
+        """
+        assert len(iv) > 0
+        if getattr(self, '_ghash_tables', None) is None:
+            h = int.from_bytes(self.encrypt_block(bytes(16)), 'big')
+            self._ghash_tables = ghash_tables(h)
+
+        if len(iv) == 12:
+            j0 = bytes(iv) + b'\x00\x00\x00\x01'
+        else:
+            lengths = (8 * len(iv)).to_bytes(16, 'big')
+            j0 = ghash(self._ghash_tables, zero_pad(iv) + lengths).to_bytes(16, 'big')
+        return self._ghash_tables, j0
+
+    def _gctr(self, j0, data, view):
+        """
+        GCM's counter mode: XORs `data` with the encryption of J0 + 1, J0 + 2,
+        ... where only the last 32 bits of the counter are incremented, and
+        writes the result to the start of `view`. The counter blocks are
+        independent, so they are encrypted in batches with `encrypt_ecb` and
+        benefit from the vectorized or native engines.
+        """
+        prefix = j0[:12]
+        counter = int.from_bytes(j0[12:], 'big')
+        chunk_bytes = 16 * GCM_CHUNK_BLOCKS
+        for offset in range(0, len(data), chunk_bytes):
+            piece = data[offset:offset+chunk_bytes]
+            first = counter + 1 + offset // 16
+            counters = b''.join(prefix + ((first + i) & 0xFFFFFFFF).to_bytes(4, 'big')
+                                for i in range((len(piece) + 15) // 16))
+            keystream = self.encrypt_ecb(counters)
+            view[offset:offset+len(piece)] = xor_long(bytes(piece), keystream[:len(piece)])
+
+    def _gcm_tag(self, tables, j0, associated_data, ciphertext, tag_size):
+        """ Computes the authentication tag over the AAD and ciphertext. """
+        lengths = (8 * len(associated_data)).to_bytes(8, 'big') + (8 * len(ciphertext)).to_bytes(8, 'big')
+        s = ghash(tables, zero_pad(associated_data))
+        s = ghash(tables, zero_pad(ciphertext), s)
+        s = ghash(tables, lengths, s)
+        return xor_long(self.encrypt_block(j0), s.to_bytes(16, 'big'))[:tag_size]
+
+    def encrypt_gcm(self, plaintext, iv, associated_data=b'', tag_size=16, out=None):
+        """
+        Encrypts and authenticates `plaintext` using GCM mode with the given
+        IV (12 bytes recommended), also authenticating `associated_data`.
+        Returns the ciphertext followed by a `tag_size` bytes long tag.
+        """
+        assert 12 <= tag_size <= 16
+        tables, j0 = self._gcm_setup(iv)
+        size = len(plaintext)
+        buffer, view = output_buffer(out, size + tag_size)
+        self._gctr(j0, plaintext, view)
+        view[size:size + tag_size] = self._gcm_tag(tables, j0, associated_data, view[:size], tag_size)
+        return finish_output(out, buffer, size + tag_size)
+
+    def decrypt_gcm(self, ciphertext, iv, associated_data=b'', tag_size=16, out=None):
+        """
+        Verifies and decrypts `ciphertext` (with the tag at the end) using GCM
+        mode with the given IV and associated data.
+        """
+        assert 12 <= tag_size <= 16
+        assert len(ciphertext) >= tag_size, 'Ciphertext is shorter than the tag.'
+        ciphertext, tag = ciphertext[:-tag_size], ciphertext[-tag_size:]
+        tables, j0 = self._gcm_setup(iv)
+        expected_tag = self._gcm_tag(tables, j0, associated_data, ciphertext, tag_size)
+        assert compare_digest(tag, expected_tag), 'Ciphertext corrupted or tampered.'
+        buffer, view = output_buffer(out, len(ciphertext))
+        self._gctr(j0, ciphertext, view)
+        return finish_output(out, buffer, len(ciphertext))
 
 
 import os
+import queue
+import time
+from collections import namedtuple
 from hashlib import pbkdf2_hmac
 from hmac import new as new_hmac, compare_digest
 
@@ -449,6 +963,25 @@ IV_SIZE = 16
 
 SALT_SIZE = 16
 HMAC_SIZE = 32
+GCM_IV_SIZE = 12
+GCM_TAG_SIZE = 16
+
+# Session envelope: magic + version + workload + salt, then per message a
+# nonce, the ciphertext and an HMAC covering everything before it.
+SESSION_MAGIC = b'\x89AES'
+SESSION_VERSION = 1
+SESSION_HEADER_SIZE = len(SESSION_MAGIC) + 1 + 4 + SALT_SIZE
+SESSION_KEY_SIZE = 32
+NONCE_SIZE = 16
+
+def stretch_key(password, salt, workload, length=SESSION_KEY_SIZE):
+    """
+    Stretches `password` (str or bytes) into `length` bytes with
+    PBKDF2-HMAC-SHA256, for envelopes that derive their keys from it.
+    """
+    if isinstance(password, str):
+        password = password.encode('utf-8')
+    return pbkdf2_hmac('sha256', password, salt, workload, length)
 
 def get_key_iv(password, salt, workload=100000):
     """
@@ -462,53 +995,603 @@ def get_key_iv(password, salt, workload=100000):
     return aes_key, hmac_key, iv
 
 
-def encrypt(key, plaintext, workload=100000):
+KeyCacheInfo = namedtuple('KeyCacheInfo', 'hits misses evictions expirations size maxsize')
+
+class KeyCache:
+    """
+    Bounded, thread-safe LRU cache of `get_key_iv` results, keyed on
+    (password digest, salt, workload).
+
+    Passwords are never stored: they are identified by an HMAC under a
+    random per-cache secret. Entries older than `ttl` seconds (if given) are
+    dropped on access, and the least recently used entry is evicted once
+    `maxsize` entries are stored.
+    """
+    def __init__(self, maxsize=256, ttl=None, clock=time.monotonic):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._secret = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = self._misses = self._evictions = self._expirations = 0
+
+    def _password_id(self, password):
+        return new_hmac(self._secret, password, 'sha256').digest()
+
+    def get_key_iv(self, password, salt, workload=100000):
+        """
+        Returns `get_key_iv(password, salt, workload)`, from the cache when
+        possible. The key derivation runs outside the lock.
+        """
+        cache_key = (self._password_id(password), bytes(salt), workload)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and self.ttl is not None and self._clock() - entry[0] > self.ttl:
+                del self._entries[cache_key]
+                self._expirations += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(cache_key)
+                self._hits += 1
+                return entry[1]
+            self._misses += 1
+
+        value = get_key_iv(password, salt, workload)
+        self._store(cache_key, value)
+        return value
+
+    def _store(self, cache_key, value):
+        with self._lock:
+            self._entries[cache_key] = (self._clock(), value)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, password=None):
+        """
+        Drops every entry derived from `password`, or all entries if no
+        password is given (e.g. after a password change or key rotation).
+        """
+        with self._lock:
+            if password is None:
+                self._entries.clear()
+                return
+            password_id = self._password_id(password)
+            for cache_key in [k for k in self._entries if k[0] == password_id]:
+                del self._entries[cache_key]
+
+    def cache_info(self):
+        """ Returns hit/miss statistics, like `functools.lru_cache`. """
+        with self._lock:
+            return KeyCacheInfo(self._hits, self._misses, self._evictions,
+                                self._expirations, len(self._entries), self.maxsize)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Opt-in cache consulted by `decrypt`; None disables caching.
+key_cache = None
+
+def enable_key_cache(maxsize=256, ttl=None):
+    """
+    Makes `decrypt` cache derived keys, and returns the cache. Only worth it
+    when the same (password, salt) pairs are decrypted often, since every
+    entry keeps key material in memory.
+    """
+    global key_cache
+    key_cache = KeyCache(maxsize, ttl)
+    return key_cache
+
+def disable_key_cache():
+    """ Stops caching derived keys and drops the cached ones. """
+    global key_cache
+    if key_cache is not None:
+        key_cache.invalidate()
+    key_cache = None
+
+def _derive(password, salt, workload):
+    """ `get_key_iv`, going through the key cache when it is enabled. """
+    if key_cache is None:
+        return get_key_iv(password, salt, workload)
+    return key_cache.get_key_iv(password, salt, workload)
+
+
+def encrypt(key, plaintext, workload=100000, mode='cbc', out=None):
     """
     Encrypts `plaintext` with `key` using AES-128, an HMAC to verify integrity,
     and PBKDF2 to stretch the given key.
 
+    With mode='gcm', AES-GCM replaces CBC + HMAC, so the message is encrypted
+    and authenticated in a single pass, producing salt + ciphertext + tag.
+    With mode='session', the message is a one-off `Session` record.
+
+    If a writable buffer `out` is given, the result is written into it and
+    the number of bytes written is returned.
+
     The exact algorithm is specified in the module docstring.
     """
+    assert mode in ('cbc', 'gcm', 'session')
+    if mode == 'session':
+        return store_output(out, Session(key, workload).encrypt(plaintext))
     if isinstance(key, str):
         key = key.encode('utf-8')
     if isinstance(plaintext, str):
         plaintext = plaintext.encode('utf-8')
 
     salt = os.urandom(SALT_SIZE)
+    # The salt is new, so the key cache could never hit here; storing the
+    # result would only push out keys that `decrypt` reuses.
     key, hmac_key, iv = get_key_iv(key, salt, workload)
-    ciphertext = AES(key).encrypt_cbc(plaintext, iv)
-    hmac = new_hmac(hmac_key, salt + ciphertext, 'sha256').digest()
+
+    if mode == 'gcm':
+        # The salt is authenticated as associated data.
+        size = SALT_SIZE + len(plaintext) + GCM_TAG_SIZE
+        buffer, view = output_buffer(out, size)
+        view[:SALT_SIZE] = salt
+        AES(key).encrypt_gcm(plaintext, iv[:GCM_IV_SIZE], salt, out=view[SALT_SIZE:size])
+        return finish_output(out, buffer, size)
+
+    # hmac + salt + ciphertext, with the ciphertext written in place first.
+    header_size = HMAC_SIZE + SALT_SIZE
+    size = header_size + len(plaintext) // 16 * 16 + 16
+    buffer, view = output_buffer(out, size)
+    view[HMAC_SIZE:header_size] = salt
+    AES(key).encrypt_cbc(plaintext, iv, out=view[header_size:size])
+    hmac = new_hmac(hmac_key, view[HMAC_SIZE:size], 'sha256').digest()
     assert len(hmac) == HMAC_SIZE
+    view[:HMAC_SIZE] = hmac
 
-    return hmac + salt + ciphertext
+    return finish_output(out, buffer, size)
 
 
-def decrypt(key, ciphertext, workload=100000):
+def decrypt(key, ciphertext, workload=100000, mode='cbc', out=None):
     """
     Decrypts `ciphertext` with `key` using AES-128, an HMAC to verify integrity,
     and PBKDF2 to stretch the given key.
 
+    `mode` must match the one used by `encrypt`. With a writable buffer `out`
+    (which needs room for the ciphertext minus its salt and MAC or tag), the
+    plaintext is written into it and its length is returned.
+
+    With mode='session', `ciphertext` is a `Session` record, which must have
+    been written with this `workload`.
+
     The exact algorithm is specified in the module docstring.
     """
+    assert mode in ('cbc', 'gcm', 'session')
 
-    assert len(ciphertext) % 16 == 0, "Ciphertext must be made of full 16-byte blocks."
+    if mode == 'session':
+        return store_output(out, Session.from_ciphertext(key, ciphertext, workload).decrypt(ciphertext))
 
-    assert len(ciphertext) >= 32, """
-    Ciphertext must be at least 32 bytes long (16 byte salt + 16 byte block). To
-    encrypt or decrypt single blocks use `AES(key).decrypt_block(ciphertext)`.
-    """
+    if mode == 'gcm':
+        assert len(ciphertext) >= SALT_SIZE + GCM_TAG_SIZE, 'Ciphertext is too short.'
+    else:
+        assert len(ciphertext) % 16 == 0, "Ciphertext must be made of full 16-byte blocks."
+
+        assert len(ciphertext) >= 32, """
+        Ciphertext must be at least 32 bytes long (16 byte salt + 16 byte block). To
+        encrypt or decrypt single blocks use `AES(key).decrypt_block(ciphertext)`.
+        """
 
     if isinstance(key, str):
         key = key.encode('utf-8')
 
-    hmac, ciphertext = ciphertext[:HMAC_SIZE], ciphertext[HMAC_SIZE:]
-    salt, ciphertext = ciphertext[:SALT_SIZE], ciphertext[SALT_SIZE:]
-    key, hmac_key, iv = get_key_iv(key, salt, workload)
+    if mode == 'gcm':
+        salt, ciphertext = ciphertext[:SALT_SIZE], ciphertext[SALT_SIZE:]
+        key, _, iv = _derive(key, salt, workload)
+        return AES(key, cache=key_cache is not None).decrypt_gcm(ciphertext, iv[:GCM_IV_SIZE], salt, out=out)
 
-    expected_hmac = new_hmac(hmac_key, salt + ciphertext, 'sha256').digest()
+    # Views, so the (possibly large) ciphertext is never copied.
+    data = memoryview(ciphertext).cast('B')
+    hmac, salt = data[:HMAC_SIZE], bytes(data[HMAC_SIZE:HMAC_SIZE + SALT_SIZE])
+    key, hmac_key, iv = _derive(key, salt, workload)
+
+    # The HMAC covers salt + ciphertext, which are contiguous in the input.
+    expected_hmac = new_hmac(hmac_key, data[HMAC_SIZE:], 'sha256').digest()
     assert compare_digest(hmac, expected_hmac), 'Ciphertext corrupted or tampered.'
 
-    return AES(key).decrypt_cbc(ciphertext, iv)
+    # Derived keys only recur when `decrypt` caches them.
+    return AES(key, cache=key_cache is not None).decrypt_cbc(data[HMAC_SIZE + SALT_SIZE:], iv, out=out)
+
+
+def hkdf(key, salt, info, length):
+    """
+    HKDF-SHA256 (RFC 5869): extracts a pseudorandom key from `key` and
+    `salt`, then expands it to `length` bytes bound to `info`.
+    """
+    prk = new_hmac(salt, key, 'sha256').digest()
+    output = b''
+    block = b''
+    counter = 1
+    while len(output) < length:
+        block = new_hmac(prk, block + info + bytes([counter]), 'sha256').digest()
+        output += block
+        counter += 1
+    return output[:length]
+
+
+class Session:
+    """
+    Encrypts many messages under one password while paying for PBKDF2 once.
+
+    The password is stretched a single time into a session key. Each message
+    then gets a fresh random nonce, from which HKDF derives its own AES key,
+    HMAC key and IV, so encrypting a record costs microseconds of key
+    derivation instead of a full key stretch. Messages are encrypted with
+    AES-128 in CBC mode and authenticated with HMAC-SHA256 over the header,
+    nonce and ciphertext.
+
+    Every ciphertext carries a versioned header with the PBKDF2 salt and
+    workload, so `decrypt(mode='session')` (or any session with the same
+    password and workload) can read it back. The header is only
+    authenticated after the key stretch, so its workload must match the
+    expected one rather than being trusted:
+
+        header = magic + version + workload + salt
+        ciphertext = header + nonce + E_key_aes(message, iv) + HMAC
+    """
+    # Session keys for salts seen by `decrypt`, so records written by one
+    # session are only stretched once. Bounded to keep memory in check.
+    max_foreign_keys = 64
+
+    def __init__(self, password, workload=100000, salt=None):
+        if isinstance(password, str):
+            password = password.encode('utf-8')
+        assert 0 < workload < 1 << 32
+        self._password = password
+        self.workload = workload
+        self.salt = os.urandom(SALT_SIZE) if salt is None else bytes(salt)
+        assert len(self.salt) == SALT_SIZE
+        self.header = (SESSION_MAGIC + bytes([SESSION_VERSION]) +
+                       workload.to_bytes(4, 'big') + self.salt)
+        self._session_key = self._stretch(self.salt, workload)
+        self._foreign_keys = OrderedDict()
+
+    def __getstate__(self):
+        # A pickled session (sent to a worker process, say) carries its
+        # session key but not the password, so it can encrypt and decrypt
+        # its own records but cannot stretch keys for other salts.
+        state = dict(self.__dict__, _password=None)
+        state['_foreign_keys'] = OrderedDict()
+        return state
+
+    @classmethod
+    def from_ciphertext(cls, password, ciphertext, workload=100000):
+        """
+        Creates a session with the salt of `ciphertext`'s header, which must
+        have been written with `workload`.
+        """
+        salt, header_workload = parse_session_header(ciphertext)
+        assert header_workload == workload, 'Unexpected workload {}.'.format(header_workload)
+        return cls(password, workload, salt)
+
+    def _stretch(self, salt, workload):
+        assert self._password is not None, 'Session was unpickled without its password.'
+        return stretch_key(self._password, salt, workload)
+
+    def _message_keys(self, session_key, nonce):
+        """ Derives the per-message AES key, HMAC key and IV. """
+        keys = hkdf(session_key, nonce, self.header[:len(SESSION_MAGIC) + 1],
+                    AES_KEY_SIZE + HMAC_KEY_SIZE + IV_SIZE)
+        return (keys[:AES_KEY_SIZE], keys[AES_KEY_SIZE:AES_KEY_SIZE + HMAC_KEY_SIZE],
+                keys[AES_KEY_SIZE + HMAC_KEY_SIZE:])
+
+    def encrypt(self, plaintext):
+        """
+        Encrypts and authenticates one message.
+        """
+        if isinstance(plaintext, str):
+            plaintext = plaintext.encode('utf-8')
+
+        nonce = os.urandom(NONCE_SIZE)
+        key, hmac_key, iv = self._message_keys(self._session_key, nonce)
+        body = self.header + nonce + AES(key).encrypt_cbc(plaintext, iv)
+        return body + new_hmac(hmac_key, body, 'sha256').digest()
+
+    def _session_key_for(self, salt):
+        if salt == self.salt:
+            return self._session_key
+        if salt not in self._foreign_keys:
+            self._foreign_keys[salt] = self._stretch(salt, self.workload)
+            if len(self._foreign_keys) > self.max_foreign_keys:
+                self._foreign_keys.popitem(last=False)
+        return self._foreign_keys[salt]
+
+    def decrypt(self, ciphertext):
+        """
+        Verifies and decrypts one message produced by a session with the
+        same password and workload (this one, or another with a different
+        salt).
+        """
+        salt, workload = parse_session_header(ciphertext)
+        assert workload == self.workload, 'Unexpected workload {}.'.format(workload)
+        assert len(ciphertext) >= SESSION_HEADER_SIZE + NONCE_SIZE + 16 + HMAC_SIZE, 'Ciphertext is too short.'
+        body, hmac = ciphertext[:-HMAC_SIZE], ciphertext[-HMAC_SIZE:]
+        nonce = body[SESSION_HEADER_SIZE:SESSION_HEADER_SIZE + NONCE_SIZE]
+        encrypted = body[SESSION_HEADER_SIZE + NONCE_SIZE:]
+        assert len(encrypted) % 16 == 0, "Ciphertext must be made of full 16-byte blocks."
+
+        session_key = self._session_key_for(salt)
+        key, hmac_key, iv = self._message_keys(session_key, nonce)
+        expected_hmac = new_hmac(hmac_key, body, 'sha256').digest()
+        assert compare_digest(hmac, expected_hmac), 'Ciphertext corrupted or tampered.'
+
+        return AES(key).decrypt_cbc(encrypted, iv)
+
+
+def parse_session_header(ciphertext):
+    """
+    Checks the session envelope header and returns its (salt, workload).
+    """
+    assert ciphertext[:len(SESSION_MAGIC)] == SESSION_MAGIC, 'Not a session ciphertext.'
+    assert len(ciphertext) >= SESSION_HEADER_SIZE, 'Ciphertext is too short.'
+    version = ciphertext[len(SESSION_MAGIC)]
+    assert version == SESSION_VERSION, 'Unsupported session envelope version {}.'.format(version)
+    offset = len(SESSION_MAGIC) + 1
+    workload = int.from_bytes(ciphertext[offset:offset + 4], 'big')
+    salt = bytes(ciphertext[offset + 4:SESSION_HEADER_SIZE])
+    return salt, workload
+
+
+
+# Streaming envelope: a sequence of frames, each a 4-byte big-endian length
+# followed by one `Session` record. Every record encrypts the chunk index,
+# a final-chunk flag and up to `STREAM_CHUNK_SIZE` bytes of data, so frames
+# cannot be dropped, reordered or cut off at the end without detection.
+STREAM_CHUNK_SIZE = 1 << 20
+STREAM_QUEUE_DEPTH = 4
+STREAM_INDEX_SIZE = 8
+
+_DONE = object()
+
+def _run_pipeline(chunks, transform, write, depth=STREAM_QUEUE_DEPTH):
+    """
+    Runs three overlapped stages: iterating `chunks` on a reader thread,
+    `transform` on a worker thread and `write` in the calling thread. They
+    are connected by queues of at most `depth` items, so memory stays bounded
+    and a slow stage holds back the others. The first exception raised by
+    any stage stops the pipeline and is re-raised here.
+    """
+    read_queue = queue.Queue(depth)
+    write_queue = queue.Queue(depth)
+    stop = threading.Event()
+    errors = []
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def reader():
+        try:
+            for chunk in chunks:
+                if not put(read_queue, chunk):
+                    return
+        except BaseException as e:
+            errors.append(e)
+        put(read_queue, _DONE)
+
+    def worker():
+        try:
+            while True:
+                chunk = get(read_queue)
+                if chunk is _DONE or not put(write_queue, transform(chunk)):
+                    break
+        except BaseException as e:
+            errors.append(e)
+        put(write_queue, _DONE)
+
+    threads = [threading.Thread(target=reader, daemon=True),
+               threading.Thread(target=worker, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            output = get(write_queue)
+            if output is _DONE:
+                break
+            write(output)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _read_exactly(source, size):
+    """ Reads `size` bytes, or fewer only at the end of the input. """
+    data = source.read(size)
+    while data and len(data) < size:
+        more = source.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def plaintext_chunk_steps(chunk_size):
+    """
+    Splits the input into (index, chunk, final) items, at least one. Like
+    `frame_steps`, this is parsing without I/O, shared by the blocking and
+    the asyncio readers: run it with `run_steps`.
+    """
+    index = 0
+    chunk = yield chunk_size
+    while True:
+        following = (yield chunk_size) if len(chunk) == chunk_size else b''
+        yield index, chunk, not following
+        if not following:
+            return
+        index += 1
+        chunk = following
+
+
+def run_steps(steps, read):
+    """
+    Runs a step generator such as `frame_steps` over the blocking
+    `read(size)`, which returns fewer bytes only at the end of the input.
+    The generator yields an int for bytes it needs (and is sent them), or
+    a parsed item, which is yielded from here.
+    """
+    try:
+        step = next(steps)
+        while True:
+            if isinstance(step, int):
+                step = steps.send(read(step))
+            else:
+                yield step
+                step = next(steps)
+    except StopIteration:
+        return
+
+
+def _plaintext_chunks(source, chunk_size):
+    """ Yields (index, chunk, final) for the input, at least one chunk. """
+    return run_steps(plaintext_chunk_steps(chunk_size), lambda size: _read_exactly(source, size))
+
+
+def stream_record_size(chunk_size):
+    """ Length of the largest record in a stream of `chunk_size` chunks. """
+    padded = (STREAM_INDEX_SIZE + 1 + chunk_size) // 16 * 16 + 16
+    return SESSION_HEADER_SIZE + NONCE_SIZE + padded + HMAC_SIZE
+
+
+def frame_length(prefix, max_length):
+    """
+    Checks a frame's 4-byte length prefix and returns the record length.
+    Lengths are not authenticated, so anything over `max_length` is refused
+    before the record is read.
+    """
+    assert len(prefix) == 4, 'Stream truncated.'
+    length = int.from_bytes(prefix, 'big')
+    assert length <= max_length, 'Frame longer than the largest record.'
+    return length
+
+
+def frame_steps(max_length):
+    """
+    Splits a framed stream into its records, see `plaintext_chunk_steps`.
+    """
+    while True:
+        prefix = yield 4
+        if not prefix:
+            return
+        length = frame_length(prefix, max_length)
+        record = yield length
+        assert len(record) == length, 'Stream truncated.'
+        yield record
+
+
+def _frames(source, max_length):
+    """ Yields the records of a framed stream. """
+    return run_steps(frame_steps(max_length), lambda size: _read_exactly(source, size))
+
+
+def encrypt_frame(session, index, chunk, final):
+    """
+    Returns the frame (length prefix and `Session` record) for chunk number
+    `index` of a stream, `final` if it is the last one.
+    """
+    record = session.encrypt(index.to_bytes(STREAM_INDEX_SIZE, 'big') + bytes([final]) + chunk)
+    return len(record).to_bytes(4, 'big') + record
+
+
+def decrypt_frame(session, record):
+    """
+    Verifies and decrypts one frame's record, returning (index, final,
+    chunk). The caller checks that indexes follow each other.
+    """
+    # Every frame must come from the same stream, not just the same password.
+    assert parse_session_header(record) == (session.salt, session.workload), 'Frame from another stream.'
+    plaintext = session.decrypt(record)
+    index = int.from_bytes(plaintext[:STREAM_INDEX_SIZE], 'big')
+    return index, plaintext[STREAM_INDEX_SIZE] == 1, plaintext[STREAM_INDEX_SIZE + 1:]
+
+
+def encrypt_stream(key, source, destination, workload=100000,
+                   chunk_size=STREAM_CHUNK_SIZE, depth=STREAM_QUEUE_DEPTH, progress=None):
+    """
+    Encrypts everything read from the binary file object `source` into
+    `destination`, one `chunk_size` chunk at a time, with reading, encryption
+    and writing overlapped. Memory use is bounded by a few chunks whatever
+    the input size. Keys are derived once, as in a `Session`. `progress`, if
+    given, is called with the number of plaintext bytes done after each
+    chunk. Returns the total number of plaintext bytes.
+    """
+    assert 0 < chunk_size < 1 << 32
+    session = Session(key, workload)
+    done = 0
+
+    def transform(item):
+        index, chunk, final = item
+        return len(chunk), encrypt_frame(session, index, chunk, final)
+
+    def write(item):
+        nonlocal done
+        size, frame = item
+        destination.write(frame)
+        done += size
+        if progress:
+            progress(done)
+
+    _run_pipeline(_plaintext_chunks(source, chunk_size), transform, write, depth)
+    return done
+
+
+def decrypt_stream(key, source, destination, workload=100000, chunk_size=STREAM_CHUNK_SIZE,
+                   depth=STREAM_QUEUE_DEPTH, progress=None):
+    """
+    Decrypts a stream written by `encrypt_stream` from `source` into
+    `destination`, see `encrypt_stream`. `workload` and `chunk_size` must be
+    the ones the stream was written with (or, for chunk_size, larger).
+    Every chunk is verified before it is written; a tampered, reordered,
+    spliced or truncated stream raises an AssertionError, possibly after
+    earlier chunks have been written. Returns the total number of plaintext
+    bytes.
+    """
+    state = {'session': None, 'index': 0, 'final': False}
+    done = 0
+
+    def transform(record):
+        if state['session'] is None:
+            # The header is not authenticated yet, so never stretch the
+            # password with a workload taken from it.
+            salt, header_workload = parse_session_header(record)
+            assert header_workload == workload, 'Unexpected workload {}.'.format(header_workload)
+            state['session'] = Session(key, workload, salt)
+        assert not state['final'], 'Data after the final chunk.'
+        index, state['final'], chunk = decrypt_frame(state['session'], record)
+        assert index == state['index'], 'Chunks out of order.'
+        state['index'] += 1
+        return chunk
+
+    def write(chunk):
+        nonlocal done
+        destination.write(chunk)
+        done += len(chunk)
+        if progress:
+            progress(done)
+
+    _run_pipeline(_frames(source, stream_record_size(chunk_size)), transform, write, depth)
+    assert state['final'], 'Stream truncated.'
+    return done
 
 
 def benchmark():
@@ -518,7 +1601,8 @@ def benchmark():
     for i in range(30000):
         aes.encrypt_block(message)
 
-__all__ = ["encrypt", "decrypt", "AES"]
+__all__ = ["encrypt", "decrypt", "AES", "KeyCache", "enable_key_cache", "disable_key_cache", "Session",
+           "clear_schedule_cache", "encrypt_stream", "decrypt_stream"]
 
 if __name__ == '__main__':
     import sys
@@ -527,9 +1611,21 @@ if __name__ == '__main__':
 
     if len(sys.argv) < 2:
         print('Usage: ./aes.py encrypt "key" "message"')
+        print('       ./aes.py encrypt-stream "key" < input > output')
         print('Running tests...')
         from tests import *
         run()
+    elif len(sys.argv) == 3 and sys.argv[1] in ('encrypt-stream', 'decrypt-stream'):
+        # Constant memory: chunks are read, processed and written as they come.
+        crypt_stream = encrypt_stream if sys.argv[1] == 'encrypt-stream' else decrypt_stream
+        start = time.perf_counter()
+        size = crypt_stream(sys.argv[2], sys.stdin.buffer, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+        elapsed = time.perf_counter() - start
+        print('{}ed {:.1f} MB in {:.2f} s ({:.2f} MB/s)'.format(
+            sys.argv[1].split('-')[0], size / 1e6, elapsed, size / 1e6 / elapsed if elapsed else 0),
+            file=sys.stderr)
+        exit()
     elif len(sys.argv) == 2 and sys.argv[1] == 'benchmark':
         benchmark()
         exit()
@@ -0,0 +1,199 @@
+"""
+asyncio interface that keeps key stretching and encryption off the event loop.
+
+`encrypt` and `decrypt` spend most of their time in 100,000 rounds of PBKDF2
+and a pure-Python cipher pass; called from a coroutine they block every
+other task on the loop for that long. `AsyncAES` runs that work in an
+executor instead: the loop's default thread pool, or any
+`concurrent.futures` executor, such as a `ProcessPoolExecutor` so that the
+cipher does not compete with the loop for the GIL. At most `max_concurrency`
+jobs are handed to the executor at a time; further callers wait their turn
+on the loop without holding a worker.
+
+    crypto = AsyncAES(ProcessPoolExecutor(4), max_concurrency=4)
+    ciphertext = await crypto.encrypt(key, plaintext)
+
+    async for frame in crypto.encrypt_stream(key, reader):
+        writer.write(frame)
+        await writer.drain()
+
+The streaming methods read an `asyncio.StreamReader` (or any async iterator
+of bytes) and produce the framed format of `aes.encrypt_stream`, so either
+side can be synchronous. At most `depth` chunks are read ahead of the
+consumer, so a slow writer holds back reading and memory stays bounded.
+
+With a process pool, each stream chunk is sent to a worker along with the
+stream's `Session`. A pickled session carries the derived session key but
+never the password.
+"""
+
+import asyncio
+import os
+from collections import deque
+
+import aes
+from aes import (Session, encrypt_frame, decrypt_frame, parse_session_header, plaintext_chunk_steps,
+                 frame_steps, stream_record_size, STREAM_CHUNK_SIZE, STREAM_QUEUE_DEPTH)
+
+
+class AsyncAES:
+    """
+    Runs `aes.encrypt`/`aes.decrypt` and stream chunks in `executor` (the
+    loop's default executor if None), with at most `max_concurrency` jobs
+    submitted at once (one per CPU by default; match it to the executor's
+    workers) and `depth` chunks in flight per stream.
+    """
+    def __init__(self, executor=None, max_concurrency=None, depth=STREAM_QUEUE_DEPTH):
+        assert max_concurrency is None or max_concurrency > 0
+        assert depth > 0
+        self.executor = executor
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self.depth = depth
+        self._loop = self._limit = None
+
+    def _semaphore(self):
+        # asyncio primitives belong to one loop, so a new loop gets a new limit.
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop, self._limit = loop, asyncio.Semaphore(self.max_concurrency)
+        return self._limit
+
+    async def run(self, func, *args):
+        """
+        Calls `func(*args)` in the executor once a slot is free and returns
+        its result. With a process pool, `func` and its arguments must be
+        picklable.
+        """
+        async with self._semaphore():
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def encrypt(self, key, plaintext, workload=100000, mode='cbc'):
+        """ Awaitable `aes.encrypt`. """
+        return await self.run(aes.encrypt, key, plaintext, workload, mode)
+
+    async def decrypt(self, key, ciphertext, workload=100000, mode='cbc'):
+        """ Awaitable `aes.decrypt`. """
+        return await self.run(aes.decrypt, key, ciphertext, workload, mode)
+
+    async def _ordered(self, items, func):
+        """
+        Yields func(*item) for every item of the async iterator `items`, in
+        order, with up to `depth` calls running ahead of the consumer.
+        """
+        pending = deque()
+        try:
+            async for item in items:
+                pending.append(asyncio.ensure_future(self.run(func, *item)))
+                if len(pending) >= self.depth:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def encrypt_stream(self, key, source, workload=100000, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Encrypts everything read from `source` (a `StreamReader` or an async
+        iterator of bytes) and yields the frames of an `aes.encrypt_stream`
+        stream, one per `chunk_size` chunk.
+        """
+        assert 0 < chunk_size < 1 << 32
+        session = await self.run(Session, key, workload)
+
+        async def items():
+            async for index, chunk, final in _run_steps(plaintext_chunk_steps(chunk_size), _reader(source)):
+                yield session, index, chunk, final
+
+        async for frame in self._ordered(items(), encrypt_frame):
+            yield frame
+
+    async def decrypt_stream(self, key, source, workload=100000, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Decrypts a stream written by `encrypt_stream` (or `aes.encrypt_stream`)
+        from `source` and yields the plaintext chunks. `workload` and
+        `chunk_size` are as for `aes.decrypt_stream`. Every chunk is verified
+        before it is yielded; a tampered, reordered, spliced or truncated
+        stream raises an AssertionError, possibly after earlier chunks.
+        """
+        frames = _run_steps(frame_steps(stream_record_size(chunk_size)), _reader(source))
+        try:
+            first = await frames.__anext__()
+        except StopAsyncIteration:
+            raise AssertionError('Stream truncated.')
+        # The header is not authenticated yet, so never stretch the password
+        # with a workload taken from it.
+        salt, header_workload = parse_session_header(first)
+        assert header_workload == workload, 'Unexpected workload {}.'.format(header_workload)
+        session = await self.run(Session, key, workload, salt)
+
+        async def items():
+            yield session, first
+            async for record in frames:
+                yield session, record
+
+        expected, final = 0, False
+        async for index, final_chunk, chunk in self._ordered(items(), decrypt_frame):
+            assert not final, 'Data after the final chunk.'
+            assert index == expected, 'Chunks out of order.'
+            expected, final = expected + 1, final_chunk
+            yield chunk
+        assert final, 'Stream truncated.'
+
+
+def _reader(source):
+    """
+    Returns a coroutine function read(size) over `source` that returns
+    `size` bytes, or fewer only at the end of the input.
+    """
+    if hasattr(source, 'readexactly'):
+        async def read(size):
+            try:
+                return await source.readexactly(size)
+            except asyncio.IncompleteReadError as e:
+                return e.partial
+        return read
+
+    iterator = source.__aiter__()
+    buffer = bytearray()
+
+    async def read(size):
+        while len(buffer) < size:
+            try:
+                buffer.extend(await iterator.__anext__())
+            except StopAsyncIteration:
+                break
+        data = bytes(buffer[:size])
+        del buffer[:size]
+        return data
+    return read
+
+
+async def _run_steps(steps, read):
+    """ `aes.run_steps` for a coroutine function `read`. """
+    try:
+        step = next(steps)
+        while True:
+            if isinstance(step, int):
+                step = steps.send(await read(step))
+            else:
+                yield step
+                step = next(steps)
+    except StopIteration:
+        return
+
+
+_default = AsyncAES()
+
+
+async def encrypt(key, plaintext, workload=100000, mode='cbc'):
+    """ `aes.encrypt` in the event loop's default executor. """
+    return await _default.encrypt(key, plaintext, workload, mode)
+
+
+async def decrypt(key, ciphertext, workload=100000, mode='cbc'):
+    """ `aes.decrypt` in the event loop's default executor. """
+    return await _default.decrypt(key, ciphertext, workload, mode)
+
+
+__all__ = ["AsyncAES", "encrypt", "decrypt"]
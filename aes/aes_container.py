@@ -0,0 +1,215 @@
+"""
+Chunked authenticated container for large objects.
+
+`aes.encrypt` produces one HMAC over one CBC stream, so nothing can be
+checked or decrypted before the whole ciphertext has been read. A container
+instead splits the plaintext into fixed-size segments, each encrypted with
+CTR mode and authenticated on its own:
+
+    header = magic + version + workload + segment size + salt + nonce
+    segment k = E_key_aes(chunk k, iv_k) + HMAC(header + k + final + ciphertext)
+
+Keys are stretched from the password with PBKDF2 (once per container) and
+expanded with HKDF bound to the random header nonce. The counter block of
+segment k starts at nonce || k, so segments never share keystream. Every
+tag covers the header, the segment index and whether the segment is the
+last one, so segments cannot be modified, moved, dropped or cut off at the
+end without detection.
+
+Segments are independent, so `encrypt` and `decrypt` spread them over a pool
+of worker processes, and a single segment can be decrypted from a byte range
+of the container. The header is only authenticated along with the segments,
+so `open` takes the expected workload rather than trusting the header's:
+
+    container = Container.open(password, object_bytes[:HEADER_SIZE], workload)
+    start, end, final = container.segment_range(k, object_size)
+    chunk = container.decrypt_segment(k, object_bytes[start:end], final)
+"""
+
+import os
+from hmac import new as new_hmac, compare_digest
+
+from aes import AES, hkdf, stretch_key, SALT_SIZE
+from aes_parallel import WorkerPool
+
+CONTAINER_MAGIC = b'\x89AEC'
+CONTAINER_VERSION = 1
+NONCE_SIZE = 8
+HEADER_SIZE = len(CONTAINER_MAGIC) + 1 + 4 + 4 + SALT_SIZE + NONCE_SIZE
+TAG_SIZE = 32
+KEY_SIZE = 16
+
+# Plaintext bytes per segment. Smaller segments make byte-range reads
+# cheaper, larger ones spend less on tags and per-segment overhead.
+SEGMENT_SIZE = 1 << 16
+
+
+class Container(WorkerPool):
+    """
+    Header and keys of one container. Segments can be encrypted and
+    decrypted individually, in any order. Use `create` for a new container
+    and `open` to read an existing one. `map_segments` runs many segments in
+    a pool of `processes` workers, started on first use and kept until
+    `close`.
+    """
+    def __init__(self, header, session_key, engine='table', processes=None):
+        self.header = bytes(header)
+        self.workload, self.segment_size, self.salt, self.nonce = parse_header(self.header)
+        self.engine = engine
+        self.session_key = session_key
+        self.processes = processes or os.cpu_count() or 1
+
+        keys = hkdf(session_key, self.nonce, self.header, 2 * KEY_SIZE)
+        self._aes = AES(keys[:KEY_SIZE], engine)
+        self._mac = new_hmac(keys[KEY_SIZE:], self.header, 'sha256')
+
+    @classmethod
+    def create(cls, password, workload=100000, segment_size=SEGMENT_SIZE, engine='table', processes=None):
+        """ Starts a new container, with a fresh random salt and nonce. """
+        assert 0 < workload < 1 << 32
+        assert 0 < segment_size < 1 << 32 and segment_size % 16 == 0
+        salt = os.urandom(SALT_SIZE)
+        header = (CONTAINER_MAGIC + bytes([CONTAINER_VERSION]) + workload.to_bytes(4, 'big') +
+                  segment_size.to_bytes(4, 'big') + salt + os.urandom(NONCE_SIZE))
+        return cls(header, stretch_key(password, salt, workload), engine, processes)
+
+    @classmethod
+    def open(cls, password, header, workload=100000, engine='table', processes=None):
+        """
+        Reads an existing container from its header (the first HEADER_SIZE
+        bytes; anything after them is ignored), which must have been
+        written with `workload`.
+        """
+        header = bytes(header[:HEADER_SIZE])
+        header_workload, _, salt, _ = parse_header(header)
+        assert header_workload == workload, 'Unexpected workload {}.'.format(header_workload)
+        return cls(header, stretch_key(password, salt, workload), engine, processes)
+
+    def _pool_initializer(self):
+        return _init_worker, (self.header, self.session_key, self.engine)
+
+    def _iv(self, index):
+        return self.nonce + index.to_bytes(4, 'big') + bytes(4)
+
+    def _tag(self, index, final, ciphertext):
+        mac = self._mac.copy()
+        mac.update(index.to_bytes(8, 'big') + bytes([final]))
+        mac.update(ciphertext)
+        return mac.digest()
+
+    def encrypt_segment(self, index, plaintext, final):
+        """
+        Encrypts chunk `index` of the plaintext (segment_size bytes, or at
+        most that for the final one) and returns the segment.
+        """
+        assert 0 <= index < 1 << 32
+        assert len(plaintext) == self.segment_size or (final and len(plaintext) <= self.segment_size)
+        ciphertext = self._aes.encrypt_ctr(plaintext, self._iv(index))
+        return ciphertext + self._tag(index, final, ciphertext)
+
+    def decrypt_segment(self, index, segment, final):
+        """
+        Verifies and decrypts segment `index`. `final` says whether it is the
+        last segment of the container, see `segment_range`.
+        """
+        assert TAG_SIZE <= len(segment) <= self.segment_size + TAG_SIZE, 'Segment has the wrong size.'
+        ciphertext, tag = bytes(segment[:-TAG_SIZE]), segment[-TAG_SIZE:]
+        assert compare_digest(tag, self._tag(index, final, ciphertext)), 'Segment corrupted or tampered.'
+        return self._aes.decrypt_ctr(ciphertext, self._iv(index))
+
+    def segment_count(self, container_size):
+        """ Number of segments in a container of `container_size` bytes. """
+        body = container_size - HEADER_SIZE
+        assert body >= TAG_SIZE, 'Container is too short.'
+        return -(-body // (self.segment_size + TAG_SIZE))
+
+    def segment_range(self, index, container_size):
+        """
+        Returns (start, end, final): where segment `index` lies in a
+        container of `container_size` bytes, and whether it is the last one.
+        The segment holding plaintext byte n is n // segment_size.
+        """
+        count = self.segment_count(container_size)
+        assert 0 <= index < count, 'No such segment.'
+        start = HEADER_SIZE + index * (self.segment_size + TAG_SIZE)
+        end = min(start + self.segment_size + TAG_SIZE, container_size)
+        assert end - start >= TAG_SIZE, 'Container is truncated.'
+        return start, end, index == count - 1
+
+    def plaintext_size(self, container_size):
+        """ Size of the plaintext stored in a container of `container_size` bytes. """
+        return container_size - HEADER_SIZE - self.segment_count(container_size) * TAG_SIZE
+
+    def map_segments(self, method, items):
+        """
+        Calls `method` ('encrypt_segment' or 'decrypt_segment') on every
+        (index, data, final) item, in the worker pool when there is more
+        than one segment, and returns the results in order.
+        """
+        if self.processes == 1 or len(items) <= 1:
+            return [getattr(self, method)(*item) for item in items]
+        return self._get_pool().starmap(_worker_task, [(method,) + item for item in items])
+
+
+def parse_header(header):
+    """
+    Checks a container header and returns its (workload, segment_size,
+    salt, nonce).
+    """
+    assert len(header) >= HEADER_SIZE, 'Container is too short.'
+    assert header[:len(CONTAINER_MAGIC)] == CONTAINER_MAGIC, 'Not a container.'
+    version = header[len(CONTAINER_MAGIC)]
+    assert version == CONTAINER_VERSION, 'Unsupported container version {}.'.format(version)
+    offset = len(CONTAINER_MAGIC) + 1
+    workload = int.from_bytes(header[offset:offset + 4], 'big')
+    segment_size = int.from_bytes(header[offset + 4:offset + 8], 'big')
+    assert segment_size > 0 and segment_size % 16 == 0, 'Invalid segment size.'
+    salt = bytes(header[offset + 8:offset + 8 + SALT_SIZE])
+    nonce = bytes(header[HEADER_SIZE - NONCE_SIZE:HEADER_SIZE])
+    return workload, segment_size, salt, nonce
+
+
+_worker_container = None
+
+
+def _init_worker(header, session_key, engine):
+    """ Builds the per-process container keys once, when the worker starts. """
+    global _worker_container
+    _worker_container = Container(header, session_key, engine)
+
+
+def _worker_task(method, index, data, final):
+    return getattr(_worker_container, method)(index, data, final)
+
+
+def encrypt(password, plaintext, workload=100000, segment_size=SEGMENT_SIZE,
+            processes=None, engine='table'):
+    """
+    Encrypts `plaintext` into a new container. Segments are encrypted by
+    `processes` worker processes (one per CPU by default).
+    """
+    if isinstance(plaintext, str):
+        plaintext = plaintext.encode('utf-8')
+    starts = range(0, len(plaintext), segment_size) if plaintext else [0]
+    items = [(index, plaintext[start:start + segment_size], index == len(starts) - 1)
+             for index, start in enumerate(starts)]
+    processes = min(processes or os.cpu_count() or 1, len(items))
+    with Container.create(password, workload, segment_size, engine, processes) as container:
+        return container.header + b''.join(container.map_segments('encrypt_segment', items))
+
+
+def decrypt(password, ciphertext, workload=100000, processes=None, engine='table'):
+    """
+    Verifies and decrypts a whole container, see `encrypt`; `workload` must
+    match the one it was written with. Raises an AssertionError if any
+    segment was modified, moved, dropped or truncated.
+    """
+    with Container.open(password, ciphertext, workload, engine, processes) as container:
+        items = []
+        for index in range(container.segment_count(len(ciphertext))):
+            start, end, final = container.segment_range(index, len(ciphertext))
+            items.append((index, ciphertext[start:end], final))
+        return b''.join(container.map_segments('decrypt_segment', items))
+
+
+__all__ = ["Container", "encrypt", "decrypt", "parse_header", "HEADER_SIZE", "SEGMENT_SIZE"]
@@ -0,0 +1,203 @@
+"""
+Seekable, CTR-encrypted files.
+
+In CTR mode the keystream block for byte n is E(iv + n // 16), so any part of
+a file can be read or written without touching what comes before it.
+`CtrFile` wraps a binary file holding CTR ciphertext and behaves like the
+plaintext file: it is an `io.RawIOBase`, so `read`, `readinto`, `write`,
+`seek`, `tell` and `truncate` work at any (unaligned) offset, and it can be
+wrapped in `io.BufferedRandom` or `io.TextIOWrapper`. `pread` and `pwrite`
+access an offset without moving the file position.
+
+    with open_ctr('data.bin', AES(key), iv) as f:
+        f.seek(10 ** 9)
+        record = f.read(4096)
+
+Writing is only safe once per byte. Overwriting a range encrypts the new
+data with the same keystream as the old, so anyone holding both versions
+of the file learns old XOR new, and nothing authenticates the contents.
+Append-only writers are fine; for data that changes in place, use a fresh
+key or IV per version (re-encrypting the file), or `aes_container`.
+"""
+
+import io
+import os
+import threading
+
+from aes import add_counter
+
+# Bytes encrypted at a time when filling a gap or growing the file.
+ZERO_CHUNK = 1 << 20
+
+
+class CtrFile(io.RawIOBase):
+    """
+    Plaintext view of `file`, a binary file object containing data encrypted
+    with `aes.encrypt_ctr(plaintext, iv)`. The file must be seekable. It is
+    closed with this object unless `closefd` is False.
+
+    It is writable if `file` is, but rewriting bytes that were already
+    written reuses their keystream; see the module docstring.
+
+    `pread` and `pwrite` may be called from several threads at once, for
+    disjoint ranges: on an unbuffered OS file (as from `open_ctr`) they use
+    `os.pread`/`os.pwrite`, otherwise they seek and read or write `file`
+    under a lock. Calls that grow the file should not race with each other.
+    `read`, `write` and `seek` share one position, so like any file object
+    they need external locking.
+    """
+    def __init__(self, file, aes, iv, closefd=True):
+        super().__init__()
+        assert len(iv) == 16
+        assert file.seekable(), 'CTR files need random access.'
+        self.raw = file
+        self.aes = aes
+        self.iv = bytes(iv)
+        self.closefd = closefd
+        self._position = 0
+        # Positional I/O on the descriptor bypasses any Python-level buffer,
+        # so it is only used for unbuffered files.
+        use_fd = isinstance(file, io.FileIO) and hasattr(os, 'pread')
+        self._fd = file.fileno() if use_fd else None
+        self._lock = threading.Lock()
+
+    def _crypt(self, data, offset):
+        """ XORs `data` with the keystream starting at byte `offset`. """
+        skip = offset % 16
+        counter = add_counter(self.iv, offset // 16)
+        return self.aes.encrypt_ctr(bytes(skip) + bytes(data), counter)[skip:]
+
+    def _size(self):
+        if self._fd is not None:
+            return os.fstat(self._fd).st_size
+        with self._lock:
+            return self.raw.seek(0, io.SEEK_END)
+
+    def _read_at(self, size, offset):
+        if self._fd is not None:
+            return os.pread(self._fd, size, offset)
+        with self._lock:
+            self.raw.seek(offset)
+            return self.raw.read(size)
+
+    def _write_at(self, data, offset):
+        if self._fd is not None:
+            data = memoryview(data)
+            while data:
+                written = os.pwrite(self._fd, data, offset)
+                data, offset = data[written:], offset + written
+            return
+        with self._lock:
+            self.raw.seek(offset)
+            self.raw.write(data)
+
+    def readable(self):
+        return self.raw.readable()
+
+    def writable(self):
+        return self.raw.writable()
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size()
+        else:
+            assert whence == io.SEEK_SET, 'Invalid whence.'
+        if offset < 0:
+            raise ValueError('Negative seek position {}.'.format(offset))
+        self._position = offset
+        return offset
+
+    def pread(self, size, offset):
+        """
+        Reads up to `size` bytes at `offset` without moving the position.
+        """
+        self._checkClosed()
+        self._checkReadable()
+        ciphertext = self._read_at(size, offset)
+        return self._crypt(ciphertext, offset) if ciphertext else b''
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        data = self.pread(len(view), self._position)
+        view[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def readall(self):
+        data = self.pread(max(self._size() - self._position, 0), self._position)
+        self._position += len(data)
+        return data
+
+    def _fill(self, start, end):
+        """ Writes encrypted zeros from `start` to `end`. """
+        for offset in range(start, end, ZERO_CHUNK):
+            self._write_at(self._crypt(bytes(min(ZERO_CHUNK, end - offset)), offset), offset)
+
+    def pwrite(self, data, offset):
+        """
+        Writes `data` at `offset` without moving the position, and returns
+        the number of bytes written. Writing past the end fills the gap with
+        (encrypted) zero bytes, like a sparse file.
+        """
+        self._checkClosed()
+        self._checkWritable()
+        size = self._size()
+        if offset > size:
+            self._fill(size, offset)
+        data = memoryview(data).cast('B')
+        self._write_at(self._crypt(data, offset), offset)
+        return len(data)
+
+    def write(self, data):
+        written = self.pwrite(data, self._position)
+        self._position += written
+        return written
+
+    def truncate(self, size=None):
+        self._checkClosed()
+        self._checkWritable()
+        size = self._position if size is None else size
+        current = self._size()
+        if size > current:
+            self._fill(current, size)
+        else:
+            with self._lock:
+                self.raw.truncate(size)
+        return size
+
+    def flush(self):
+        if not self.closed:
+            self.raw.flush()
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.flush()
+            finally:
+                super().close()
+                if self.closefd:
+                    self.raw.close()
+
+
+def open_ctr(path, aes, iv, mode='rb'):
+    """
+    Opens the CTR-encrypted file at `path` as a `CtrFile`. `mode` is 'rb'
+    (the default), 'r+b' or 'w+b'; 'wb' is opened as 'w+b', so the file can
+    be read back. Never overwrite data in place under the same key and IV.
+    """
+    mode = {'rb': 'rb', 'r+b': 'r+b', 'rb+': 'r+b', 'wb': 'w+b', 'w+b': 'w+b', 'wb+': 'w+b'}.get(mode)
+    assert mode is not None, "Mode must be 'rb', 'r+b' or 'w+b'."
+    return CtrFile(open(path, mode, buffering=0), aes, iv)
+
+
+__all__ = ["CtrFile", "open_ctr"]
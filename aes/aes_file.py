@@ -0,0 +1,122 @@
+"""
+Memory-mapped encryption and decryption of whole files.
+
+Instead of reading a file into memory, the source is `mmap`ed, the
+destination is created at its final size and `mmap`ed too, and the data goes
+through an `aes_stream` cipher one large window at a time. Resident memory is
+bounded by the window size no matter how large the file is.
+
+The length-preserving modes (CTR, OFB, CFB) can also work in place, by
+leaving out the destination:
+
+    encrypt_file(AES(key), 'ctr', iv, 'backup.tar')
+"""
+
+import contextlib
+import mmap
+import os
+
+from aes_stream import encryptor, decryptor
+
+# Bytes handed to the cipher at a time. A multiple of both the block size
+# and the mmap allocation granularity, so windows stay page aligned.
+WINDOW_SIZE = 1 << 22
+
+LENGTH_PRESERVING_MODES = ('cfb', 'ofb', 'ctr')
+PADDED_MODES = ('cbc', 'pcbc')
+
+
+def _same_file(source, destination):
+    return destination is None or (
+        os.path.exists(destination) and os.path.samefile(source, destination))
+
+
+def _crypt_in_place(cipher, path, window, progress):
+    size = os.path.getsize(path)
+    if size:
+        with open(path, 'r+b') as f, mmap.mmap(f.fileno(), 0) as data:
+            for offset in range(0, size, window):
+                chunk = data[offset:offset+window]
+                data[offset:offset+len(chunk)] = cipher.update(chunk)
+                if progress:
+                    progress(offset + len(chunk), size)
+            data.flush()
+    cipher.finalize()
+    return size
+
+
+def _crypt_copy(cipher, src, dst, output_size, window, progress):
+    """ Runs the open `src` file through `cipher` into the open `dst`. """
+    size = os.fstat(src.fileno()).st_size
+    written = 0
+    dst.truncate(output_size)
+    src_map = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+    dst_map = mmap.mmap(dst.fileno(), 0) if output_size else None
+    try:
+        for offset in range(0, size, window):
+            output = cipher.update(src_map[offset:offset+window])
+            dst_map[written:written+len(output)] = output
+            written += len(output)
+            if progress:
+                progress(min(offset + window, size), size)
+        output = cipher.finalize()
+        if output:
+            dst_map[written:written+len(output)] = output
+            written += len(output)
+        if dst_map is not None:
+            dst_map.flush()
+    finally:
+        if src_map is not None:
+            src_map.close()
+        if dst_map is not None:
+            dst_map.close()
+    # Decryption only learns the real size once the padding is removed.
+    if written != output_size:
+        dst.truncate(written)
+    return written
+
+
+def _crypt_file(cipher, mode, source, destination, output_size, window, progress):
+    assert window > 0 and window % 16 == 0 and window % mmap.ALLOCATIONGRANULARITY == 0
+    if _same_file(source, destination):
+        assert mode in LENGTH_PRESERVING_MODES, 'Only CTR, OFB and CFB can run in place.'
+        return _crypt_in_place(cipher, source, window, progress)
+
+    with open(source, 'rb') as src:
+        dst = open(destination, 'w+b')
+        try:
+            with dst:
+                return _crypt_copy(cipher, src, dst, output_size, window, progress)
+        except Exception:
+            # Do not leave a half-written output behind. Only reached once
+            # this call has created or truncated the file, and never masks
+            # the original error.
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(destination)
+            raise
+
+
+def encrypt_file(aes, mode, iv, source, destination=None, window=WINDOW_SIZE, progress=None):
+    """
+    Encrypts the file at `source` with the `AES` object in `mode`, writing
+    to `destination`, or in place when it is None (CTR, OFB and CFB only).
+    `progress`, if given, is called as progress(bytes_done, total_bytes)
+    after every window. Returns the number of bytes written.
+    """
+    size = os.path.getsize(source)
+    output_size = size + 16 - size % 16 if mode in PADDED_MODES else size
+    return _crypt_file(encryptor(aes, mode, iv), mode, source, destination,
+                       output_size, window, progress)
+
+
+def decrypt_file(aes, mode, iv, source, destination=None, window=WINDOW_SIZE, progress=None):
+    """
+    Decrypts the file at `source`, see `encrypt_file`. Returns the number of
+    bytes written.
+    """
+    size = os.path.getsize(source)
+    return _crypt_file(decryptor(aes, mode, iv), mode, source, destination,
+                       size, window, progress)
+
+
+__all__ = ["encrypt_file", "decrypt_file"]
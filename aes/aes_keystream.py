@@ -0,0 +1,155 @@
+"""
+Keystream precomputed ahead of demand, for CTR and OFB.
+
+In CTR and OFB modes the keystream depends only on the key and IV, never on
+the data. `KeystreamBuffer` runs a background thread that keeps a ring
+buffer filled with the upcoming keystream, so encrypting a message that
+arrives later is a single XOR against bytes that are already there instead
+of a block-by-block cipher pass while the message waits.
+
+    with KeystreamBuffer(AES(key), 'ctr', iv) as keystream:
+        for message in messages:          # consecutive parts of one stream
+            send(keystream.crypt(message))
+
+Messages are consecutive pieces of one stream: the output is the same as
+`encrypt_ctr` (or `encrypt_ofb`) on all of them concatenated. `stats()`
+reports the buffer depth and how often, and for how long, callers had to
+wait for keystream (underruns).
+"""
+
+import threading
+import time
+from collections import namedtuple
+
+from aes import add_counter, xor_long
+
+# Bytes of keystream kept ready by default, and produced per cipher call.
+BUFFER_SIZE = 1 << 20
+CHUNK_SIZE = 1 << 14
+
+KeystreamStats = namedtuple('KeystreamStats', 'depth capacity produced consumed underruns stall_seconds')
+
+
+class KeystreamBuffer:
+    """
+    Ring buffer of CTR or OFB keystream for one (key, IV), filled by a
+    background thread. `crypt` XORs data with the next keystream bytes, so
+    encryption and decryption are the same call.
+    """
+    def __init__(self, aes, mode, iv, capacity=BUFFER_SIZE, chunk_size=CHUNK_SIZE):
+        assert mode in ('ctr', 'ofb')
+        assert len(iv) == 16
+        assert chunk_size > 0 and chunk_size % 16 == 0 and capacity >= chunk_size
+        self.aes = aes
+        self.mode = mode
+        self.capacity = capacity
+        self.chunk_size = chunk_size
+        self._next_iv = bytes(iv)
+        self._ring = bytearray(capacity)
+        self._start = 0
+        self._depth = 0
+        self._produced = self._consumed = self._underruns = 0
+        self._stall_seconds = 0.0
+        self._error = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _generate(self):
+        """ Computes the next chunk of keystream. Only the producer calls this. """
+        zeros = bytes(self.chunk_size)
+        if self.mode == 'ctr':
+            chunk = self.aes.encrypt_ctr(zeros, self._next_iv)
+            self._next_iv = add_counter(self._next_iv, self.chunk_size // 16)
+        else:
+            chunk = self.aes.encrypt_ofb(zeros, self._next_iv)
+            self._next_iv = chunk[-16:]
+        return chunk
+
+    def _produce(self):
+        try:
+            while True:
+                with self._condition:
+                    while not self._closed and self.capacity - self._depth < self.chunk_size:
+                        self._condition.wait()
+                    if self._closed:
+                        return
+                # The cipher runs outside the lock, so consumers are never
+                # held up by it while keystream is available.
+                chunk = self._generate()
+                with self._condition:
+                    end = (self._start + self._depth) % self.capacity
+                    first = min(len(chunk), self.capacity - end)
+                    self._ring[end:end + first] = chunk[:first]
+                    self._ring[:len(chunk) - first] = chunk[first:]
+                    self._depth += len(chunk)
+                    self._produced += len(chunk)
+                    self._condition.notify_all()
+        except BaseException as e:
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+
+    def _take(self, size, out):
+        """ Appends up to `size` ready keystream bytes to `out`, waiting if none are. """
+        with self._condition:
+            if not self._depth:
+                self._underruns += 1
+                started = time.perf_counter()
+                while not self._depth and self._error is None and not self._closed:
+                    self._condition.wait()
+                self._stall_seconds += time.perf_counter() - started
+            if self._error is not None:
+                raise self._error
+            assert not self._closed, 'Keystream buffer closed.'
+            size = min(size, self._depth)
+            first = min(size, self.capacity - self._start)
+            out += self._ring[self._start:self._start + first]
+            out += self._ring[:size - first]
+            self._start = (self._start + size) % self.capacity
+            self._depth -= size
+            self._consumed += size
+            self._condition.notify_all()
+
+    def keystream(self, size):
+        """ Returns the next `size` bytes of keystream. """
+        out = bytearray()
+        while len(out) < size:
+            self._take(size - len(out), out)
+        return bytes(out)
+
+    def crypt(self, data):
+        """
+        Encrypts or decrypts `data`, the next part of the stream, by XORing
+        it with the next len(data) keystream bytes.
+        """
+        return xor_long(data, self.keystream(len(data))) if data else b''
+
+    @property
+    def depth(self):
+        """ Keystream bytes ready to use right now. """
+        return self._depth
+
+    def stats(self):
+        """ Returns buffer depth and underrun statistics. """
+        with self._condition:
+            return KeystreamStats(self._depth, self.capacity, self._produced, self._consumed,
+                                  self._underruns, self._stall_seconds)
+
+    def close(self):
+        """ Stops the background thread and drops the buffered keystream. """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._ring[:] = bytes(self.capacity)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+__all__ = ["KeystreamBuffer", "KeystreamStats"]
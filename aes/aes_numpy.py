@@ -0,0 +1,172 @@
+"""
+Vectorized AES rounds with NumPy, used by `AES(key, engine='numpy')`.
+
+N independent blocks are held as an (N, 16) uint8 array and every round step
+is applied to all of them at once: SubBytes is a table gather, ShiftRows a
+fixed column permutation, MixColumns a handful of XORs with an `xtime` table
+and AddRoundKey a broadcast XOR. This only helps modes where blocks do not
+depend on each other: ECB, CTR, and CBC/CFB decryption.
+"""
+
+import numpy as np
+
+from aes import s_box, inv_s_box, xtime, mul_9, mul_11, mul_13, mul_14
+
+S_BOX = np.array(s_box, dtype=np.uint8)
+INV_S_BOX = np.array(inv_s_box, dtype=np.uint8)
+XTIME = np.array([xtime(a) for a in range(256)], dtype=np.uint8)
+MUL_9, MUL_11, MUL_13, MUL_14 = (np.array(table, dtype=np.uint8)
+                                 for table in (mul_9, mul_11, mul_13, mul_14))
+
+# Byte i of a block is row i % 4 of column i // 4. ShiftRows moves row r
+# left by r columns, so output byte (r, c) comes from input byte (r, c + r).
+SHIFT_ROWS = np.array([r + 4 * ((c + r) % 4) for c in range(4) for r in range(4)])
+INV_SHIFT_ROWS = np.array([r + 4 * ((c - r) % 4) for c in range(4) for r in range(4)])
+
+# Number of blocks processed per batch, to bound temporary memory (1 MiB).
+CHUNK_BLOCKS = 65536
+
+
+def mix_columns(state):
+    """ MixColumns on an (N, 16) state, see Sec 4.1.2 in The Design of Rijndael. """
+    s = state.reshape(-1, 4, 4)
+    a0, a1, a2, a3 = s[:, :, 0], s[:, :, 1], s[:, :, 2], s[:, :, 3]
+    t = a0 ^ a1 ^ a2 ^ a3
+    out = np.empty_like(s)
+    out[:, :, 0] = a0 ^ t ^ XTIME[a0 ^ a1]
+    out[:, :, 1] = a1 ^ t ^ XTIME[a1 ^ a2]
+    out[:, :, 2] = a2 ^ t ^ XTIME[a2 ^ a3]
+    out[:, :, 3] = a3 ^ t ^ XTIME[a3 ^ a0]
+    return out.reshape(-1, 16)
+
+
+def inv_mix_columns(state):
+    """ InvMixColumns on an (N, 16) state, in one pass with multiplication tables. """
+    s = state.reshape(-1, 4, 4)
+    a0, a1, a2, a3 = s[:, :, 0], s[:, :, 1], s[:, :, 2], s[:, :, 3]
+    out = np.empty_like(s)
+    out[:, :, 0] = MUL_14[a0] ^ MUL_11[a1] ^ MUL_13[a2] ^ MUL_9[a3]
+    out[:, :, 1] = MUL_9[a0] ^ MUL_14[a1] ^ MUL_11[a2] ^ MUL_13[a3]
+    out[:, :, 2] = MUL_13[a0] ^ MUL_9[a1] ^ MUL_14[a2] ^ MUL_11[a3]
+    out[:, :, 3] = MUL_11[a0] ^ MUL_13[a1] ^ MUL_9[a2] ^ MUL_14[a3]
+    return out.reshape(-1, 16)
+
+
+def counter_blocks(iv, first, count):
+    """
+    Returns `count` CTR input blocks as an (N, 16) array, starting at the
+    128-bit big-endian counter `iv` + `first`.
+    """
+    start = int.from_bytes(iv, 'big') + first
+    high = np.full(count, (start >> 64) & 0xFFFFFFFFFFFFFFFF, dtype=np.uint64)
+    low_start = np.uint64(start & 0xFFFFFFFFFFFFFFFF)
+    low = low_start + np.arange(count, dtype=np.uint64)
+    # Carry into the high half wherever the low half wrapped around.
+    high += (low < low_start).astype(np.uint64)
+    counters = np.empty((count, 2), dtype='>u8')
+    counters[:, 0] = high
+    counters[:, 1] = low
+    return counters.view(np.uint8).reshape(count, 16)
+
+
+class BatchEngine:
+    """
+    Encrypts and decrypts many independent blocks at once, for the round key
+    matrices of an `aes.KeySchedule` (encryption and equivalent inverse).
+    """
+    def __init__(self, key_matrices, dec_key_matrices):
+        pack = lambda matrices: np.array(
+            [[b for column in matrix for b in column] for matrix in matrices],
+            dtype=np.uint8)
+        self.round_keys = pack(key_matrices)
+        self.dec_round_keys = pack(dec_key_matrices)
+        self.n_rounds = len(key_matrices) - 1
+
+    def encrypt_blocks(self, state):
+        """
+        Encrypts an (N, 16) uint8 array of blocks, returning a new array.
+        """
+        rk = self.round_keys
+        state = state ^ rk[0]
+        for i in range(1, self.n_rounds):
+            state = mix_columns(S_BOX[state][:, SHIFT_ROWS]) ^ rk[i]
+        return S_BOX[state][:, SHIFT_ROWS] ^ rk[self.n_rounds]
+
+    def decrypt_blocks(self, state):
+        """
+        Decrypts an (N, 16) uint8 array of blocks, returning a new array.
+        """
+        rk = self.dec_round_keys
+        state = state ^ rk[0]
+        for i in range(1, self.n_rounds):
+            state = inv_mix_columns(INV_S_BOX[state][:, INV_SHIFT_ROWS]) ^ rk[i]
+        return INV_S_BOX[state][:, INV_SHIFT_ROWS] ^ rk[self.n_rounds]
+
+    def _blocks(self, data):
+        """ Views full-block `data` as an (N, 16) array without copying. """
+        return np.frombuffer(data, dtype=np.uint8).reshape(-1, 16)
+
+    def encrypt_ecb(self, plaintext):
+        """ Encrypts a whole number of blocks, returning bytes. """
+        blocks = self._blocks(plaintext)
+        out = np.empty_like(blocks)
+        for i in range(0, len(blocks), CHUNK_BLOCKS):
+            out[i:i+CHUNK_BLOCKS] = self.encrypt_blocks(blocks[i:i+CHUNK_BLOCKS])
+        return out.tobytes()
+
+    def decrypt_ecb(self, ciphertext):
+        """ Decrypts a whole number of blocks, returning bytes. """
+        blocks = self._blocks(ciphertext)
+        out = np.empty_like(blocks)
+        for i in range(0, len(blocks), CHUNK_BLOCKS):
+            out[i:i+CHUNK_BLOCKS] = self.decrypt_blocks(blocks[i:i+CHUNK_BLOCKS])
+        return out.tobytes()
+
+    def crypt_ctr(self, data, iv):
+        """
+        XORs `data` with the CTR keystream starting at counter `iv`. The
+        last block may be partial.
+        """
+        data = np.frombuffer(data, dtype=np.uint8)
+        out = np.empty_like(data)
+        chunk_bytes = 16 * CHUNK_BLOCKS
+        for offset in range(0, len(data), chunk_bytes):
+            piece = data[offset:offset+chunk_bytes]
+            n_blocks = (len(piece) + 15) // 16
+            keystream = self.encrypt_blocks(counter_blocks(iv, offset // 16, n_blocks))
+            out[offset:offset+len(piece)] = piece ^ keystream.reshape(-1)[:len(piece)]
+        return out.tobytes()
+
+    def decrypt_cbc(self, ciphertext, iv):
+        """
+        CBC decryption without unpadding: each plaintext block is the
+        decrypted ciphertext block XOR the previous ciphertext block.
+        """
+        blocks = self._blocks(ciphertext)
+        out = np.empty_like(blocks)
+        previous = np.frombuffer(iv, dtype=np.uint8)
+        for i in range(0, len(blocks), CHUNK_BLOCKS):
+            chunk = blocks[i:i+CHUNK_BLOCKS]
+            chained = np.vstack((previous, chunk[:-1]))
+            out[i:i+CHUNK_BLOCKS] = self.decrypt_blocks(chunk) ^ chained
+            previous = chunk[-1]
+        return out.tobytes()
+
+    def decrypt_cfb(self, ciphertext, iv):
+        """
+        CFB decryption: each plaintext block is the ciphertext block XOR the
+        encrypted previous ciphertext block. The last block may be partial.
+        """
+        data = np.frombuffer(ciphertext, dtype=np.uint8)
+        full = len(data) // 16
+        # Keystream inputs are the IV followed by every full ciphertext
+        # block except the last one needed.
+        n_blocks = (len(data) + 15) // 16
+        inputs = np.vstack((np.frombuffer(iv, dtype=np.uint8),
+                            data[:16 * full].reshape(-1, 16)))[:n_blocks]
+        out = np.empty_like(data)
+        for i in range(0, n_blocks, CHUNK_BLOCKS):
+            keystream = self.encrypt_blocks(inputs[i:i+CHUNK_BLOCKS]).reshape(-1)
+            piece = data[16 * i:16 * (i + CHUNK_BLOCKS)]
+            out[16 * i:16 * i + len(piece)] = piece ^ keystream[:len(piece)]
+        return out.tobytes()
@@ -0,0 +1,153 @@
+"""
+Process-pool parallel AES for large payloads.
+
+A single Python process only uses one core, but CTR mode and CBC decryption
+have no dependency between blocks. `ParallelAES` keeps a persistent pool of
+worker processes, each holding an `AES` object (and so an expanded key
+schedule) built once when the worker starts. A message is copied once into a
+`multiprocessing.shared_memory` block, split into segments, and every worker
+overwrites its own segment in place, so no payload data is pickled.
+
+    with ParallelAES(key) as cipher:
+        ciphertext = cipher.encrypt_ctr(big_message, iv)
+"""
+
+import os
+import multiprocessing
+from multiprocessing import shared_memory
+
+from aes import AES, add_counter, unpad
+
+# Segments handed to each worker, in bytes. Must be a multiple of 16.
+SEGMENT_SIZE = 1 << 20
+
+
+class WorkerPool:
+    """
+    Mixin for classes that run work in a pool of `self.processes` worker
+    processes, started on first use and kept until `close`. Subclasses
+    return the pool's (initializer, initargs) from `_pool_initializer`.
+    """
+    _pool = None
+
+    def _pool_initializer(self):
+        raise NotImplementedError
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes, *self._pool_initializer())
+        return self._pool
+
+    def close(self):
+        """ Shuts the worker pool down. """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_worker_aes = None
+
+
+def _init_worker(master_key, engine):
+    """ Builds the per-process cipher once, when the worker starts. """
+    global _worker_aes
+    _worker_aes = AES(master_key, engine)
+
+
+def _process_segment(aes, kind, data, arg, out=None):
+    """
+    Runs one segment, into `out` if given (which may be `data` itself). For
+    CTR `arg` is the counter block of the segment's first block; for CBC it
+    is the ciphertext block preceding the segment.
+    """
+    if kind == 'ctr':
+        return aes.encrypt_ctr(data, arg, out)
+    # CBC decrypt without unpadding: decrypt(block) XOR previous block.
+    return aes.decrypt_cbc_blocks(data, arg, out)
+
+
+def _worker_task(name, kind, start, end, arg):
+    """ Processes buffer[start:end] of the named shared memory in place. """
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        segment = shm.buf[start:end]
+        try:
+            _process_segment(_worker_aes, kind, segment, arg, out=segment)
+        finally:
+            segment.release()
+    finally:
+        shm.close()
+
+
+class ParallelAES(WorkerPool):
+    """
+    CTR encryption/decryption and CBC decryption spread over a persistent
+    pool of worker processes. Output is identical to `AES`. Messages smaller
+    than one segment are processed in the calling process.
+    """
+    def __init__(self, master_key, processes=None, engine='table', segment_size=SEGMENT_SIZE):
+        assert len(master_key) in AES.rounds_by_key_size
+        assert segment_size > 0 and segment_size % 16 == 0
+        self.master_key = bytes(master_key)
+        self.engine = engine
+        self.processes = processes or os.cpu_count() or 1
+        self.segment_size = segment_size
+        self._aes = AES(self.master_key, engine)
+
+    def _pool_initializer(self):
+        return _init_worker, (self.master_key, self.engine)
+
+    def _run(self, kind, data, iv):
+        assert len(iv) == 16
+        size = len(data)
+        if size <= self.segment_size or self.processes == 1:
+            return _process_segment(self._aes, kind, bytes(data), iv)
+
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        try:
+            shm.buf[:size] = data
+            tasks = []
+            for start in range(0, size, self.segment_size):
+                end = min(start + self.segment_size, size)
+                if kind == 'ctr':
+                    arg = add_counter(iv, start // 16)
+                else:
+                    # Read the chaining block now: another worker may
+                    # overwrite it with plaintext before this one starts.
+                    arg = bytes(data[start-16:start]) if start else bytes(iv)
+                tasks.append((shm.name, kind, start, end, arg))
+            self._get_pool().starmap(_worker_task, tasks)
+            return bytes(shm.buf[:size])
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def encrypt_ctr(self, plaintext, iv):
+        """
+        Encrypts `plaintext` using CTR mode with the given nounce/IV.
+        """
+        return self._run('ctr', plaintext, iv)
+
+    def decrypt_ctr(self, ciphertext, iv):
+        """
+        Decrypts `ciphertext` using CTR mode with the given nounce/IV.
+        """
+        return self._run('ctr', ciphertext, iv)
+
+    def decrypt_cbc(self, ciphertext, iv):
+        """
+        Decrypts `ciphertext` using CBC mode and PKCS#7 padding, with the given
+        initialization vector (iv).
+        """
+        assert len(ciphertext) % 16 == 0
+        return unpad(self._run('cbc', ciphertext, iv))
+
+
+__all__ = ["ParallelAES"]
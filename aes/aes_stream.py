@@ -0,0 +1,294 @@
+"""
+Incremental cipher objects for the AES block modes.
+
+The mode methods on `AES` take a whole message at once. The objects here
+accept it in arbitrary-sized chunks through `update()`, return the output
+available so far, and only ever buffer the incomplete tail block.
+`finalize()` applies PKCS#7 padding (CBC, PCBC encryption) or checks and
+removes it (decryption), and returns the last bytes.
+
+    cipher = encryptor(AES(key), 'cbc', iv)
+    for chunk in chunks:
+        out.write(cipher.update(chunk))
+    out.write(cipher.finalize())
+
+Whole blocks are passed to the `AES` mode methods where possible, so a fast
+engine (or `aes_native.AES`) speeds these up too.
+"""
+
+from aes import add_counter, pad, unpad, xor_long
+
+
+class StreamCipher:
+    """
+    Base class: tracks buffered input and refuses use after `finalize`.
+    """
+    def __init__(self, aes, iv):
+        assert len(iv) == 16
+        self.aes = aes
+        self._pending = b''
+        self._finalized = False
+
+    def update(self, data):
+        """
+        Processes the next chunk of input, returning the output it completes.
+        """
+        assert not self._finalized, 'Cipher already finalized.'
+        return self._update(bytes(data))
+
+    def finalize(self):
+        """
+        Processes the buffered tail and returns the last output bytes.
+        """
+        assert not self._finalized, 'Cipher already finalized.'
+        self._finalized = True
+        return self._finalize()
+
+    def _take_blocks(self, data, keep_last=False):
+        """
+        Appends `data` to the buffer and returns the whole blocks ready for
+        processing. With `keep_last`, a complete final block stays buffered
+        (decryption needs it at finalize time to remove the padding).
+        """
+        data = self._pending + data
+        n = len(data) - len(data) % 16
+        if keep_last and n == len(data):
+            n = max(n - 16, 0)
+        self._pending = data[n:]
+        return data[:n]
+
+
+class CbcEncryptor(StreamCipher):
+    """ Incremental CBC encryption with PKCS#7 padding. """
+    def __init__(self, aes, iv):
+        super().__init__(aes, iv)
+        self._previous = bytes(iv)
+
+    def _encrypt_blocks(self, blocks):
+        out = []
+        previous = self._previous
+        for i in range(0, len(blocks), 16):
+            previous = self.aes.encrypt_block(xor_long(blocks[i:i+16], previous))
+            out.append(previous)
+        self._previous = previous
+        return b''.join(out)
+
+    def _update(self, data):
+        return self._encrypt_blocks(self._take_blocks(data))
+
+    def _finalize(self):
+        return self._encrypt_blocks(pad(self._pending))
+
+
+class CbcDecryptor(StreamCipher):
+    """ Incremental CBC decryption, removing PKCS#7 padding at the end. """
+    def __init__(self, aes, iv):
+        super().__init__(aes, iv)
+        self._previous = bytes(iv)
+
+    def _decrypt_blocks(self, blocks):
+        if not blocks:
+            return b''
+        # Blocks are independent once the ciphertext is known, so decrypt
+        # them in one call and XOR with the shifted ciphertext.
+        plaintext = xor_long(self.aes.decrypt_ecb(blocks), self._previous + blocks[:-16])
+        self._previous = blocks[-16:]
+        return plaintext
+
+    def _update(self, data):
+        return self._decrypt_blocks(self._take_blocks(data, keep_last=True))
+
+    def _finalize(self):
+        assert len(self._pending) == 16, 'Ciphertext must be made of full 16-byte blocks.'
+        return unpad(self._decrypt_blocks(self._pending))
+
+
+class PcbcEncryptor(StreamCipher):
+    """ Incremental PCBC encryption with PKCS#7 padding. """
+    def __init__(self, aes, iv):
+        super().__init__(aes, iv)
+        # prev_ciphertext XOR prev_plaintext, with prev_plaintext = 0 at first.
+        self._mask = bytes(iv)
+
+    def _encrypt_blocks(self, blocks):
+        out = []
+        mask = self._mask
+        for i in range(0, len(blocks), 16):
+            block = blocks[i:i+16]
+            ciphertext_block = self.aes.encrypt_block(xor_long(block, mask))
+            mask = xor_long(ciphertext_block, block)
+            out.append(ciphertext_block)
+        self._mask = mask
+        return b''.join(out)
+
+    def _update(self, data):
+        return self._encrypt_blocks(self._take_blocks(data))
+
+    def _finalize(self):
+        return self._encrypt_blocks(pad(self._pending))
+
+
+class PcbcDecryptor(StreamCipher):
+    """ Incremental PCBC decryption, removing PKCS#7 padding at the end. """
+    def __init__(self, aes, iv):
+        super().__init__(aes, iv)
+        self._mask = bytes(iv)
+
+    def _decrypt_blocks(self, blocks):
+        out = []
+        mask = self._mask
+        for i in range(0, len(blocks), 16):
+            block = blocks[i:i+16]
+            plaintext_block = xor_long(self.aes.decrypt_block(block), mask)
+            mask = xor_long(block, plaintext_block)
+            out.append(plaintext_block)
+        self._mask = mask
+        return b''.join(out)
+
+    def _update(self, data):
+        return self._decrypt_blocks(self._take_blocks(data, keep_last=True))
+
+    def _finalize(self):
+        assert len(self._pending) == 16, 'Ciphertext must be made of full 16-byte blocks.'
+        return unpad(self._decrypt_blocks(self._pending))
+
+
+class KeystreamCipher(StreamCipher):
+    """
+    Base for the stream modes (CFB, OFB, CTR). Output is produced for every
+    input byte immediately: whole blocks go through the `AES` mode method,
+    and a partial block uses a keystream block kept until it is used up.
+    """
+    def __init__(self, aes, iv):
+        super().__init__(aes, iv)
+        self._keystream = b''
+
+    def _consume(self, data):
+        """ XORs `data` with the start of the current keystream block. """
+        n = len(data)
+        output = xor_long(data, self._keystream[:n])
+        self._keystream = self._keystream[n:]
+        return output
+
+    def _update(self, data):
+        out = []
+        if self._keystream:
+            n = min(len(data), len(self._keystream))
+            out.append(self._consume(data[:n]))
+            data = data[n:]
+
+        n = len(data) - len(data) % 16
+        if n:
+            out.append(self._bulk(data[:n]))
+
+        if len(data) > n:
+            self._keystream = self._next_keystream()
+            out.append(self._consume(data[n:]))
+        return b''.join(out)
+
+    def _finalize(self):
+        return b''
+
+
+class CtrCipher(KeystreamCipher):
+    """ Incremental CTR mode. Encryption and decryption are the same. """
+    def __init__(self, aes, iv):
+        super().__init__(aes, iv)
+        self._counter = bytes(iv)
+
+    def _bulk(self, blocks):
+        output = self.aes.encrypt_ctr(blocks, self._counter)
+        self._counter = add_counter(self._counter, len(blocks) // 16)
+        return output
+
+    def _next_keystream(self):
+        keystream = self.aes.encrypt_block(self._counter)
+        self._counter = add_counter(self._counter, 1)
+        return keystream
+
+
+class OfbCipher(KeystreamCipher):
+    """ Incremental OFB mode. Encryption and decryption are the same. """
+    def __init__(self, aes, iv):
+        super().__init__(aes, iv)
+        self._previous = bytes(iv)
+
+    def _bulk(self, blocks):
+        output = self.aes.encrypt_ofb(blocks, self._previous)
+        # The last keystream block is the last output XOR the last input.
+        self._previous = xor_long(output[-16:], blocks[-16:])
+        return output
+
+    def _next_keystream(self):
+        self._previous = self.aes.encrypt_block(self._previous)
+        return self._previous
+
+
+class CfbEncryptor(KeystreamCipher):
+    """ Incremental CFB encryption. """
+    def __init__(self, aes, iv):
+        super().__init__(aes, iv)
+        self._previous = bytes(iv)
+        self._feedback = b''
+
+    def _bulk(self, blocks):
+        output = self.aes.encrypt_cfb(blocks, self._previous)
+        self._previous = output[-16:]
+        return output
+
+    def _next_keystream(self):
+        self._feedback = b''
+        return self.aes.encrypt_block(self._previous)
+
+    def _collect(self, ciphertext):
+        """ Gathers the ciphertext of a partial block for the next feedback. """
+        self._feedback += ciphertext
+        if len(self._feedback) == 16:
+            self._previous = self._feedback
+
+    def _consume(self, data):
+        output = super()._consume(data)
+        self._collect(output)
+        return output
+
+
+class CfbDecryptor(CfbEncryptor):
+    """ Incremental CFB decryption. """
+    def _bulk(self, blocks):
+        output = self.aes.decrypt_cfb(blocks, self._previous)
+        self._previous = blocks[-16:]
+        return output
+
+    def _consume(self, data):
+        output = KeystreamCipher._consume(self, data)
+        self._collect(data)
+        return output
+
+
+MODES = {
+    'cbc': (CbcEncryptor, CbcDecryptor),
+    'pcbc': (PcbcEncryptor, PcbcDecryptor),
+    'cfb': (CfbEncryptor, CfbDecryptor),
+    'ofb': (OfbCipher, OfbCipher),
+    'ctr': (CtrCipher, CtrCipher),
+}
+
+
+def encryptor(aes, mode, iv):
+    """
+    Returns an incremental encryption object for `mode` ('cbc', 'pcbc',
+    'cfb', 'ofb' or 'ctr') using the `AES` object and initialization vector.
+    """
+    assert mode in MODES
+    return MODES[mode][0](aes, iv)
+
+
+def decryptor(aes, mode, iv):
+    """
+    Returns an incremental decryption object for `mode`, see `encryptor`.
+    """
+    assert mode in MODES
+    return MODES[mode][1](aes, iv)
+
+
+__all__ = ["encryptor", "decryptor", "StreamCipher"]
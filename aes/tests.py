@@ -1,5 +1,31 @@
+import asyncio
+import io
+import mmap
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
-from aes import AES, encrypt, decrypt
+from aes import AES, encrypt, decrypt, get_key_iv, KeyCache, enable_key_cache, disable_key_cache, Session
+from aes import encrypt_stream, decrypt_stream
+import aes as aes_module
+from aes_parallel import ParallelAES
+from aes_stream import encryptor, decryptor
+from aes_file import encrypt_file, decrypt_file
+import aes_container
+from aes_ctr_file import CtrFile, open_ctr
+from aes_keystream import KeystreamBuffer
+from aes_container import Container
+from aes_async import AsyncAES
+import aes_async
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class TestBlock(unittest.TestCase):
     """
@@ -66,6 +92,380 @@ class TestKeySizes(unittest.TestCase):
         self.assertEqual(ciphertext, b'\x8e\xa2\xb7\xca\x51\x67\x45\xbf\xea\xfc\x49\x90\x4b\x49\x60\x89')
         self.assertEqual(aes.decrypt_block(ciphertext), message)
 
+class TestTableEngine(unittest.TestCase):
+    """
+    Tests the 32-bit word / T-table round engine against the matrix engine.
+    """
+    def test_expected_values(self):
+        """ FIPS-197 Appendix C vectors for all key sizes. """
+        message = b'\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xAA\xBB\xCC\xDD\xEE\xFF'
+        expected = {
+            16: b'\x69\xc4\xe0\xd8\x6a\x7b\x04\x30\xd8\xcd\xb7\x80\x70\xb4\xc5\x5a',
+            24: b'\xdd\xa9\x7c\xa4\x86\x4c\xdf\xe0\x6e\xaf\x70\xa0\xec\x0d\x71\x91',
+            32: b'\x8e\xa2\xb7\xca\x51\x67\x45\xbf\xea\xfc\x49\x90\x4b\x49\x60\x89',
+        }
+        for key_size, ciphertext in expected.items():
+            aes = AES(bytes(range(key_size)), engine='table')
+            self.assertEqual(aes.encrypt_block(message), ciphertext)
+            self.assertEqual(aes.decrypt_block(ciphertext), message)
+
+    def test_matches_matrix(self):
+        """ Both engines should agree on random keys and blocks. """
+        for key_size in (16, 24, 32):
+            key = os.urandom(key_size)
+            matrix, table = AES(key), AES(key, engine='table')
+            for _ in range(10):
+                block = os.urandom(16)
+                self.assertEqual(table.encrypt_block(block), matrix.encrypt_block(block))
+                self.assertEqual(table.decrypt_block(block), matrix.decrypt_block(block))
+
+    def test_modes(self):
+        """ Block modes should work unchanged on top of the table engine. """
+        iv = b'\x01' * 16
+        message = b'M' * 100
+        matrix, table = AES(b'\x00' * 16), AES(b'\x00' * 16, engine='table')
+        self.assertEqual(table.encrypt_cbc(message, iv), matrix.encrypt_cbc(message, iv))
+        self.assertEqual(table.decrypt_cbc(matrix.encrypt_cbc(message, iv), iv), message)
+
+    def test_bad_engine(self):
+        with self.assertRaises(AssertionError):
+            AES(b'\x00' * 16, engine='unknown')
+
+class TestScheduleCache(unittest.TestCase):
+    """
+    Tests the process-wide key schedule cache and the equivalent inverse
+    cipher round keys.
+    """
+    def setUp(self):
+        aes_module.clear_schedule_cache()
+
+    def tearDown(self):
+        aes_module.clear_schedule_cache()
+
+    def test_shared(self):
+        key = os.urandom(16)
+        self.assertIs(AES(key, cache=True)._key_matrices, AES(bytearray(key), cache=True)._key_matrices)
+        self.assertIsNot(AES(key, cache=True)._key_matrices, AES(os.urandom(16), cache=True)._key_matrices)
+        self.assertIsNot(AES(key)._key_matrices, AES(key, cache=True)._key_matrices)
+
+    def test_bounded(self):
+        first = os.urandom(16)
+        AES(first, cache=True)
+        for _ in range(aes_module.SCHEDULE_CACHE_SIZE):
+            AES(os.urandom(16), cache=True)
+        self.assertEqual(len(aes_module._schedule_cache), aes_module.SCHEDULE_CACHE_SIZE)
+        self.assertNotIn(first, aes_module._schedule_cache)
+
+    def test_one_time_keys(self):
+        """ Per-message keys never enter the schedule cache. """
+        AES(os.urandom(16))
+        for mode in ('cbc', 'gcm', 'session'):
+            decrypt(b'key', encrypt(b'key', b'message', 1000, mode), 1000, mode)
+        Session(b'key', workload=1000).encrypt(b'message')
+        aes_container.decrypt(b'key', aes_container.encrypt(b'key', b'message', 1000, processes=1),
+                              1000, processes=1)
+        self.assertEqual(len(aes_module._schedule_cache), 0)
+
+    def test_clear(self):
+        AES(os.urandom(16), cache=True)
+        aes_module.clear_schedule_cache()
+        self.assertEqual(len(aes_module._schedule_cache), 0)
+
+    def test_equivalent_inverse(self):
+        """ Decryption with the equivalent inverse keys matches FIPS-197. """
+        message = b'\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xAA\xBB\xCC\xDD\xEE\xFF'
+        ciphertext = b'\x69\xc4\xe0\xd8\x6a\x7b\x04\x30\xd8\xcd\xb7\x80\x70\xb4\xc5\x5a'
+        aes = AES(bytes(range(16)))
+        self.assertEqual(aes._dec_key_matrices[0], aes._key_matrices[-1])
+        self.assertEqual(aes._dec_key_matrices[-1], aes._key_matrices[0])
+        self.assertEqual(aes.decrypt_block(ciphertext), message)
+        for key_size in (16, 24, 32):
+            aes = AES(os.urandom(key_size))
+            block = os.urandom(16)
+            self.assertEqual(aes.decrypt_block(aes.encrypt_block(block)), block)
+
+@unittest.skipUnless(numpy, 'NumPy is not installed')
+class TestNumpyEngine(unittest.TestCase):
+    """
+    Tests the vectorized NumPy engine against the matrix engine.
+    """
+    def setUp(self):
+        self.key = os.urandom(16)
+        self.iv = os.urandom(16)
+        self.matrix = AES(self.key)
+        self.numpy = AES(self.key, engine='numpy')
+
+    def test_ecb(self):
+        for key_size in (16, 24, 32):
+            key = os.urandom(key_size)
+            message = os.urandom(16 * 33)
+            matrix, vectorized = AES(key), AES(key, engine='numpy')
+            ciphertext = vectorized.encrypt_ecb(message)
+            self.assertEqual(ciphertext, matrix.encrypt_ecb(message))
+            self.assertEqual(vectorized.decrypt_ecb(ciphertext), message)
+
+    def test_modes(self):
+        """ Parallel modes should match, including partial final blocks. """
+        for length in (0, 1, 16, 17, 100, 1000):
+            message = os.urandom(length)
+            ciphertext = self.matrix.encrypt_ctr(message, self.iv)
+            self.assertEqual(self.numpy.encrypt_ctr(message, self.iv), ciphertext)
+            self.assertEqual(self.numpy.decrypt_ctr(ciphertext, self.iv), message)
+
+            ciphertext = self.matrix.encrypt_cbc(message, self.iv)
+            self.assertEqual(self.numpy.decrypt_cbc(ciphertext, self.iv), message)
+
+            ciphertext = self.matrix.encrypt_cfb(message, self.iv)
+            self.assertEqual(self.numpy.decrypt_cfb(ciphertext, self.iv), message)
+
+    def test_ctr_carry(self):
+        """ The counter must carry from the low 64 bits into the high ones. """
+        iv = b'\x00' * 7 + b'\x01' + b'\xff' * 8
+        message = os.urandom(16 * 4)
+        self.assertEqual(self.numpy.encrypt_ctr(message, iv), self.matrix.encrypt_ctr(message, iv))
+
+    def test_chunks(self):
+        """ Messages longer than one batch should be split transparently. """
+        import aes_numpy
+        original, aes_numpy.CHUNK_BLOCKS = aes_numpy.CHUNK_BLOCKS, 4
+        try:
+            message = os.urandom(16 * 10 + 3)
+            self.assertEqual(self.numpy.encrypt_ctr(message, self.iv), self.matrix.encrypt_ctr(message, self.iv))
+            ciphertext = self.matrix.encrypt_cbc(message, self.iv)
+            self.assertEqual(self.numpy.decrypt_cbc(ciphertext, self.iv), message)
+            ciphertext = self.matrix.encrypt_cfb(message, self.iv)
+            self.assertEqual(self.numpy.decrypt_cfb(ciphertext, self.iv), message)
+        finally:
+            aes_numpy.CHUNK_BLOCKS = original
+
+class TestParallel(unittest.TestCase):
+    """
+    Tests the process-pool implementation against the single process one.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.key = os.urandom(16)
+        # Tiny segments so that even short messages use several workers.
+        cls.parallel = ParallelAES(cls.key, processes=2, segment_size=64)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.parallel.close()
+
+    def setUp(self):
+        self.aes = AES(self.key)
+        self.iv = b'\x00' * 15 + b'\xfe'
+
+    def test_ctr(self):
+        for length in (10, 64, 65, 1000):
+            message = os.urandom(length)
+            ciphertext = self.parallel.encrypt_ctr(message, self.iv)
+            self.assertEqual(ciphertext, self.aes.encrypt_ctr(message, self.iv))
+            self.assertEqual(self.parallel.decrypt_ctr(ciphertext, self.iv), message)
+
+    def test_cbc(self):
+        for length in (10, 63, 64, 1000):
+            message = os.urandom(length)
+            ciphertext = self.aes.encrypt_cbc(message, self.iv)
+            self.assertEqual(self.parallel.decrypt_cbc(ciphertext, self.iv), message)
+            self.assertEqual(self.parallel.decrypt_cbc(bytearray(ciphertext), self.iv), message)
+
+class TestStreaming(unittest.TestCase):
+    """
+    Tests incremental update()/finalize() ciphers against the whole-message
+    mode methods, feeding input in uneven chunks.
+    """
+    def setUp(self):
+        self.aes = AES(os.urandom(16))
+        self.iv = os.urandom(16)
+
+    def chunked(self, cipher, data, sizes):
+        out = []
+        i = 0
+        for size in sizes:
+            out.append(cipher.update(data[i:i+size]))
+            i += size
+        out.append(cipher.update(data[i:]))
+        out.append(cipher.finalize())
+        return b''.join(out)
+
+    def test_modes(self):
+        for mode in ('cbc', 'pcbc', 'cfb', 'ofb', 'ctr'):
+            encrypt = getattr(self.aes, 'encrypt_' + mode)
+            for length in (0, 5, 16, 33, 100):
+                message = os.urandom(length)
+                expected = encrypt(message, self.iv)
+                for sizes in ([], [1, 2, 3], [16, 0, 7], [15, 17, 5]):
+                    ciphertext = self.chunked(encryptor(self.aes, mode, self.iv), message, sizes)
+                    self.assertEqual(ciphertext, expected, (mode, length, sizes))
+                    plaintext = self.chunked(decryptor(self.aes, mode, self.iv), ciphertext, sizes)
+                    self.assertEqual(plaintext, message, (mode, length, sizes))
+
+    def test_stream_output_is_immediate(self):
+        """ Stream modes should not hold back bytes of a partial block. """
+        cipher = encryptor(self.aes, 'ctr', self.iv)
+        self.assertEqual(len(cipher.update(b'abc')), 3)
+
+    def test_truncated(self):
+        cipher = decryptor(self.aes, 'cbc', self.iv)
+        cipher.update(self.aes.encrypt_cbc(b'M' * 20, self.iv)[:-1])
+        with self.assertRaises(AssertionError):
+            cipher.finalize()
+
+    def test_finalized(self):
+        cipher = encryptor(self.aes, 'cbc', self.iv)
+        cipher.finalize()
+        with self.assertRaises(AssertionError):
+            cipher.update(b'more')
+
+class TestFiles(unittest.TestCase):
+    """
+    Tests memory-mapped file encryption against the in-memory modes.
+    """
+    def setUp(self):
+        self.aes = AES(os.urandom(16))
+        self.iv = os.urandom(16)
+        self.dir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.dir.name, 'source')
+        self.encrypted = os.path.join(self.dir.name, 'encrypted')
+        self.decrypted = os.path.join(self.dir.name, 'decrypted')
+        # Small windows so several are needed even for short files.
+        self.window = mmap.ALLOCATIONGRANULARITY
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_copy(self):
+        for mode in ('cbc', 'pcbc', 'cfb', 'ofb', 'ctr'):
+            for length in (0, 10, 3 * self.window + 5):
+                message = os.urandom(length)
+                self.write(self.source, message)
+                written = encrypt_file(self.aes, mode, self.iv, self.source, self.encrypted, self.window)
+                expected = getattr(self.aes, 'encrypt_' + mode)(message, self.iv)
+                self.assertEqual(written, len(expected))
+                self.assertEqual(self.read(self.encrypted), expected, (mode, length))
+                written = decrypt_file(self.aes, mode, self.iv, self.encrypted, self.decrypted, self.window)
+                self.assertEqual(written, length)
+                self.assertEqual(self.read(self.decrypted), message, (mode, length))
+
+    def test_in_place(self):
+        message = os.urandom(2 * self.window + 7)
+        for mode in ('cfb', 'ofb', 'ctr'):
+            self.write(self.source, message)
+            encrypt_file(self.aes, mode, self.iv, self.source, window=self.window)
+            self.assertEqual(self.read(self.source), getattr(self.aes, 'encrypt_' + mode)(message, self.iv))
+            decrypt_file(self.aes, mode, self.iv, self.source, self.source, window=self.window)
+            self.assertEqual(self.read(self.source), message)
+
+        with self.assertRaises(AssertionError):
+            encrypt_file(self.aes, 'cbc', self.iv, self.source)
+
+    def test_progress(self):
+        message = os.urandom(2 * self.window + 7)
+        self.write(self.source, message)
+        reports = []
+        encrypt_file(self.aes, 'ctr', self.iv, self.source, self.encrypted, self.window,
+                     progress=lambda done, total: reports.append((done, total)))
+        self.assertEqual(reports[-1], (len(message), len(message)))
+        self.assertEqual(len(reports), 3)
+
+    def test_bad_padding_removes_output(self):
+        self.write(self.source, os.urandom(32))
+        with self.assertRaises(AssertionError):
+            decrypt_file(self.aes, 'cbc', self.iv, self.source, self.decrypted, self.window)
+        self.assertFalse(os.path.exists(self.decrypted))
+
+    def test_unopenable_output(self):
+        """ Failing to open the output raises that error and removes nothing. """
+        self.write(self.source, os.urandom(32))
+        missing = os.path.join(self.dir.name, 'missing', 'encrypted')
+        with self.assertRaises(FileNotFoundError) as context:
+            encrypt_file(self.aes, 'ctr', self.iv, self.source, missing, self.window)
+        self.assertEqual(context.exception.filename, missing)
+
+        self.write(self.encrypted, b'keep me')
+        os.chmod(self.encrypted, 0o444)
+        if os.access(self.encrypted, os.W_OK):
+            self.skipTest('read-only files are writable here (running as root?)')
+        with self.assertRaises(PermissionError):
+            encrypt_file(self.aes, 'ctr', self.iv, self.source, self.encrypted, self.window)
+        self.assertEqual(self.read(self.encrypted), b'keep me')
+
+class TestGcm(unittest.TestCase):
+    """
+    Tests AES-GCM with the test cases from the GCM specification
+    (McGrew and Viega), as used in NIST's validation vectors.
+    """
+    P = bytes.fromhex(
+        'd9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a72'
+        '1c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b391aafd255')
+    A = bytes.fromhex('feedfacedeadbeeffeedfacedeadbeefabaddad2')
+    K = bytes.fromhex('feffe9928665731c6d6a8f9467308308')
+    IV = bytes.fromhex('cafebabefacedbaddecaf888')
+
+    def check(self, key, iv, plaintext, aad, ciphertext, tag):
+        for engine in AES.engines if numpy else ('matrix', 'table'):
+            aes = AES(key, engine)
+            sealed = aes.encrypt_gcm(plaintext, iv, aad)
+            self.assertEqual(sealed, ciphertext + tag)
+            self.assertEqual(aes.decrypt_gcm(sealed, iv, aad), plaintext)
+
+    def test_zero_key(self):
+        self.check(bytes(16), bytes(12), b'', b'', b'',
+                   bytes.fromhex('58e2fccefa7e3061367f1d57a4e7455a'))
+        self.check(bytes(16), bytes(12), bytes(16), b'',
+                   bytes.fromhex('0388dace60b6a392f328c2b971b2fe78'),
+                   bytes.fromhex('ab6e47d42cec13bdf53a67b21257bddf'))
+
+    def test_vectors(self):
+        self.check(self.K, self.IV, self.P, b'', bytes.fromhex(
+            '42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e'
+            '21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091473f5985'),
+            bytes.fromhex('4d5c2af327cd64a62cf35abd2ba6fab4'))
+        self.check(self.K, self.IV, self.P[:60], self.A, bytes.fromhex(
+            '42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e'
+            '21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091'),
+            bytes.fromhex('5bc94fbc3221a5db94fae95ae7121a47'))
+
+    def test_other_iv_sizes(self):
+        self.check(self.K, bytes.fromhex('cafebabefacedbad'), self.P[:60], self.A, bytes.fromhex(
+            '61353b4c2806934a777ff51fa22a4755699b2a714fcdc6f83766e5f97b6c7423'
+            '73806900e49f24b22b097544d4896b424989b5e1ebac0f07c23f4598'),
+            bytes.fromhex('3612d2e79e3b0785561be14aaca2fccb'))
+        self.check(self.K, bytes.fromhex(
+            '9313225df88406e555909c5aff5269aa6a7a9538534f7da1e4c303d2a318a728'
+            'c3c0c95156809539fcf0e2429a6b525416aedbf5a0de6a57a637b39b'), self.P[:60], self.A, bytes.fromhex(
+            '8ce24998625615b603a033aca13fb894be9112a5c3a211a8ba262a3cca7e2ca7'
+            '01e4a9a4fba43c90ccdcb281d48c7c6fd62875d2aca417034c34aee5'),
+            bytes.fromhex('619cc5aefffe0bfa462af43c1699d050'))
+
+    def test_256(self):
+        self.check(bytes(32), bytes(12), bytes(16), b'',
+                   bytes.fromhex('cea7403d4d606b6e074ec5d3baf39d18'),
+                   bytes.fromhex('d0d1c8a799996bf0265b98b5d48ab919'))
+        self.check(self.K * 2, self.IV, self.P, b'', bytes.fromhex(
+            '522dc1f099567d07f47f37a32a84427d643a8cdcbfe5c0c97598a2bd2555d1aa'
+            '8cb08e48590dbb3da7b08b1056828838c5f61e6393ba7a0abcc9f662898015ad'),
+            bytes.fromhex('b094dac5d93471bdec1a502270e3cc6c'))
+
+    def test_tampering(self):
+        aes = AES(self.K)
+        sealed = aes.encrypt_gcm(self.P, self.IV, self.A)
+        with self.assertRaises(AssertionError):
+            aes.decrypt_gcm(sealed[:-1] + bytes([sealed[-1] ^ 1]), self.IV, self.A)
+        with self.assertRaises(AssertionError):
+            aes.decrypt_gcm(bytes([sealed[0] ^ 1]) + sealed[1:], self.IV, self.A)
+        with self.assertRaises(AssertionError):
+            aes.decrypt_gcm(sealed, self.IV, self.A + b'x')
+
 
 class TestCbc(unittest.TestCase):
     """
@@ -124,6 +524,16 @@ class TestCbc(unittest.TestCase):
         ciphertext = self.aes.encrypt_cbc(long_message, self.iv)
         self.assertEqual(self.aes.decrypt_cbc(ciphertext, self.iv), long_message)
 
+    def test_blocks_in_place(self):
+        """ Pieces of a message can be decrypted in place, padding kept. """
+        message = b'M' * 100
+        buffer = bytearray(self.aes.encrypt_cbc(message, self.iv))
+        view = memoryview(buffer)
+        previous = bytes(view[32:48])
+        self.assertEqual(self.aes.decrypt_cbc_blocks(view[48:], previous, out=view[48:]), 64)
+        self.assertEqual(self.aes.decrypt_cbc_blocks(view[:48], self.iv, out=view[:48]), 48)
+        self.assertEqual(bytes(buffer), message + bytes([12]) * 12)
+
 class TestPcbc(unittest.TestCase):
     """
     Tests AES-128 in CBC mode.
@@ -385,6 +795,16 @@ class TestFunctions(unittest.TestCase):
         ciphertext2 = self.encrypt(self.key, self.message)
         self.assertNotEqual(ciphertext1, ciphertext2)
 
+    def test_gcm(self):
+        """ The GCM envelope should round trip and detect tampering. """
+        ciphertext = encrypt(self.key, self.message, 10000, mode='gcm')
+        self.assertEqual(decrypt(self.key, ciphertext, 10000, mode='gcm'), self.message)
+        self.assertEqual(len(ciphertext), 16 + len(self.message) + 16)
+        with self.assertRaises(AssertionError):
+            decrypt(self.key, ciphertext[:-1] + b'a', 10000, mode='gcm')
+        with self.assertRaises(AssertionError):
+            decrypt(self.key, b'x' + ciphertext[1:], 10000, mode='gcm')
+
     def test_integrity(self):
         """ Tests integrity verifications. """
         with self.assertRaises(AssertionError):
@@ -402,6 +822,602 @@ class TestFunctions(unittest.TestCase):
             ciphertext = ciphertext[:-1] + b'a'
             self.decrypt(self.key, ciphertext)
 
+class TestKeyCache(unittest.TestCase):
+    """
+    Tests the derived key cache and its use by `encrypt` and `decrypt`.
+    """
+    def setUp(self):
+        self.now = 0
+        self.cache = KeyCache(maxsize=2, ttl=10, clock=lambda: self.now)
+
+    def tearDown(self):
+        disable_key_cache()
+
+    def test_hits_and_misses(self):
+        salt = b's' * 16
+        first = self.cache.get_key_iv(b'password', salt, 1000)
+        self.assertEqual(first, get_key_iv(b'password', salt, 1000))
+        self.assertEqual(self.cache.get_key_iv(b'password', salt, 1000), first)
+        # Workload is part of the key.
+        self.cache.get_key_iv(b'password', salt, 1001)
+        info = self.cache.cache_info()
+        self.assertEqual((info.hits, info.misses, info.size), (1, 2, 2))
+
+    def test_lru_eviction(self):
+        self.cache.get_key_iv(b'a', b's' * 16, 1000)
+        self.cache.get_key_iv(b'b', b's' * 16, 1000)
+        self.cache.get_key_iv(b'a', b's' * 16, 1000)
+        self.cache.get_key_iv(b'c', b's' * 16, 1000)
+        self.assertEqual(self.cache.cache_info().evictions, 1)
+        # 'b' was least recently used, so 'a' is still cached.
+        self.cache.get_key_iv(b'a', b's' * 16, 1000)
+        self.assertEqual(self.cache.cache_info().hits, 2)
+
+    def test_ttl(self):
+        self.cache.get_key_iv(b'a', b's' * 16, 1000)
+        self.now = 11
+        self.cache.get_key_iv(b'a', b's' * 16, 1000)
+        info = self.cache.cache_info()
+        self.assertEqual((info.hits, info.misses, info.expirations), (0, 2, 1))
+
+    def test_invalidate(self):
+        self.cache.get_key_iv(b'a', b's' * 16, 1000)
+        self.cache.get_key_iv(b'b', b's' * 16, 1000)
+        self.cache.invalidate(b'a')
+        self.assertEqual(len(self.cache), 1)
+        self.cache.invalidate()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_encrypt_decrypt(self):
+        cache = enable_key_cache()
+        ciphertext = encrypt(b'key', b'message', 1000)
+        for _ in range(3):
+            self.assertEqual(decrypt(b'key', ciphertext, 1000), b'message')
+        info = cache.cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 1))
+        with self.assertRaises(AssertionError):
+            decrypt(b'wrong key', ciphertext, 1000)
+
+    def test_encrypt_leaves_cache_alone(self):
+        # Fresh salts never hit, so encrypting must not evict decrypt's keys.
+        cache = enable_key_cache(maxsize=2)
+        ciphertext = encrypt(b'key', b'message', 1000)
+        decrypt(b'key', ciphertext, 1000)
+        for _ in range(5):
+            encrypt(b'key', b'other message', 1000)
+        decrypt(b'key', ciphertext, 1000)
+        info = cache.cache_info()
+        self.assertEqual((info.hits, info.misses, info.evictions, info.size), (1, 1, 0, 1))
+
+class TestSession(unittest.TestCase):
+    """
+    Tests the session envelope: one key stretch, cheap per-message keys.
+    """
+    def setUp(self):
+        self.session = Session(b'master key', workload=1000)
+
+    def test_success(self):
+        ciphertexts = [self.session.encrypt(b'record %d' % i) for i in range(5)]
+        self.assertEqual(len(set(ciphertexts)), 5)
+        for i, ciphertext in enumerate(ciphertexts):
+            self.assertEqual(self.session.decrypt(ciphertext), b'record %d' % i)
+
+    def test_module_decrypt(self):
+        """ `decrypt` reads session records only when asked to. """
+        ciphertext = self.session.encrypt('text message')
+        self.assertEqual(decrypt(b'master key', ciphertext, 1000, mode='session'), b'text message')
+        self.assertEqual(decrypt('master key', encrypt('master key', 'text', 1000, mode='session'), 1000,
+                                 mode='session'), b'text')
+        with self.assertRaises(AssertionError):
+            decrypt(b'master key', ciphertext, 1000)
+        # A GCM ciphertext whose salt happens to start like a session header.
+        salt = aes_module.SESSION_MAGIC + os.urandom(12)
+        key, _, iv = get_key_iv(b'master key', salt, 1000)
+        legacy = salt + AES(key).encrypt_gcm(b'legacy', iv[:12], salt)
+        self.assertEqual(decrypt(b'master key', legacy, 1000, mode='gcm'), b'legacy')
+
+    def test_untrusted_workload(self):
+        """ The header's workload is checked before any key stretching. """
+        ciphertext = Session(b'master key', workload=2000).encrypt(b'message')
+        with self.assertRaisesRegex(AssertionError, 'workload'):
+            self.session.decrypt(ciphertext)
+        with self.assertRaisesRegex(AssertionError, 'workload'):
+            decrypt(b'master key', ciphertext, 1000, mode='session')
+        huge = bytearray(ciphertext)
+        huge[5:9] = b'\xff' * 4
+        with self.assertRaisesRegex(AssertionError, 'workload'):
+            decrypt(b'master key', bytes(huge), mode='session')
+
+    def test_other_session(self):
+        """ A session with the same password reads another session's output. """
+        other = Session(b'master key', workload=1000)
+        self.assertNotEqual(other.salt, self.session.salt)
+        ciphertext = self.session.encrypt(b'message')
+        self.assertEqual(other.decrypt(ciphertext), b'message')
+        self.assertEqual(other.decrypt(self.session.encrypt(b'again')), b'again')
+        with self.assertRaises(AssertionError):
+            Session(b'wrong key', workload=1000).decrypt(ciphertext)
+
+    def test_integrity(self):
+        ciphertext = self.session.encrypt(b'message')
+        for i in (0, 4, 10, 30, 45, len(ciphertext) - 1):
+            tampered = ciphertext[:i] + bytes([ciphertext[i] ^ 1]) + ciphertext[i+1:]
+            with self.assertRaises(AssertionError):
+                self.session.decrypt(tampered)
+        with self.assertRaises(AssertionError):
+            self.session.decrypt(ciphertext[:-1])
+
+    def test_pickle(self):
+        """ A pickled session keeps its session key but not the password. """
+        ciphertext = self.session.encrypt(b'message')
+        copy = pickle.loads(pickle.dumps(self.session))
+        self.assertIsNone(copy._password)
+        self.assertEqual(copy.decrypt(ciphertext), b'message')
+        self.assertEqual(self.session.decrypt(copy.encrypt(b'back')), b'back')
+        with self.assertRaisesRegex(AssertionError, 'password'):
+            copy.decrypt(Session(b'master key', workload=1000).encrypt(b'other salt'))
+
+
+class TestOutputBuffers(unittest.TestCase):
+    """
+    Tests that every mode writes into a caller's buffer (`out=`) exactly
+    what it would otherwise return, and reports the bytes written.
+    """
+    def setUp(self):
+        self.key = os.urandom(16)
+        self.iv = os.urandom(16)
+        self.engines = ['matrix', 'table'] + (['numpy'] if numpy is not None else [])
+
+    def check(self, method, data, *args):
+        expected = method(data, *args)
+        for make in (lambda n: bytearray(n),
+                     lambda n: memoryview(bytearray(n + 7))[7:],
+                     lambda n: mmap.mmap(-1, n)):
+            out = make(len(data) + 32)
+            written = method(data, *args, out=out)
+            self.assertEqual(written, len(expected), method.__name__)
+            self.assertEqual(bytes(out[:written]), expected, method.__name__)
+        return expected
+
+    def test_modes(self):
+        for engine in self.engines:
+            aes = AES(self.key, engine)
+            for length in (0, 5, 16, 33, 64):
+                message = os.urandom(length)
+                for mode in ('cbc', 'pcbc', 'cfb', 'ofb', 'ctr'):
+                    ciphertext = self.check(getattr(aes, 'encrypt_' + mode), message, self.iv)
+                    self.check(getattr(aes, 'decrypt_' + mode), ciphertext, self.iv)
+                ciphertext = self.check(aes.encrypt_gcm, message, self.iv[:12], b'aad')
+                self.check(aes.decrypt_gcm, ciphertext, self.iv[:12], b'aad')
+            block = self.check(aes.encrypt_block, message[:16] or bytes(16))
+            self.check(aes.decrypt_block, block)
+            self.check(aes.decrypt_ecb, self.check(aes.encrypt_ecb, os.urandom(48)))
+
+    def test_in_place(self):
+        aes = AES(self.key, 'table')
+        message = os.urandom(64)
+        buffer = bytearray(message)
+        aes.encrypt_ctr(buffer, self.iv, out=buffer)
+        self.assertEqual(buffer, aes.encrypt_ctr(message, self.iv))
+        # Decryption writes the padding too, so it needs the ciphertext's length.
+        buffer = bytearray(aes.encrypt_cbc(message, self.iv))
+        self.assertEqual(aes.decrypt_cbc(buffer, self.iv, out=buffer), 64)
+        self.assertEqual(buffer[:64], message)
+
+    def test_bad_buffers(self):
+        aes = AES(self.key)
+        with self.assertRaises(AssertionError):
+            aes.encrypt_cbc(bytes(16), self.iv, out=bytearray(16))
+        with self.assertRaises(AssertionError):
+            aes.encrypt_ctr(bytes(16), self.iv, out=bytes(16))
+
+    def test_functions(self):
+        message = os.urandom(100)
+        for mode in ('cbc', 'gcm'):
+            out = bytearray(200)
+            written = encrypt(b'key', message, workload=1000, mode=mode, out=out)
+            self.assertEqual(decrypt(b'key', bytes(out[:written]), workload=1000, mode=mode), message)
+            plaintext = bytearray(200)
+            size = decrypt(b'key', bytes(out[:written]), workload=1000, mode=mode, out=plaintext)
+            self.assertEqual(plaintext[:size], message)
+
+
+class TestCtrFile(unittest.TestCase):
+    """
+    Tests random access through `CtrFile` against whole-message CTR.
+    """
+    def setUp(self):
+        self.aes = AES(os.urandom(16))
+        self.iv = os.urandom(8) + b'\xff' * 8
+        self.message = os.urandom(1000)
+        self.file = CtrFile(io.BytesIO(self.aes.encrypt_ctr(self.message, self.iv)), self.aes, self.iv)
+
+    def contents(self):
+        return self.aes.decrypt_ctr(self.file.raw.getvalue(), self.iv)
+
+    def test_read(self):
+        for offset, size in ((0, 1000), (5, 3), (15, 2), (16, 16), (999, 10), (1000, 5), (2000, 1)):
+            self.file.seek(offset)
+            self.assertEqual(self.file.read(size), self.message[offset:offset + size], (offset, size))
+            self.assertEqual(self.file.tell(), min(offset + size, max(offset, 1000)))
+        self.file.seek(-10, io.SEEK_END)
+        self.assertEqual(self.file.read(), self.message[-10:])
+
+    def test_pread(self):
+        self.file.seek(100)
+        self.assertEqual(self.file.pread(7, 33), self.message[33:40])
+        self.assertEqual(self.file.tell(), 100)
+        buffer = bytearray(20)
+        self.assertEqual(self.file.readinto(buffer), 20)
+        self.assertEqual(buffer, self.message[100:120])
+
+    def test_write(self):
+        expected = bytearray(self.message)
+        for offset, data in ((3, b'abc'), (14, b'x' * 40), (998, b'tail!')):
+            self.file.seek(offset)
+            self.assertEqual(self.file.write(data), len(data))
+            expected[offset:offset + len(data)] = data
+        self.assertEqual(self.file.pwrite(b'pw', 500), 2)
+        expected[500:502] = b'pw'
+        self.assertEqual(self.file.tell(), 1003)
+        self.assertEqual(self.contents(), expected)
+
+    def test_gaps_and_truncate(self):
+        self.file.pwrite(b'end', 1100)
+        self.assertEqual(self.contents(), self.message + bytes(100) + b'end')
+        self.file.truncate(500)
+        self.assertEqual(self.contents(), self.message[:500])
+        self.file.truncate(520)
+        self.assertEqual(self.contents(), self.message[:500] + bytes(20))
+
+    def test_buffered_file(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'data')
+            with io.BufferedRandom(open_ctr(path, self.aes, self.iv, 'w+b')) as f:
+                f.write(self.message)
+                f.seek(300)
+                self.assertEqual(f.read(10), self.message[300:310])
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.aes.encrypt_ctr(self.message, self.iv))
+            with open_ctr(path, self.aes, self.iv) as f:
+                self.assertEqual(f.pread(50, 950), self.message[950:])
+                with self.assertRaises(io.UnsupportedOperation):
+                    f.write(b'read only')
+
+    def test_concurrent_positional_io(self):
+        """ pread/pwrite from many threads, on an OS file and on BytesIO. """
+        offsets = [(i * 37) % 990 for i in range(200)]
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'data')
+            with open(path, 'wb') as f:
+                f.write(self.aes.encrypt_ctr(self.message, self.iv))
+            with open_ctr(path, self.aes, self.iv, 'r+b') as f:
+                if hasattr(os, 'pread'):
+                    self.assertIsNotNone(f._fd)
+                for file in (f, self.file):
+                    with ThreadPoolExecutor(8) as pool:
+                        chunks = list(pool.map(lambda offset: file.pread(10, offset), offsets))
+                    self.assertEqual(chunks, [self.message[o:o + 10] for o in offsets])
+                    with ThreadPoolExecutor(8) as pool:
+                        list(pool.map(lambda k: file.pwrite(bytes([k]) * 10, 10 * k), range(100)))
+                    self.assertEqual(file.pread(1000, 0), b''.join(bytes([k]) * 10 for k in range(100)))
+
+
+class TestKeystreamBuffer(unittest.TestCase):
+    """
+    Tests precomputed CTR/OFB keystream against the whole-message modes.
+    """
+    def setUp(self):
+        self.aes = AES(os.urandom(16), engine='table')
+        self.iv = os.urandom(16)
+
+    def test_modes(self):
+        messages = [os.urandom(n) for n in (0, 5, 16, 100, 3, 700, 1)]
+        for mode in ('ctr', 'ofb'):
+            # A small ring, so the buffer wraps around several times.
+            with KeystreamBuffer(self.aes, mode, self.iv, capacity=96, chunk_size=32) as keystream:
+                ciphertext = b''.join(keystream.crypt(m) for m in messages)
+                stats = keystream.stats()
+            expected = getattr(self.aes, 'encrypt_' + mode)(b''.join(messages), self.iv)
+            self.assertEqual(ciphertext, expected, mode)
+            self.assertEqual(stats.consumed, len(expected))
+            self.assertGreaterEqual(stats.produced, stats.consumed)
+
+    def test_stats(self):
+        with KeystreamBuffer(self.aes, 'ctr', self.iv, capacity=256, chunk_size=64) as keystream:
+            deadline = time.time() + 5
+            while keystream.depth < 256 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(keystream.stats().depth, 256)
+            keystream.crypt(bytes(100))
+            self.assertEqual(keystream.stats().underruns, 0)
+            # More than the buffer holds has to wait for the producer.
+            keystream.crypt(bytes(2000))
+            stats = keystream.stats()
+        self.assertGreater(stats.underruns, 0)
+        self.assertEqual(stats.consumed, 2100)
+
+    def test_closed(self):
+        keystream = KeystreamBuffer(self.aes, 'ofb', self.iv)
+        keystream.close()
+        with self.assertRaises(AssertionError):
+            keystream.crypt(b'late')
+
+
+class TestContainer(unittest.TestCase):
+    """
+    Tests the segmented container: whole-object round trips, single-segment
+    access and detection of modified, moved or missing segments.
+    """
+    def encrypt(self, message, processes=1):
+        return aes_container.encrypt(b'key', message, workload=1000, segment_size=64, processes=processes)
+
+    def test_success(self):
+        for length in (0, 1, 64, 65, 200):
+            message = os.urandom(length)
+            ciphertext = self.encrypt(message)
+            self.assertEqual(len(ciphertext), aes_container.HEADER_SIZE + length +
+                             aes_container.TAG_SIZE * max(1, -(-length // 64)))
+            self.assertEqual(aes_container.decrypt(b'key', ciphertext, 1000, processes=1), message)
+
+    def test_processes(self):
+        message = os.urandom(1000)
+        ciphertext = self.encrypt(message, processes=3)
+        self.assertEqual(aes_container.decrypt(b'key', ciphertext, 1000, processes=1), message)
+        self.assertEqual(aes_container.decrypt(b'key', ciphertext, 1000, processes=3), message)
+
+    def test_single_segment(self):
+        message = os.urandom(1000)
+        ciphertext = self.encrypt(message)
+        container = Container.open(b'key', ciphertext[:aes_container.HEADER_SIZE], 1000)
+        self.assertEqual(container.segment_count(len(ciphertext)), 16)
+        self.assertEqual(container.plaintext_size(len(ciphertext)), 1000)
+        for index in (0, 7, 15):
+            start, end, final = container.segment_range(index, len(ciphertext))
+            self.assertEqual(final, index == 15)
+            self.assertEqual(container.decrypt_segment(index, ciphertext[start:end], final),
+                             message[64 * index:64 * (index + 1)])
+        # A segment is only valid at its own index.
+        start, end, _ = container.segment_range(3, len(ciphertext))
+        with self.assertRaises(AssertionError):
+            container.decrypt_segment(4, ciphertext[start:end], False)
+
+    def test_tampering(self):
+        ciphertext = self.encrypt(os.urandom(200))
+        segment = 64 + aes_container.TAG_SIZE
+        header, body = ciphertext[:aes_container.HEADER_SIZE], ciphertext[aes_container.HEADER_SIZE:]
+        segments = [body[i:i + segment] for i in range(0, len(body), segment)]
+        for bad in (ciphertext[:-1],
+                    header + b''.join(segments[:-1]),
+                    header + b''.join([segments[1], segments[0]] + segments[2:]),
+                    ciphertext[:20] + bytes([ciphertext[20] ^ 1]) + ciphertext[21:],
+                    ciphertext[:100] + bytes([ciphertext[100] ^ 1]) + ciphertext[101:]):
+            with self.assertRaises(AssertionError):
+                aes_container.decrypt(b'key', bad, 1000, processes=1)
+        with self.assertRaises(AssertionError):
+            aes_container.decrypt(b'wrong key', ciphertext, 1000, processes=1)
+
+    def test_untrusted_workload(self):
+        ciphertext = self.encrypt(os.urandom(200))
+        with self.assertRaisesRegex(AssertionError, 'workload'):
+            aes_container.decrypt(b'key', ciphertext, 2000, processes=1)
+        with self.assertRaisesRegex(AssertionError, 'workload'):
+            Container.open(b'key', ciphertext[:5] + b'\xff' * 4 + ciphertext[9:])
+
+    def test_pool_reused(self):
+        message = os.urandom(1000)
+        ciphertext = self.encrypt(message)
+        with Container.open(b'key', ciphertext, 1000, processes=2) as container:
+            items = []
+            for index in range(container.segment_count(len(ciphertext))):
+                start, end, final = container.segment_range(index, len(ciphertext))
+                items.append((index, ciphertext[start:end], final))
+            self.assertEqual(b''.join(container.map_segments('decrypt_segment', items)), message)
+            pool = container._pool
+            self.assertEqual(b''.join(container.map_segments('decrypt_segment', items)), message)
+            self.assertIs(container._pool, pool)
+        self.assertIsNone(container._pool)
+
+
+class TestStreamEnvelope(unittest.TestCase):
+    """
+    Tests the framed, pipelined `encrypt_stream`/`decrypt_stream`.
+    """
+    def encrypt(self, message, chunk_size=64):
+        destination = io.BytesIO()
+        size = encrypt_stream(b'key', io.BytesIO(message), destination, workload=1000, chunk_size=chunk_size)
+        self.assertEqual(size, len(message))
+        return destination.getvalue()
+
+    def decrypt(self, ciphertext):
+        destination = io.BytesIO()
+        decrypt_stream(b'key', io.BytesIO(ciphertext), destination, workload=1000, chunk_size=64)
+        return destination.getvalue()
+
+    def frames(self, ciphertext):
+        frames = []
+        while ciphertext:
+            length = 4 + int.from_bytes(ciphertext[:4], 'big')
+            frames.append(ciphertext[:length])
+            ciphertext = ciphertext[length:]
+        return frames
+
+    def test_success(self):
+        for length in (0, 1, 63, 64, 65, 1000):
+            message = os.urandom(length)
+            self.assertEqual(self.decrypt(self.encrypt(message)), message, length)
+
+    def test_chunks(self):
+        self.assertEqual(len(self.frames(self.encrypt(b'M' * 640))), 10)
+        self.assertEqual(len(self.frames(self.encrypt(b''))), 1)
+
+    def test_progress(self):
+        done = []
+        encrypt_stream(b'key', io.BytesIO(bytes(200)), io.BytesIO(), workload=1000,
+                       chunk_size=64, progress=done.append)
+        self.assertEqual(done, [64, 128, 192, 200])
+
+    def test_truncation_and_reordering(self):
+        frames = self.frames(self.encrypt(os.urandom(300)))
+        for bad in (frames[:-1], frames[1:], [frames[1], frames[0]] + frames[2:],
+                    frames + frames[-1:], frames[:2] + [frames[-1][:-1]]):
+            with self.assertRaises(AssertionError):
+                self.decrypt(b''.join(bad))
+
+    def test_splicing(self):
+        # Frames from another stream under the same password are refused.
+        first = self.frames(self.encrypt(bytes(200)))
+        second = self.frames(self.encrypt(bytes(200)))
+        with self.assertRaises(AssertionError):
+            self.decrypt(b''.join(first[:2] + second[2:]))
+
+    def test_untrusted_header(self):
+        # Neither the workload nor the frame length is trusted before the
+        # first record has been authenticated.
+        ciphertext = self.encrypt(bytes(200))
+        with self.assertRaisesRegex(AssertionError, 'workload'):
+            decrypt_stream(b'key', io.BytesIO(ciphertext), io.BytesIO(), workload=2000)
+        huge = (1 << 32) - 1
+        with self.assertRaisesRegex(AssertionError, 'longer'):
+            self.decrypt(huge.to_bytes(4, 'big') + ciphertext[4:])
+        # A larger chunk size than the writer's is fine.
+        destination = io.BytesIO()
+        decrypt_stream(b'key', io.BytesIO(ciphertext), destination, workload=1000, chunk_size=128)
+        self.assertEqual(destination.getvalue(), bytes(200))
+
+    def test_writer_error(self):
+        class Broken(io.BytesIO):
+            def write(self, data):
+                raise IOError('disk full')
+        with self.assertRaises(IOError):
+            encrypt_stream(b'key', io.BytesIO(bytes(10000)), Broken(), workload=1000, chunk_size=16)
+
+    def test_command_line(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aes.py')
+        message = os.urandom(100000)
+        encrypted = subprocess.run([sys.executable, script, 'encrypt-stream', 'key'], input=message,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        self.assertIn(b'MB/s', encrypted.stderr)
+        decrypted = subprocess.run([sys.executable, script, 'decrypt-stream', 'key'], input=encrypted.stdout,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        self.assertEqual(decrypted.stdout, message)
+
+
+class TestAsync(unittest.TestCase):
+    """
+    Tests the asyncio wrappers in `aes_async`.
+    """
+    def setUp(self):
+        self.crypto = AsyncAES(max_concurrency=2, depth=2)
+
+    def encrypt_stream(self, message, chunk_size=64):
+        async def source():
+            for i in range(0, len(message), 10):
+                yield message[i:i + 10]
+
+        async def collect():
+            return b''.join([frame async for frame in
+                             self.crypto.encrypt_stream(b'key', source(), 1000, chunk_size)])
+        return asyncio.run(collect())
+
+    def decrypt_stream(self, ciphertext):
+        async def collect():
+            reader = asyncio.StreamReader()
+            reader.feed_data(ciphertext)
+            reader.feed_eof()
+            return b''.join([chunk async for chunk in self.crypto.decrypt_stream(b'key', reader, 1000, 64)])
+        return asyncio.run(collect())
+
+    def test_success(self):
+        async def run():
+            ciphertext = await aes_async.encrypt(b'key', b'message', 1000)
+            self.assertEqual(await aes_async.decrypt(b'key', ciphertext, 1000), b'message')
+            ciphertexts = await asyncio.gather(*[self.crypto.encrypt(b'key', bytes([i]) * 40, 1000, 'gcm')
+                                                 for i in range(6)])
+            for i, ciphertext in enumerate(ciphertexts):
+                self.assertEqual(decrypt(b'key', ciphertext, 1000, 'gcm'), bytes([i]) * 40)
+        asyncio.run(run())
+
+    def test_loop_not_blocked(self):
+        # Other tasks keep running while the key is stretched.
+        async def run():
+            ticks = 0
+            job = asyncio.ensure_future(self.crypto.encrypt(b'key', b'message', 200000))
+            while not job.done():
+                ticks += 1
+                await asyncio.sleep(0.001)
+            await job
+            return ticks
+        self.assertGreater(asyncio.run(run()), 5)
+
+    def test_bounded_concurrency(self):
+        running = []
+        peak = []
+
+        def work(i):
+            running.append(i)
+            peak.append(len(running))
+            time.sleep(0.01)
+            running.remove(i)
+            return i
+
+        async def run():
+            return await asyncio.gather(*[self.crypto.run(work, i) for i in range(10)])
+        self.assertEqual(asyncio.run(run()), list(range(10)))
+        self.assertLessEqual(max(peak), 2)
+
+    def test_stream(self):
+        for length in (0, 1, 64, 65, 1000):
+            message = os.urandom(length)
+            ciphertext = self.encrypt_stream(message)
+            self.assertEqual(self.decrypt_stream(ciphertext), message, length)
+            # Same format as the synchronous stream functions.
+            destination = io.BytesIO()
+            decrypt_stream(b'key', io.BytesIO(ciphertext), destination, workload=1000)
+            self.assertEqual(destination.getvalue(), message)
+
+    def test_stream_tampering(self):
+        ciphertext = self.encrypt_stream(os.urandom(300))
+        for bad in (b'', ciphertext[:-1], ciphertext[:-100], ciphertext + ciphertext[-50:],
+                    b'\xff' * 4 + ciphertext[4:]):
+            with self.assertRaises(AssertionError):
+                self.decrypt_stream(bad)
+
+        async def wrong_workload():
+            reader = asyncio.StreamReader()
+            reader.feed_data(ciphertext)
+            reader.feed_eof()
+            async for chunk in self.crypto.decrypt_stream(b'key', reader, 2000, 64):
+                pass
+        with self.assertRaisesRegex(AssertionError, 'workload'):
+            asyncio.run(wrong_workload())
+
+    def test_backpressure(self):
+        # Chunks are only read a few steps ahead of the consumer.
+        consumed = []
+
+        async def source():
+            for i in range(100):
+                consumed.append(i)
+                yield bytes(16)
+
+        async def run():
+            frames = self.crypto.encrypt_stream(b'key', source(), 1000, 16)
+            await frames.__anext__()
+            await frames.aclose()
+        asyncio.run(run())
+        self.assertLess(len(consumed), 10)
+
+    def test_process_pool(self):
+        with ProcessPoolExecutor(2) as executor:
+            self.crypto = AsyncAES(executor, max_concurrency=2)
+            message = os.urandom(500)
+            self.assertEqual(self.decrypt_stream(self.encrypt_stream(message)), message)
+
+            async def run():
+                return await self.crypto.decrypt(b'key', await self.crypto.encrypt(b'key', message, 1000), 1000)
+            self.assertEqual(asyncio.run(run()), message)
+
 
 def run():
     unittest.main()
@@ -0,0 +1,471 @@
+"""
+Python bindings for the compiled rijndael library.
+
+The shared library is loaded once per process and its function prototypes
+are declared once, so callers only deal with the `AES` class below. It has
+the same methods as `aes.AES` (the pure-Python implementation in the aes
+submodule) and switches to it transparently when the library cannot be
+loaded.
+
+    import aes_native
+    cipher = aes_native.AES(key)
+    ciphertext = cipher.encrypt_ctr(message, iv)
+"""
+
+import ctypes
+import os
+import platform
+import sys
+
+project_root = os.path.abspath(os.path.dirname(__file__))
+aes_path = os.path.join(project_root, 'aes')
+if aes_path not in sys.path:
+    sys.path.insert(0, aes_path)
+
+from aes import AES as PyAES, pad, output_buffer, finish_output, unpadded_size, pack_block, unpack_block
+
+LIBRARY_NAME = 'rijndael.dll' if platform.system() == 'Windows' else 'rijndael.so'
+
+_lib = None
+_load_attempted = False
+
+
+def _declare_prototypes(lib):
+    """
+    Declares argument and return types for every exported function. Buffers
+    are plain void pointers so that bytes objects and ctypes views created
+    with `from_buffer` can be passed without copying.
+    """
+    void_p, size_t = ctypes.c_void_p, ctypes.c_size_t
+
+    lib.aes_context_new.argtypes = [void_p]
+    lib.aes_context_new.restype = void_p
+    lib.aes_context_new_keylen.argtypes = [void_p, size_t]
+    lib.aes_context_new_keylen.restype = void_p
+    lib.aes_context_free.argtypes = [void_p]
+    lib.aes_context_free.restype = None
+
+    for name in ('aes_context_encrypt_block', 'aes_context_decrypt_block'):
+        func = getattr(lib, name)
+        func.argtypes = [void_p, void_p, void_p]
+        func.restype = None
+
+    for name in ('aes_ecb_encrypt', 'aes_ecb_decrypt'):
+        func = getattr(lib, name)
+        func.argtypes = [void_p, void_p, void_p, size_t]
+        func.restype = None
+
+    for name in ('aes_cbc_encrypt', 'aes_cbc_decrypt', 'aes_ctr_crypt', 'aes_pcbc_encrypt',
+                 'aes_pcbc_decrypt', 'aes_cfb_encrypt', 'aes_cfb_decrypt', 'aes_ofb_crypt'):
+        func = getattr(lib, name)
+        func.argtypes = [void_p, void_p, void_p, void_p, size_t]
+        func.restype = None
+
+    lib.aes_ctr_crypt_parallel.argtypes = [void_p, void_p, void_p, void_p, size_t, ctypes.c_int]
+    lib.aes_ctr_crypt_parallel.restype = None
+
+    lib.aes_force_portable.argtypes = [ctypes.c_int]
+    lib.aes_force_portable.restype = ctypes.c_int
+    lib.aes_implementation.argtypes = []
+    lib.aes_implementation.restype = ctypes.c_char_p
+
+    lib.aes_stats_enabled.argtypes = []
+    lib.aes_stats_enabled.restype = ctypes.c_int
+    lib.aes_stats_count.argtypes = []
+    lib.aes_stats_count.restype = size_t
+    lib.aes_stats_name.argtypes = [size_t]
+    lib.aes_stats_name.restype = ctypes.c_char_p
+    lib.aes_stats_value.argtypes = [size_t]
+    lib.aes_stats_value.restype = ctypes.c_ulonglong
+    lib.aes_stats_reset.argtypes = []
+    lib.aes_stats_reset.restype = None
+
+
+def load_library(path=None):
+    """
+    Loads the rijndael shared library and returns it, or None if it is not
+    available. The result is cached, so only the first call touches the
+    filesystem. The location can be overridden with the RIJNDAEL_LIBRARY
+    environment variable.
+    """
+    global _lib, _load_attempted
+    if _load_attempted and path is None:
+        return _lib
+
+    if path is None:
+        path = os.environ.get('RIJNDAEL_LIBRARY', os.path.join(project_root, LIBRARY_NAME))
+    _load_attempted = True
+    try:
+        lib = ctypes.cdll.LoadLibrary(path)
+        _declare_prototypes(lib)
+    except (OSError, AttributeError):
+        # Missing file, or an older build without the context/bulk API.
+        lib = None
+    _lib = lib
+    return _lib
+
+
+def available():
+    """ Returns True if the compiled library could be loaded. """
+    return load_library() is not None
+
+
+def implementation():
+    """
+    Returns the name of the code the library runs on, 'aesni' or
+    'portable', or None if the library is not available.
+    """
+    lib = load_library()
+    return lib.aes_implementation().decode() if lib is not None else None
+
+
+def force_portable(force=True):
+    """
+    Makes the library use its portable C code even if the CPU has AES-NI
+    (or, with force=False, go back to picking AES-NI when available).
+    Returns True if AES-NI is in use afterwards. Meant for tests and
+    benchmarks; do not call it while other threads are encrypting.
+    """
+    lib = load_library()
+    return lib is not None and bool(lib.aes_force_portable(int(force)))
+
+
+def stats():
+    """
+    Returns the library's instrumentation counters as a dict (name to
+    value), such as 'key_expansions', 'ctr_blocks' or 'cipher_ns'. It is
+    empty unless the library was built with `make stats` (-DRIJNDAEL_STATS),
+    and None if the library is not available.
+    """
+    lib = load_library()
+    if lib is None:
+        return None
+    return {lib.aes_stats_name(i).decode(): lib.aes_stats_value(i)
+            for i in range(lib.aes_stats_count())}
+
+
+def reset_stats():
+    """ Sets every instrumentation counter back to zero. """
+    lib = load_library()
+    if lib is not None:
+        lib.aes_stats_reset()
+
+
+def _input_pointer(data):
+    """
+    Returns something ctypes accepts as a `const void *` for `data`, without
+    copying when possible. Bytes are passed as-is, writable buffers through a
+    `from_buffer` view, and anything else is copied to bytes.
+    """
+    if isinstance(data, bytes):
+        return data
+    view = memoryview(data)
+    if not view.readonly and view.contiguous:
+        return (ctypes.c_char * view.nbytes).from_buffer(view.cast('B'))
+    return bytes(view)
+
+
+def _output_pointer(view):
+    """ A ctypes view of the writable byte memoryview `view`, for output arguments. """
+    return (ctypes.c_char * len(view)).from_buffer(view)
+
+
+class AES(PyAES):
+    """
+    Drop-in replacement for `aes.AES` backed by the rijndael C library.
+
+    Single blocks and every block mode run entirely in C on a key schedule
+    expanded once in the constructor; GCM reuses the pure-Python mode logic
+    on top of native block encryption. If the library is missing, every
+    method falls back to the pure-Python implementation.
+    """
+    def __init__(self, master_key, engine='matrix', threads=1):
+        """
+        Initializes the object with a given key.
+
+        `engine` is only used by the pure-Python fallback. `threads` is the
+        number of threads used for CTR mode (0 for one per CPU).
+        """
+        self._ctx = None
+        self.threads = threads
+        lib = load_library()
+        if lib is None:
+            super().__init__(master_key, engine)
+            return
+
+        assert engine in PyAES.engines
+        assert len(master_key) in PyAES.rounds_by_key_size
+        self.n_rounds = PyAES.rounds_by_key_size[len(master_key)]
+        self.engine = engine
+        self._batch = None
+        self._lib = lib
+        self._ctx = lib.aes_context_new_keylen(bytes(master_key), len(master_key))
+        if not self._ctx:
+            raise MemoryError('aes_context_new_keylen failed')
+
+    @property
+    def native(self):
+        """ True if this object runs on the C library. """
+        return self._ctx is not None
+
+    def __del__(self):
+        if getattr(self, '_ctx', None):
+            self._lib.aes_context_free(self._ctx)
+            self._ctx = None
+
+    def _encrypt_words(self, s0, s1, s2, s3):
+        """
+        One native block encryption on words, for the modes inherited from
+        `aes.AES` (GCM).
+        """
+        if self._ctx is None:
+            return super()._encrypt_words(s0, s1, s2, s3)
+        block = ctypes.create_string_buffer(pack_block(s0, s1, s2, s3), 16)
+        self._lib.aes_context_encrypt_block(self._ctx, block, block)
+        return unpack_block(block.raw)
+
+    def _decrypt_words(self, s0, s1, s2, s3):
+        if self._ctx is None:
+            return super()._decrypt_words(s0, s1, s2, s3)
+        block = ctypes.create_string_buffer(pack_block(s0, s1, s2, s3), 16)
+        self._lib.aes_context_decrypt_block(self._ctx, block, block)
+        return unpack_block(block.raw)
+
+    def encrypt_block(self, plaintext, out=None):
+        """
+        Encrypts a single block of 16 byte long plaintext.
+        """
+        if self._ctx is None:
+            return super().encrypt_block(plaintext, out)
+        assert len(plaintext) == 16
+
+        if out is None:
+            output = ctypes.create_string_buffer(16)
+            self._lib.aes_context_encrypt_block(self._ctx, _input_pointer(plaintext), output)
+            return output.raw
+        _, view = output_buffer(out, 16)
+        self._lib.aes_context_encrypt_block(self._ctx, _input_pointer(plaintext), _output_pointer(view))
+        return 16
+
+    def decrypt_block(self, ciphertext, out=None):
+        """
+        Decrypts a single block of 16 byte long ciphertext.
+        """
+        if self._ctx is None:
+            return super().decrypt_block(ciphertext, out)
+        assert len(ciphertext) == 16
+
+        if out is None:
+            output = ctypes.create_string_buffer(16)
+            self._lib.aes_context_decrypt_block(self._ctx, _input_pointer(ciphertext), output)
+            return output.raw
+        _, view = output_buffer(out, 16)
+        self._lib.aes_context_decrypt_block(self._ctx, _input_pointer(ciphertext), _output_pointer(view))
+        return 16
+
+    def encrypt_ecb(self, plaintext, out=None):
+        """
+        Encrypts a whole number of independent blocks, without padding.
+        """
+        if self._ctx is None:
+            return super().encrypt_ecb(plaintext, out)
+        assert len(plaintext) % 16 == 0
+
+        size = len(plaintext)
+        buffer, view = output_buffer(out, size)
+        self._lib.aes_ecb_encrypt(self._ctx, _input_pointer(plaintext), _output_pointer(view), size // 16)
+        return finish_output(out, buffer, size)
+
+    def decrypt_ecb(self, ciphertext, out=None):
+        """
+        Decrypts a whole number of independent blocks, without padding.
+        """
+        if self._ctx is None:
+            return super().decrypt_ecb(ciphertext, out)
+        assert len(ciphertext) % 16 == 0
+
+        size = len(ciphertext)
+        buffer, view = output_buffer(out, size)
+        self._lib.aes_ecb_decrypt(self._ctx, _input_pointer(ciphertext), _output_pointer(view), size // 16)
+        return finish_output(out, buffer, size)
+
+    def encrypt_cbc(self, plaintext, iv, out=None):
+        """
+        Encrypts `plaintext` using CBC mode and PKCS#7 padding, with the given
+        initialization vector (iv).
+        """
+        if self._ctx is None:
+            return super().encrypt_cbc(plaintext, iv, out)
+        assert len(iv) == 16
+
+        full = len(plaintext) - len(plaintext) % 16
+        size = full + 16
+        buffer, view = output_buffer(out, size)
+        chain = ctypes.create_string_buffer(bytes(iv), 16)
+        # Whole blocks straight from the input, then the padded last block,
+        # so the message is never copied to add the padding.
+        if full:
+            self._lib.aes_cbc_encrypt(self._ctx, chain, _input_pointer(plaintext), _output_pointer(view), full // 16)
+        last = pad(bytes(plaintext[full:]))
+        self._lib.aes_cbc_encrypt(self._ctx, chain, last, _output_pointer(view[full:size]), 1)
+        return finish_output(out, buffer, size)
+
+    def decrypt_cbc(self, ciphertext, iv, out=None):
+        """
+        Decrypts `ciphertext` using CBC mode and PKCS#7 padding, with the given
+        initialization vector (iv).
+        """
+        if self._ctx is None:
+            return super().decrypt_cbc(ciphertext, iv, out)
+        assert len(iv) == 16
+        assert len(ciphertext) % 16 == 0
+
+        size = len(ciphertext)
+        buffer, view = output_buffer(out, size)
+        chain = ctypes.create_string_buffer(bytes(iv), 16)
+        self._lib.aes_cbc_decrypt(self._ctx, chain, _input_pointer(ciphertext), _output_pointer(view), size // 16)
+        return finish_output(out, buffer, unpadded_size(view, size))
+
+    def decrypt_cbc_blocks(self, ciphertext, iv, out=None):
+        """
+        Decrypts whole CBC blocks without removing padding, see
+        `aes.AES.decrypt_cbc_blocks`.
+        """
+        if self._ctx is None:
+            return super().decrypt_cbc_blocks(ciphertext, iv, out)
+        assert len(iv) == 16
+        assert len(ciphertext) % 16 == 0
+
+        size = len(ciphertext)
+        buffer, view = output_buffer(out, size)
+        chain = ctypes.create_string_buffer(bytes(iv), 16)
+        self._lib.aes_cbc_decrypt(self._ctx, chain, _input_pointer(ciphertext), _output_pointer(view), size // 16)
+        return finish_output(out, buffer, size)
+
+    def encrypt_pcbc(self, plaintext, iv, out=None):
+        """
+        Encrypts `plaintext` using PCBC mode and PKCS#7 padding, with the given
+        initialization vector (iv).
+        """
+        if self._ctx is None:
+            return super().encrypt_pcbc(plaintext, iv, out)
+        assert len(iv) == 16
+
+        full = len(plaintext) - len(plaintext) % 16
+        size = full + 16
+        buffer, view = output_buffer(out, size)
+        chain = ctypes.create_string_buffer(bytes(iv), 16)
+        if full:
+            self._lib.aes_pcbc_encrypt(self._ctx, chain, _input_pointer(plaintext), _output_pointer(view), full // 16)
+        last = pad(bytes(plaintext[full:]))
+        self._lib.aes_pcbc_encrypt(self._ctx, chain, last, _output_pointer(view[full:size]), 1)
+        return finish_output(out, buffer, size)
+
+    def decrypt_pcbc(self, ciphertext, iv, out=None):
+        """
+        Decrypts `ciphertext` using PCBC mode and PKCS#7 padding, with the given
+        initialization vector (iv).
+        """
+        if self._ctx is None:
+            return super().decrypt_pcbc(ciphertext, iv, out)
+        assert len(iv) == 16
+        assert len(ciphertext) % 16 == 0
+
+        size = len(ciphertext)
+        buffer, view = output_buffer(out, size)
+        chain = ctypes.create_string_buffer(bytes(iv), 16)
+        self._lib.aes_pcbc_decrypt(self._ctx, chain, _input_pointer(ciphertext), _output_pointer(view), size // 16)
+        return finish_output(out, buffer, unpadded_size(view, size))
+
+    def _crypt_stream(self, crypt, data, iv, out):
+        """
+        Runs the native CFB or OFB function `crypt` over `data`. Both XOR the
+        last partial block with the first bytes of one more keystream block.
+        """
+        assert len(iv) == 16
+
+        full_blocks, tail = divmod(len(data), 16)
+        buffer, view = output_buffer(out, len(data))
+        chain = ctypes.create_string_buffer(bytes(iv), 16)
+        if full_blocks:
+            crypt(self._ctx, chain, _input_pointer(data), _output_pointer(view), full_blocks)
+        if tail:
+            last = ctypes.create_string_buffer(bytes(data[16 * full_blocks:]), 16)
+            crypt(self._ctx, chain, last, last, 1)
+            view[16 * full_blocks:len(data)] = last.raw[:tail]
+        return finish_output(out, buffer, len(data))
+
+    def encrypt_cfb(self, plaintext, iv, out=None):
+        """
+        Encrypts `plaintext` with the given initialization vector (iv).
+        """
+        if self._ctx is None:
+            return super().encrypt_cfb(plaintext, iv, out)
+        return self._crypt_stream(self._lib.aes_cfb_encrypt, plaintext, iv, out)
+
+    def decrypt_cfb(self, ciphertext, iv, out=None):
+        """
+        Decrypts `ciphertext` with the given initialization vector (iv).
+        """
+        if self._ctx is None:
+            return super().decrypt_cfb(ciphertext, iv, out)
+        return self._crypt_stream(self._lib.aes_cfb_decrypt, ciphertext, iv, out)
+
+    def encrypt_ofb(self, plaintext, iv, out=None):
+        """
+        Encrypts `plaintext` using OFB mode initialization vector (iv).
+        """
+        if self._ctx is None:
+            return super().encrypt_ofb(plaintext, iv, out)
+        return self._crypt_stream(self._lib.aes_ofb_crypt, plaintext, iv, out)
+
+    def decrypt_ofb(self, ciphertext, iv, out=None):
+        """
+        Decrypts `ciphertext` using OFB mode initialization vector (iv).
+        """
+        if self._ctx is None:
+            return super().decrypt_ofb(ciphertext, iv, out)
+        return self._crypt_stream(self._lib.aes_ofb_crypt, ciphertext, iv, out)
+
+    def _crypt_ctr(self, data, iv, out):
+        """
+        CTR keystream XOR, shared by encryption and decryption.
+        """
+        assert len(iv) == 16
+
+        full_blocks, tail = divmod(len(data), 16)
+        buffer, view = output_buffer(out, len(data))
+        counter = ctypes.create_string_buffer(bytes(iv), 16)
+        source = _input_pointer(data)
+        if full_blocks:
+            output = _output_pointer(view)
+            if self.threads == 1:
+                self._lib.aes_ctr_crypt(self._ctx, counter, source, output, full_blocks)
+            else:
+                self._lib.aes_ctr_crypt_parallel(self._ctx, counter, source, output, full_blocks, self.threads)
+
+        if tail:
+            # Run the last partial block through a zero-padded scratch block.
+            last = ctypes.create_string_buffer(bytes(data[16 * full_blocks:]), 16)
+            self._lib.aes_ctr_crypt(self._ctx, counter, last, last, 1)
+            view[16 * full_blocks:len(data)] = last.raw[:tail]
+        return finish_output(out, buffer, len(data))
+
+    def encrypt_ctr(self, plaintext, iv, out=None):
+        """
+        Encrypts `plaintext` using CTR mode with the given nounce/IV.
+        """
+        if self._ctx is None:
+            return super().encrypt_ctr(plaintext, iv, out)
+        return self._crypt_ctr(plaintext, iv, out)
+
+    def decrypt_ctr(self, ciphertext, iv, out=None):
+        """
+        Decrypts `ciphertext` using CTR mode with the given nounce/IV.
+        """
+        if self._ctx is None:
+            return super().decrypt_ctr(ciphertext, iv, out)
+        return self._crypt_ctr(ciphertext, iv, out)
+
+__all__ = ["AES", "available", "load_library", "implementation", "force_portable",
+           "stats", "reset_stats"]
@@ -0,0 +1,346 @@
+"""
+Throughput and latency benchmarks for every AES backend in this repository.
+
+Each case (single blocks, key expansion, the block modes and the
+password-based `encrypt`/`decrypt` envelope) is timed on every available
+backend: the pure-Python engines of `aes.AES` and the compiled rijndael
+library through `aes_native`, on AES-NI and on the portable C code. Results
+are reported as MB/s, ns per block and p50/p99 latency per call.
+
+    python3 benchmark.py                          # default sizes, table output
+    python3 benchmark.py --sizes 16,4K,1M,1G --json results.json
+    python3 benchmark.py --baseline results.json  # exit status 1 on regressions
+
+Large messages are skipped on a backend when a smaller size already shows
+they would take longer than `--budget` seconds per call, so the slow Python
+engines do not hold up a run that includes 1 GB messages.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from collections import OrderedDict
+
+import aes_native  # also puts aes/ on the import path
+import aes
+from aes import AES as PyAES
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MODES = ('cbc', 'pcbc', 'cfb', 'ofb', 'ctr')
+DEFAULT_SIZES = (16, 1 << 10, 1 << 16, 1 << 20)
+KEY_SIZES = (16, 24, 32)
+UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+
+class Backend:
+    """
+    A named way of building `AES` objects. `activate`, if given, is called
+    before each case runs (to switch the C library between AES-NI and the
+    portable code).
+    """
+    def __init__(self, name, factory, activate=None):
+        self.name = name
+        self.factory = factory
+        self.activate = activate
+
+    def __call__(self, key):
+        return self.factory(key)
+
+
+def available_backends():
+    """ Returns every backend that can run here, in a fixed order. """
+    backends = [Backend('python-matrix', PyAES),
+                Backend('python-table', lambda key: PyAES(key, engine='table'))]
+    if numpy is not None:
+        backends.append(Backend('python-numpy', lambda key: PyAES(key, engine='numpy')))
+    if aes_native.available():
+        if aes_native.force_portable(False):
+            backends.append(Backend('native-aesni', aes_native.AES,
+                                    lambda: aes_native.force_portable(False)))
+        backends.append(Backend('native-portable', aes_native.AES,
+                                lambda: aes_native.force_portable(True)))
+        aes_native.force_portable(False)
+    return backends
+
+
+def parse_size(text):
+    """ Parses a size such as '16', '4K', '1M' or '1G' into bytes. """
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in UNITS else ''
+    return int(text[:len(text) - len(unit)]) * UNITS[unit]
+
+
+def format_size(size):
+    for unit in ('G', 'M', 'K'):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return '{}{}'.format(size // UNITS[unit], unit)
+    return str(size)
+
+
+def make_message(size):
+    """ Returns `size` random-looking bytes without drawing 1 GB of entropy. """
+    chunk = os.urandom(min(size, 1 << 20))
+    return (chunk * (size // len(chunk) + 1))[:size] if size else b''
+
+
+def percentile(sorted_values, fraction):
+    """ Nearest-rank percentile of an already sorted list. """
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def measure(func, min_time=0.2, min_samples=5, max_samples=100000):
+    """
+    Calls `func` repeatedly, timing each call, until at least `min_time`
+    seconds and `min_samples` calls have passed. Returns the sorted
+    per-call durations in nanoseconds.
+    """
+    samples = []
+    clock = time.perf_counter_ns
+    deadline = clock() + int(min_time * 1e9)
+    while len(samples) < max_samples and (len(samples) < min_samples or clock() < deadline):
+        start = clock()
+        func()
+        samples.append(clock() - start)
+    samples.sort()
+    return samples
+
+
+def summarize(case, backend, size, samples, key_size=16, blocks=None):
+    """ Builds one result record from the sorted per-call samples. """
+    p50 = percentile(samples, 0.50)
+    blocks = blocks if blocks is not None else max(1, -(-size // 16))
+    return OrderedDict([
+        ('case', case),
+        ('backend', backend),
+        ('size', size),
+        ('key_size', key_size),
+        ('samples', len(samples)),
+        ('mb_per_s', size / p50 * 1e3 if p50 else 0.0),
+        ('ns_per_block', p50 / blocks),
+        ('p50_ns', p50),
+        ('p99_ns', percentile(samples, 0.99)),
+    ])
+
+
+def _skipped(case, backend, size):
+    return OrderedDict([('case', case), ('backend', backend), ('size', size),
+                        ('key_size', 16), ('skipped', True)])
+
+
+def _predict(points, size):
+    """
+    Predicts the cost in ns of a call at `size` from measured (size, ns)
+    points, as a fixed cost plus a cost per byte fitted to the last two.
+    """
+    (size_a, cost_a), (size_b, cost_b) = points[-2:]
+    per_byte = max(cost_b - cost_a, 0) / (size_b - size_a)
+    fixed = max(cost_b - per_byte * size_b, 0)
+    return max(fixed + per_byte * size, cost_b)
+
+
+def _size_cases(record, backend, sizes, cases, min_time, budget):
+    """
+    Times `cases`, a list of (name, encrypt, decrypt) where encrypt(message)
+    returns the ciphertext decrypt() takes, at every size. A size is skipped
+    when the fixed and per-byte costs seen so far predict more than `budget`
+    seconds per call (the smallest size always runs). The time for an empty
+    message is the first point, so a fixed cost such as a key stretch does
+    not count as per-byte work. Ciphertext is only produced for decryptions
+    that actually run.
+    """
+    points = {}
+
+    def calibrate(case, func):
+        points[case] = [(0, percentile(measure(func, 0, min_samples=3), 0.50))]
+
+    def over_budget(case, size):
+        return len(points[case]) > 1 and _predict(points[case], size) / 1e9 > budget
+
+    def run(case, size, func):
+        if over_budget(case, size):
+            record(_skipped(case, backend, size))
+            return
+        result = summarize(case, backend, size, measure(func, min_time, min_samples=3))
+        if size > points[case][-1][0]:
+            points[case].append((size, result['p50_ns']))
+        record(result)
+
+    for name, encrypt, decrypt in cases:
+        empty = encrypt(b'')
+        calibrate(name + '-encrypt', lambda: encrypt(b''))
+        calibrate(name + '-decrypt', lambda: decrypt(empty))
+
+    for size in sorted(sizes):
+        message = make_message(size)
+        for name, encrypt, decrypt in cases:
+            run(name + '-encrypt', size, lambda: encrypt(message))
+            if over_budget(name + '-decrypt', size):
+                record(_skipped(name + '-decrypt', backend, size))
+                continue
+            ciphertext = encrypt(message)
+            run(name + '-decrypt', size, lambda: decrypt(ciphertext))
+
+
+def run_suite(sizes=DEFAULT_SIZES, backends=None, min_time=0.2, budget=2.0,
+              envelope=True, workload=100000, log=None):
+    """
+    Runs every case and returns a list of result records. Skipped
+    (backend, case, size) combinations are recorded with 'skipped' set.
+    `log`, if given, is called with each record as soon as it is ready.
+    """
+    backends = available_backends() if backends is None else backends
+    results = []
+
+    def record(result):
+        results.append(result)
+        if log:
+            log(result)
+
+    key = os.urandom(16)
+    iv = os.urandom(16)
+    block = os.urandom(16)
+    for backend in backends:
+        if backend.activate:
+            backend.activate()
+
+        cipher = backend(key)
+        ciphertext_block = cipher.encrypt_block(block)
+        record(summarize('block-encrypt', backend.name, 16,
+                         measure(lambda: cipher.encrypt_block(block), min_time)))
+        record(summarize('block-decrypt', backend.name, 16,
+                         measure(lambda: cipher.decrypt_block(ciphertext_block), min_time)))
+
+        for key_size in KEY_SIZES:
+            # Fresh keys every call, so no schedule cache can help.
+            count = 100000
+            blob = os.urandom(key_size * count)
+            keys = (blob[i:i+key_size] for i in range(0, len(blob), key_size))
+            record(summarize('key-expansion', backend.name, key_size,
+                             measure(lambda: backend(next(keys)), min_time, max_samples=count),
+                             key_size=key_size, blocks=1))
+
+        cases = []
+        for mode in MODES:
+            encrypt = getattr(cipher, 'encrypt_' + mode)
+            decrypt = getattr(cipher, 'decrypt_' + mode)
+            cases.append((mode, lambda m, e=encrypt: e(m, iv), lambda c, d=decrypt: d(c, iv)))
+        _size_cases(record, backend.name, sizes, cases, min_time, budget)
+
+    if aes_native.available():
+        aes_native.force_portable(False)
+
+    if envelope:
+        # The envelope always runs on aes.AES with the default engine.
+        cases = [('envelope', lambda m: aes.encrypt(key, m, workload),
+                  lambda c: aes.decrypt(key, c, workload))]
+        _size_cases(record, 'python-matrix', sizes, cases, min_time, budget)
+    return results
+
+
+def environment():
+    """ Describes the machine and build the numbers came from. """
+    return OrderedDict([
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('machine', platform.machine()),
+        ('numpy', numpy.__version__ if numpy is not None else None),
+        ('native', aes_native.implementation()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S%z')),
+    ])
+
+
+def _result_key(result):
+    return (result['case'], result['backend'], result['size'], result['key_size'])
+
+
+def compare(results, baseline, tolerance=0.10):
+    """
+    Compares results with a baseline (a list of records, as stored by
+    `--json`). Returns (result, baseline_result, ratio) for every measured
+    case whose throughput fell below (1 - tolerance) times the baseline.
+    """
+    previous = {_result_key(r): r for r in baseline if not r.get('skipped')}
+    regressions = []
+    for result in results:
+        old = previous.get(_result_key(result))
+        if result.get('skipped') or old is None or not old['mb_per_s']:
+            continue
+        ratio = result['mb_per_s'] / old['mb_per_s']
+        if ratio < 1 - tolerance:
+            regressions.append((result, old, ratio))
+    return regressions
+
+
+def format_label(result):
+    return '{:<17} {:<16} {:>6}'.format(result['case'], result['backend'], format_size(result['size']))
+
+
+def format_result(result):
+    """ One fixed-width table row. """
+    name = format_label(result)
+    if result.get('skipped'):
+        return name + '   skipped (over time budget)'
+    return name + ' {:>11.2f} MB/s {:>12.1f} ns/block  p50 {:>12} ns  p99 {:>12} ns'.format(
+        result['mb_per_s'], result['ns_per_block'], result['p50_ns'], result['p99_ns'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the AES backends.')
+    parser.add_argument('--sizes', default=','.join(format_size(s) for s in DEFAULT_SIZES),
+                        help='comma-separated message sizes, e.g. 16,1K,1M,1G')
+    parser.add_argument('--backends', help='comma-separated backend names (default: all available)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='seconds to spend timing each case')
+    parser.add_argument('--budget', type=float, default=2.0,
+                        help='skip sizes expected to take longer than this many seconds per call')
+    parser.add_argument('--workload', type=int, default=100000,
+                        help='PBKDF2 iterations for the envelope cases')
+    parser.add_argument('--no-envelope', action='store_true', help='skip encrypt()/decrypt()')
+    parser.add_argument('--json', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='allowed throughput drop against the baseline (fraction)')
+    args = parser.parse_args(argv)
+
+    backends = available_backends()
+    if args.backends:
+        wanted = args.backends.split(',')
+        unknown = set(wanted) - {b.name for b in backends}
+        if unknown:
+            parser.error('unavailable backends: ' + ', '.join(sorted(unknown)))
+        backends = [b for b in backends if b.name in wanted]
+
+    sizes = [parse_size(s) for s in args.sizes.split(',')]
+    results = run_suite(sizes, backends, args.min_time, args.budget,
+                        not args.no_envelope, args.workload,
+                        log=lambda r: print(format_result(r), flush=True))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for result, old, ratio in regressions:
+            print('REGRESSION {}: {:.2f} MB/s, baseline {:.2f} MB/s ({:.0%})'.format(
+                format_label(result), result['mb_per_s'], old['mb_per_s'], ratio))
+        if regressions:
+            return 1
+        print('No regressions against', args.baseline)
+    return 0
+
+
+__all__ = ["run_suite", "compare", "available_backends", "Backend", "measure", "summarize"]
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,138 @@
 /*
  * Name: [Denis Muriuki]
  * Student Number: [D22127693]
- * Description: Implementation of AES-128 (Rijndael) block cipher in C,
- * providing encryption and decryption for 16-byte blocks using a 16-byte key.
+ * Description: Implementation of AES (Rijndael) block cipher in C,
+ * providing encryption and decryption for 16-byte blocks using a 16-, 24-
+ * or 32-byte key (AES-128, AES-192 and AES-256).
  * Includes all AES operations (SubBytes, ShiftRows, MixColumns, AddRoundKey,
  * and inverses) and key expansion, with no external dependencies.
  */
 
 #include "rijndael.h"
 
+#include <pthread.h>
+#include <stdint.h>
 #include <stdlib.h>
 #include <string.h>
+#include <unistd.h>
+
+#if (defined(__x86_64__) || defined(__i386__)) && \
+    (defined(__GNUC__) || defined(__clang__)) && !defined(RIJNDAEL_NO_AESNI)
+#define HAVE_AESNI 1
+#include <cpuid.h>
+#include <wmmintrin.h>
+#endif
+
+/* AES-128 schedule: 10 rounds, 176 bytes (11 round keys) */
+#define ROUNDS 10
+#define EXPANDED_KEY_SIZE (16 * (ROUNDS + 1))
+
+/* AES-256 needs the most: 14 rounds, 240 bytes (15 round keys) */
+#define MAX_ROUNDS 14
+#define MAX_EXPANDED_KEY_SIZE (16 * (MAX_ROUNDS + 1))
+
+/* Blocks processed together by the bitsliced kernel */
+#define BITSLICE_BLOCKS 8
+
+/*
+ * Portable code variants. By default blocks go through 32-bit T-tables.
+ * -DRIJNDAEL_REFERENCE (make reference) uses the byte-oriented round
+ * functions instead, and -DRIJNDAEL_CONSTANT_TIME (make constant-time)
+ * runs every portable operation on the bitsliced kernel, and the key
+ * expansion S-box on the bitsliced S-box, so that no memory access depends
+ * on the key or the data. That build is about three times slower than the
+ * T-tables for bulk work.
+ */
+#if !defined(RIJNDAEL_REFERENCE) && !defined(RIJNDAEL_CONSTANT_TIME)
+#define RIJNDAEL_TTABLES
+#endif
+
+/*
+ * Optional instrumentation, compiled in with -DRIJNDAEL_STATS (make stats).
+ * Every public entry point counts its calls and blocks, and the time spent
+ * expanding keys and running cipher rounds is accumulated in nanoseconds.
+ * Counters are updated atomically, so threaded CTR is counted correctly;
+ * the time of concurrent calls adds up, like CPU time. Without the option
+ * the macros below expand to nothing and the hot paths are unchanged.
+ */
+#ifdef RIJNDAEL_STATS
+#include <time.h>
+
+enum {
+  STAT_KEY_EXPANSIONS,
+  STAT_KEY_EXPANSION_NS,
+  STAT_CIPHER_NS,
+  STAT_ENCRYPT_BLOCK_CALLS,
+  STAT_DECRYPT_BLOCK_CALLS,
+  STAT_ECB_ENCRYPT_CALLS,
+  STAT_ECB_ENCRYPT_BLOCKS,
+  STAT_ECB_DECRYPT_CALLS,
+  STAT_ECB_DECRYPT_BLOCKS,
+  STAT_CBC_ENCRYPT_CALLS,
+  STAT_CBC_ENCRYPT_BLOCKS,
+  STAT_CBC_DECRYPT_CALLS,
+  STAT_CBC_DECRYPT_BLOCKS,
+  STAT_CTR_CALLS,
+  STAT_CTR_BLOCKS,
+  STAT_CTR_PARALLEL_CALLS,
+  STAT_PCBC_ENCRYPT_CALLS,
+  STAT_PCBC_ENCRYPT_BLOCKS,
+  STAT_PCBC_DECRYPT_CALLS,
+  STAT_PCBC_DECRYPT_BLOCKS,
+  STAT_CFB_ENCRYPT_CALLS,
+  STAT_CFB_ENCRYPT_BLOCKS,
+  STAT_CFB_DECRYPT_CALLS,
+  STAT_CFB_DECRYPT_BLOCKS,
+  STAT_OFB_CALLS,
+  STAT_OFB_BLOCKS,
+  STAT_COUNT
+};
+
+static const char *const stat_names[STAT_COUNT] = {
+    "key_expansions",     "key_expansion_ns",   "cipher_ns",
+    "encrypt_block_calls", "decrypt_block_calls", "ecb_encrypt_calls",
+    "ecb_encrypt_blocks", "ecb_decrypt_calls",  "ecb_decrypt_blocks",
+    "cbc_encrypt_calls",  "cbc_encrypt_blocks", "cbc_decrypt_calls",
+    "cbc_decrypt_blocks", "ctr_calls",          "ctr_blocks",
+    "ctr_parallel_calls", "pcbc_encrypt_calls", "pcbc_encrypt_blocks",
+    "pcbc_decrypt_calls", "pcbc_decrypt_blocks", "cfb_encrypt_calls",
+    "cfb_encrypt_blocks", "cfb_decrypt_calls",  "cfb_decrypt_blocks",
+    "ofb_calls",          "ofb_blocks"};
+
+static uint64_t stats[STAT_COUNT];
+
+static uint64_t stats_now_ns(void) {
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return (uint64_t)now.tv_sec * 1000000000u + (uint64_t)now.tv_nsec;
+}
+
+#define STAT_ADD(stat, n) \
+  __atomic_fetch_add(&stats[stat], (uint64_t)(n), __ATOMIC_RELAXED)
+#define STAT_TIMER_START() uint64_t stat_started = stats_now_ns()
+#define STAT_TIMER_STOP(stat) STAT_ADD(stat, stats_now_ns() - stat_started)
+#else
+#define STAT_ADD(stat, n) ((void)0)
+#define STAT_TIMER_START() ((void)0)
+#define STAT_TIMER_STOP(stat) ((void)0)
+#endif
+
+struct aes_context {
+  /* 10, 12 or 14 for 128-, 192- and 256-bit keys */
+  int rounds;
+  unsigned char round_keys[MAX_EXPANDED_KEY_SIZE];
+#ifdef RIJNDAEL_CONSTANT_TIME
+  /* The same round keys as bit planes, for the bitsliced kernel */
+  uint64_t sliced_keys[MAX_ROUNDS + 1][8];
+#endif
+  /* Equivalent inverse cipher round keys, for AESDEC */
+  unsigned char dec_round_keys[MAX_EXPANDED_KEY_SIZE];
+#ifdef RIJNDAEL_TTABLES
+  /* Round keys as big-endian column words for the T-table rounds */
+  uint32_t enc_words[4 * (MAX_ROUNDS + 1)];
+  uint32_t dec_words[4 * (MAX_ROUNDS + 1)];
+#endif
+};
 
 /* AES S-box for SubBytes */
 static const unsigned char sbox[256] = {
@@ -183,29 +305,477 @@ void invert_mix_columns(unsigned char *block) {
 /*
  * This operation is shared between encryption and decryption
  */
-void add_round_key(unsigned char *block, unsigned char *round_key) {
+void add_round_key(unsigned char *block, const unsigned char *round_key) {
   /* XOR block with round key */
   for (int i = 0; i < BLOCK_SIZE; i++) {
     block[i] ^= round_key[i];
   }
 }
 
+#ifdef RIJNDAEL_CONSTANT_TIME
 /*
- * This function should expand the round key. Given an input,
- * which is a single 128-bit key, it should return a 176-byte
- * vector, containing the 11 round keys one after the other
+ * Bitsliced kernel. Eight blocks are processed at once, as two groups of
+ * four, using nothing but 64-bit AND/XOR/NOT and fixed shifts: there are no
+ * table lookups, so no memory access depends on the key or the data.
+ *
+ * A group of four blocks is held as 8 words, one per bit plane: bit
+ * (4 * i + j) of word b is bit b of byte i of block j. Byte i = 4 * col + row
+ * as in the AES state, so each column is a 16-bit lane of every word, each
+ * row a fixed set of nibbles, and ShiftRows/MixColumns become masks and
+ * rotations of whole words.
  */
-unsigned char *expand_key(unsigned char *cipher_key) {
-  unsigned char *expanded = malloc(176); /* 11 round keys * 16 bytes */
-  if (!expanded) return NULL;
-  memcpy(expanded, cipher_key, 16);
+static void swapmove(uint64_t *a, uint64_t *b, uint64_t mask, int n) {
+  uint64_t t = ((*a >> n) ^ *b) & mask;
+  *b ^= t;
+  *a ^= t << n;
+}
+
+/* Transposes the 8x8 bit matrix in every byte lane of 8 words (involution) */
+static void bitslice_transpose(uint64_t *q) {
+  for (int k = 0; k < 8; k += 2)
+    swapmove(&q[k], &q[k + 1], 0x5555555555555555ULL, 1);
+  for (int k = 0; k < 8; k += 4) {
+    swapmove(&q[k], &q[k + 2], 0x3333333333333333ULL, 2);
+    swapmove(&q[k + 1], &q[k + 3], 0x3333333333333333ULL, 2);
+  }
+  for (int k = 0; k < 4; k++)
+    swapmove(&q[k], &q[k + 4], 0x0F0F0F0F0F0F0F0FULL, 4);
+}
+
+/* Converts 4 blocks (64 bytes) into 8 bit-plane words */
+static void bitslice_load(uint64_t *q, const unsigned char *input) {
+  /* Word 4 * h + j gathers bytes h, h + 2, ..., h + 14 of block j, so that
+   * the transpose puts byte i of block j at bit 4 * i + j */
+  for (int h = 0; h < 2; h++) {
+    for (int j = 0; j < 4; j++) {
+      uint64_t w = 0;
+      for (int m = 0; m < 8; m++)
+        w |= (uint64_t)input[16 * j + 2 * m + h] << (8 * m);
+      q[4 * h + j] = w;
+    }
+  }
+  bitslice_transpose(q);
+}
+
+/* Converts 8 bit-plane words back into 4 blocks */
+static void bitslice_store(unsigned char *output, uint64_t *q) {
+  bitslice_transpose(q);
+  for (int h = 0; h < 2; h++) {
+    for (int j = 0; j < 4; j++) {
+      for (int m = 0; m < 8; m++)
+        output[16 * j + 2 * m + h] = (unsigned char)(q[4 * h + j] >> (8 * m));
+    }
+  }
+}
+
+/*
+ * SubBytes on 8 bit planes, as the Boyar-Peralta circuit ("A new
+ * combinational logic minimization technique with applications to
+ * cryptology", https://eprint.iacr.org/2009/191.pdf). Inputs x0..x7 and
+ * outputs s0..s7 are numbered from the high bit down.
+ */
+static void bitslice_sub_bytes(uint64_t *q) {
+  uint64_t x0, x1, x2, x3, x4, x5, x6, x7;
+  uint64_t y1, y2, y3, y4, y5, y6, y7, y8, y9, y10, y11;
+  uint64_t y12, y13, y14, y15, y16, y17, y18, y19, y20, y21;
+  uint64_t z0, z1, z2, z3, z4, z5, z6, z7, z8, z9, z10, z11;
+  uint64_t z12, z13, z14, z15, z16, z17;
+  uint64_t t0, t1, t2, t3, t4, t5, t6, t7, t8, t9, t10, t11, t12, t13;
+  uint64_t t14, t15, t16, t17, t18, t19, t20, t21, t22, t23, t24, t25;
+  uint64_t t26, t27, t28, t29, t30, t31, t32, t33, t34, t35, t36, t37;
+  uint64_t t38, t39, t40, t41, t42, t43, t44, t45, t46, t47, t48, t49;
+  uint64_t t50, t51, t52, t53, t54, t55, t56, t57, t58, t59, t60, t61;
+  uint64_t t62, t63, t64, t65, t66, t67;
+  uint64_t s0, s1, s2, s3, s4, s5, s6, s7;
+
+  x0 = q[7];
+  x1 = q[6];
+  x2 = q[5];
+  x3 = q[4];
+  x4 = q[3];
+  x5 = q[2];
+  x6 = q[1];
+  x7 = q[0];
+
+  /* Top linear transformation */
+  y14 = x3 ^ x5;
+  y13 = x0 ^ x6;
+  y9 = x0 ^ x3;
+  y8 = x0 ^ x5;
+  t0 = x1 ^ x2;
+  y1 = t0 ^ x7;
+  y4 = y1 ^ x3;
+  y12 = y13 ^ y14;
+  y2 = y1 ^ x0;
+  y5 = y1 ^ x6;
+  y3 = y5 ^ y8;
+  t1 = x4 ^ y12;
+  y15 = t1 ^ x5;
+  y20 = t1 ^ x1;
+  y6 = y15 ^ x7;
+  y10 = y15 ^ t0;
+  y11 = y20 ^ y9;
+  y7 = x7 ^ y11;
+  y17 = y10 ^ y11;
+  y19 = y10 ^ y8;
+  y16 = t0 ^ y11;
+  y21 = y13 ^ y16;
+  y18 = x0 ^ y16;
+
+  /* Non-linear section (inversion in GF(2^8)) */
+  t2 = y12 & y15;
+  t3 = y3 & y6;
+  t4 = t3 ^ t2;
+  t5 = y4 & x7;
+  t6 = t5 ^ t2;
+  t7 = y13 & y16;
+  t8 = y5 & y1;
+  t9 = t8 ^ t7;
+  t10 = y2 & y7;
+  t11 = t10 ^ t7;
+  t12 = y9 & y11;
+  t13 = y14 & y17;
+  t14 = t13 ^ t12;
+  t15 = y8 & y10;
+  t16 = t15 ^ t12;
+  t17 = t4 ^ t14;
+  t18 = t6 ^ t16;
+  t19 = t9 ^ t14;
+  t20 = t11 ^ t16;
+  t21 = t17 ^ y20;
+  t22 = t18 ^ y19;
+  t23 = t19 ^ y21;
+  t24 = t20 ^ y18;
+
+  t25 = t21 ^ t22;
+  t26 = t21 & t23;
+  t27 = t24 ^ t26;
+  t28 = t25 & t27;
+  t29 = t28 ^ t22;
+  t30 = t23 ^ t24;
+  t31 = t22 ^ t26;
+  t32 = t31 & t30;
+  t33 = t32 ^ t24;
+  t34 = t23 ^ t33;
+  t35 = t27 ^ t33;
+  t36 = t24 & t35;
+  t37 = t36 ^ t34;
+  t38 = t27 ^ t36;
+  t39 = t29 & t38;
+  t40 = t25 ^ t39;
+
+  t41 = t40 ^ t37;
+  t42 = t29 ^ t33;
+  t43 = t29 ^ t40;
+  t44 = t33 ^ t37;
+  t45 = t42 ^ t41;
+  z0 = t44 & y15;
+  z1 = t37 & y6;
+  z2 = t33 & x7;
+  z3 = t43 & y16;
+  z4 = t40 & y1;
+  z5 = t29 & y7;
+  z6 = t42 & y11;
+  z7 = t45 & y17;
+  z8 = t41 & y10;
+  z9 = t44 & y12;
+  z10 = t37 & y3;
+  z11 = t33 & y4;
+  z12 = t43 & y13;
+  z13 = t40 & y5;
+  z14 = t29 & y2;
+  z15 = t42 & y9;
+  z16 = t45 & y14;
+  z17 = t41 & y8;
+
+  /* Bottom linear transformation */
+  t46 = z15 ^ z16;
+  t47 = z10 ^ z11;
+  t48 = z5 ^ z13;
+  t49 = z9 ^ z10;
+  t50 = z2 ^ z12;
+  t51 = z2 ^ z5;
+  t52 = z7 ^ z8;
+  t53 = z0 ^ z3;
+  t54 = z6 ^ z7;
+  t55 = z16 ^ z17;
+  t56 = z12 ^ t48;
+  t57 = t50 ^ t53;
+  t58 = z4 ^ t46;
+  t59 = z3 ^ t54;
+  t60 = t46 ^ t57;
+  t61 = z14 ^ t57;
+  t62 = t52 ^ t58;
+  t63 = t49 ^ t58;
+  t64 = z4 ^ t59;
+  t65 = t61 ^ t62;
+  t66 = z1 ^ t63;
+  s0 = t59 ^ t63;
+  s6 = t56 ^ ~t62;
+  s7 = t48 ^ ~t60;
+  t67 = t64 ^ t65;
+  s3 = t53 ^ t66;
+  s4 = t51 ^ t66;
+  s5 = t47 ^ t65;
+  s1 = t64 ^ ~s3;
+  s2 = t55 ^ ~t67;
+
+  q[7] = s0;
+  q[6] = s1;
+  q[5] = s2;
+  q[4] = s3;
+  q[3] = s4;
+  q[2] = s5;
+  q[1] = s6;
+  q[0] = s7;
+}
+
+/* Computes A^-1(x ^ 0x63), undoing the affine step of the S-box */
+static void bitslice_inv_affine(uint64_t *q) {
+  uint64_t q0 = ~q[0], q1 = ~q[1], q2 = q[2], q3 = q[3];
+  uint64_t q4 = q[4], q5 = ~q[5], q6 = ~q[6], q7 = q[7];
+  q[7] = q1 ^ q4 ^ q6;
+  q[6] = q0 ^ q3 ^ q5;
+  q[5] = q7 ^ q2 ^ q4;
+  q[4] = q6 ^ q1 ^ q3;
+  q[3] = q5 ^ q0 ^ q2;
+  q[2] = q4 ^ q7 ^ q1;
+  q[1] = q3 ^ q6 ^ q0;
+  q[0] = q2 ^ q5 ^ q7;
+}
+
+/* InvSubBytes: S^-1(x) = A^-1(S(A^-1(x ^ 0x63)) ^ 0x63) */
+static void bitslice_invert_sub_bytes(uint64_t *q) {
+  bitslice_inv_affine(q);
+  bitslice_sub_bytes(q);
+  bitslice_inv_affine(q);
+}
+
+/* Row r is the nibbles at 4 * r + 16 * col */
+#define ROW_MASK(r) (0x000F000F000F000FULL << (4 * (r)))
+
+static uint64_t rotr64(uint64_t x, int n) {
+  return n ? (x >> n) | (x << (64 - n)) : x;
+}
+
+static void bitslice_shift_rows(uint64_t *q) {
+  /* Output column c of row r comes from column c + r: rotate by r lanes */
+  for (int b = 0; b < 8; b++) {
+    uint64_t x = q[b];
+    q[b] = (x & ROW_MASK(0)) | rotr64(x & ROW_MASK(1), 16) |
+           rotr64(x & ROW_MASK(2), 32) | rotr64(x & ROW_MASK(3), 48);
+  }
+}
+
+static void bitslice_invert_shift_rows(uint64_t *q) {
+  for (int b = 0; b < 8; b++) {
+    uint64_t x = q[b];
+    q[b] = (x & ROW_MASK(0)) | rotr64(x & ROW_MASK(1), 48) |
+           rotr64(x & ROW_MASK(2), 32) | rotr64(x & ROW_MASK(3), 16);
+  }
+}
+
+/* Moves row r + 1 (or r + 2) of every column into row r */
+static uint64_t rotate_rows_1(uint64_t x) {
+  return ((x >> 4) & 0x0FFF0FFF0FFF0FFFULL) |
+         ((x << 12) & 0xF000F000F000F000ULL);
+}
+
+static uint64_t rotate_rows_2(uint64_t x) {
+  return ((x >> 8) & 0x00FF00FF00FF00FFULL) |
+         ((x << 8) & 0xFF00FF00FF00FF00ULL);
+}
+
+/* Multiplies every byte by 2 in GF(2^8), across the 8 planes */
+static void bitslice_xtime(uint64_t *out, const uint64_t *q) {
+  uint64_t hi = q[7];
+  out[7] = q[6];
+  out[6] = q[5];
+  out[5] = q[4];
+  out[4] = q[3] ^ hi;
+  out[3] = q[2] ^ hi;
+  out[2] = q[1];
+  out[1] = q[0] ^ hi;
+  out[0] = hi;
+}
+
+static void bitslice_mix_columns(uint64_t *q) {
+  /* out_r = a_r ^ (a_0 ^ a_1 ^ a_2 ^ a_3) ^ 2 * (a_r ^ a_r+1) */
+  uint64_t pair[8], doubled[8];
+  for (int b = 0; b < 8; b++) pair[b] = q[b] ^ rotate_rows_1(q[b]);
+  bitslice_xtime(doubled, pair);
+  for (int b = 0; b < 8; b++)
+    q[b] ^= pair[b] ^ rotate_rows_2(pair[b]) ^ doubled[b];
+}
+
+static void bitslice_invert_mix_columns(uint64_t *q) {
+  /* See Sec 4.1.3 in The Design of Rijndael: add 4 * (a_r ^ a_r+2), then
+   * apply MixColumns */
+  uint64_t t[8], u[8];
+  for (int b = 0; b < 8; b++) t[b] = q[b] ^ rotate_rows_2(q[b]);
+  bitslice_xtime(u, t);
+  bitslice_xtime(t, u);
+  for (int b = 0; b < 8; b++) q[b] ^= t[b];
+  bitslice_mix_columns(q);
+}
+
+static void bitslice_add_round_key(uint64_t *q, const uint64_t *sliced_key) {
+  for (int b = 0; b < 8; b++) q[b] ^= sliced_key[b];
+}
+
+/* Spreads each byte of a round key over the four block positions */
+static void bitslice_round_key(uint64_t *sliced, const unsigned char *key) {
+  for (int b = 0; b < 8; b++) {
+    uint64_t w = 0;
+    for (int i = 0; i < BLOCK_SIZE; i++)
+      w |= (uint64_t)((key[i] >> b) & 1) * (0xFULL << (4 * i));
+    sliced[b] = w;
+  }
+}
+
+static void bitslice_context_keys(aes_context *ctx) {
+  for (int round = 0; round <= ctx->rounds; round++) {
+    bitslice_round_key(ctx->sliced_keys[round], ctx->round_keys + round * 16);
+  }
+}
+
+/* Encrypts 8 blocks (128 bytes); input and output may be the same buffer */
+static void bitslice_encrypt8(const aes_context *ctx,
+                              const unsigned char *input,
+                              unsigned char *output) {
+  const int rounds = ctx->rounds;
+  uint64_t q[2][8];
+  bitslice_load(q[0], input);
+  bitslice_load(q[1], input + 64);
+  for (int g = 0; g < 2; g++) {
+    bitslice_add_round_key(q[g], ctx->sliced_keys[0]);
+    for (int round = 1; round < rounds; round++) {
+      bitslice_sub_bytes(q[g]);
+      bitslice_shift_rows(q[g]);
+      bitslice_mix_columns(q[g]);
+      bitslice_add_round_key(q[g], ctx->sliced_keys[round]);
+    }
+    bitslice_sub_bytes(q[g]);
+    bitslice_shift_rows(q[g]);
+    bitslice_add_round_key(q[g], ctx->sliced_keys[rounds]);
+  }
+  bitslice_store(output, q[0]);
+  bitslice_store(output + 64, q[1]);
+}
+
+/* Decrypts 8 blocks (128 bytes); input and output may be the same buffer */
+static void bitslice_decrypt8(const aes_context *ctx,
+                              const unsigned char *input,
+                              unsigned char *output) {
+  const int rounds = ctx->rounds;
+  uint64_t q[2][8];
+  bitslice_load(q[0], input);
+  bitslice_load(q[1], input + 64);
+  for (int g = 0; g < 2; g++) {
+    bitslice_add_round_key(q[g], ctx->sliced_keys[rounds]);
+    for (int round = rounds - 1; round > 0; round--) {
+      bitslice_invert_shift_rows(q[g]);
+      bitslice_invert_sub_bytes(q[g]);
+      bitslice_add_round_key(q[g], ctx->sliced_keys[round]);
+      bitslice_invert_mix_columns(q[g]);
+    }
+    bitslice_invert_shift_rows(q[g]);
+    bitslice_invert_sub_bytes(q[g]);
+    bitslice_add_round_key(q[g], ctx->sliced_keys[0]);
+  }
+  bitslice_store(output, q[0]);
+  bitslice_store(output + 64, q[1]);
+}
+
+/*
+ * Runs the bitsliced kernel over any number of blocks. A final group of
+ * fewer than 8 blocks goes through the kernel too, padded with zero blocks,
+ * so the whole message stays on the constant-time path.
+ */
+static void bitslice_ecb(const aes_context *ctx, const unsigned char *input,
+                         unsigned char *output, size_t blocks,
+                         void (*kernel)(const aes_context *,
+                                        const unsigned char *,
+                                        unsigned char *)) {
+  size_t full = blocks - blocks % BITSLICE_BLOCKS;
+  for (size_t i = 0; i < full; i += BITSLICE_BLOCKS) {
+    kernel(ctx, input + i * BLOCK_SIZE, output + i * BLOCK_SIZE);
+  }
+  if (full < blocks) {
+    unsigned char group[BITSLICE_BLOCKS * BLOCK_SIZE] = {0};
+    size_t tail = (blocks - full) * BLOCK_SIZE;
+    memcpy(group, input + full * BLOCK_SIZE, tail);
+    kernel(ctx, group, group);
+    memcpy(output + full * BLOCK_SIZE, group, tail);
+    memset(group, 0, sizeof(group));
+  }
+}
+
+/* SubWord for the key schedule: the four bytes go through the bitsliced
+ * S-box as byte positions 0-3 of one block */
+static void bitslice_sub_word(unsigned char *word) {
+  uint64_t q[8] = {0};
+  for (int b = 0; b < 8; b++) {
+    for (int i = 0; i < 4; i++)
+      q[b] |= (uint64_t)((word[i] >> b) & 1) << (4 * i);
+  }
+  bitslice_sub_bytes(q);
+  for (int i = 0; i < 4; i++) {
+    unsigned char byte = 0;
+    for (int b = 0; b < 8; b++)
+      byte |= (unsigned char)(((q[b] >> (4 * i)) & 1) << b);
+    word[i] = byte;
+  }
+  memset(q, 0, sizeof(q));
+}
+#endif
+
+/* Applies the S-box to the four bytes of a key schedule word */
+static void sub_word(unsigned char *word) {
+#ifdef RIJNDAEL_CONSTANT_TIME
+  bitslice_sub_word(word);
+#else
+  for (int i = 0; i < 4; i++) word[i] = sbox[word[i]];
+#endif
+}
+
+/*
+ * Number of rounds for a key of key_length bytes (16, 24 or 32), or 0 if
+ * the length is not a valid AES key size.
+ */
+static int rounds_for_key_length(size_t key_length) {
+  switch (key_length) {
+    case 16:
+      return 10;
+    case 24:
+      return 12;
+    case 32:
+      return 14;
+    default:
+      return 0;
+  }
+}
+
+/*
+ * Expands a 128-, 192- or 256-bit key into its schedule of rounds + 1
+ * round keys (FIPS-197 Sec 5.2), writing into a caller-provided buffer.
+ */
+static void expand_key_into(const unsigned char *cipher_key,
+                            size_t key_length, unsigned char *expanded) {
+  int rounds = rounds_for_key_length(key_length);
+  int nk = (int)key_length; /* key length in bytes */
+  memcpy(expanded, cipher_key, key_length);
   /* Rcon values for key expansion */
   static const unsigned char rcon[10] = {0x01, 0x02, 0x04, 0x08, 0x10,
                                          0x20, 0x40, 0x80, 0x1b, 0x36};
-  for (int i = 16; i < 176; i += 4) {
+  for (int i = nk; i < 16 * (rounds + 1); i += 4) {
     unsigned char temp[4];
     memcpy(temp, expanded + i - 4, 4);
-    if (i % 16 == 0) {
+    if (nk == 32 && i % nk == 16) {
+      /* AES-256 also applies the S-box halfway through each key length */
+      sub_word(temp);
+    }
+    if (i % nk == 0) {
       /* Rotate word */
       unsigned char t = temp[0];
       temp[0] = temp[1];
@@ -213,38 +783,57 @@ unsigned char *expand_key(unsigned char *cipher_key) {
       temp[2] = temp[3];
       temp[3] = t;
       /* Apply S-box */
-      temp[0] = sbox[temp[0]];
-      temp[1] = sbox[temp[1]];
-      temp[2] = sbox[temp[2]];
-      temp[3] = sbox[temp[3]];
+      sub_word(temp);
       /* XOR with Rcon */
-      temp[0] ^= rcon[(i / 16) - 1];
+      temp[0] ^= rcon[(i / nk) - 1];
     }
-    expanded[i] = expanded[i - 16] ^ temp[0];
-    expanded[i + 1] = expanded[i - 15] ^ temp[1];
-    expanded[i + 2] = expanded[i - 14] ^ temp[2];
-    expanded[i + 3] = expanded[i - 13] ^ temp[3];
+    expanded[i] = expanded[i - nk] ^ temp[0];
+    expanded[i + 1] = expanded[i - nk + 1] ^ temp[1];
+    expanded[i + 2] = expanded[i - nk + 2] ^ temp[2];
+    expanded[i + 3] = expanded[i - nk + 3] ^ temp[3];
   }
+}
+
+/*
+ * This function should expand the round key. Given an input,
+ * which is a single 128-bit key, it should return a 176-byte
+ * vector, containing the 11 round keys one after the other
+ */
+unsigned char *expand_key(unsigned char *cipher_key) {
+  unsigned char *expanded = malloc(EXPANDED_KEY_SIZE);
+  if (!expanded) return NULL;
+  expand_key_into(cipher_key, 16, expanded);
   return expanded;
 }
 
 /*
- * The implementations of the functions declared in the
- * header file should go here
+ * Portable implementation: T-tables, the byte-oriented round functions
+ * above in a RIJNDAEL_REFERENCE build, or the bitsliced kernel in a
+ * RIJNDAEL_CONSTANT_TIME build, where a single block is a padded group.
  */
-unsigned char *aes_encrypt_block(unsigned char *plaintext, unsigned char *key) {
-  unsigned char *output = malloc(sizeof(unsigned char) * BLOCK_SIZE);
-  if (!output) return NULL;
-  memcpy(output, plaintext, BLOCK_SIZE);
-  unsigned char *round_keys = expand_key(key);
-  if (!round_keys) {
-    free(output);
-    return NULL;
-  }
+#if defined(RIJNDAEL_CONSTANT_TIME)
+static void portable_encrypt_block(const aes_context *ctx,
+                                   const unsigned char *plaintext,
+                                   unsigned char *output) {
+  bitslice_ecb(ctx, plaintext, output, 1, bitslice_encrypt8);
+}
+
+static void portable_decrypt_block(const aes_context *ctx,
+                                   const unsigned char *ciphertext,
+                                   unsigned char *output) {
+  bitslice_ecb(ctx, ciphertext, output, 1, bitslice_decrypt8);
+}
+#elif defined(RIJNDAEL_REFERENCE)
+static void portable_encrypt_block(const aes_context *ctx,
+                                   const unsigned char *plaintext,
+                                   unsigned char *output) {
+  const unsigned char *round_keys = ctx->round_keys;
+  const int rounds = ctx->rounds;
+  memmove(output, plaintext, BLOCK_SIZE);
   /* Initial round */
   add_round_key(output, round_keys);
-  /* Main rounds (1 to 9) */
-  for (int round = 1; round < 10; round++) {
+  /* Main rounds (1 to rounds - 1) */
+  for (int round = 1; round < rounds; round++) {
     sub_bytes(output);
     shift_rows(output);
     mix_columns(output);
@@ -253,27 +842,21 @@ unsigned char *aes_encrypt_block(unsigned char *plaintext, unsigned char *key) {
   /* Final round */
   sub_bytes(output);
   shift_rows(output);
-  add_round_key(output, round_keys + 160);
-  free(round_keys); /* Free internal allocation */
-  return output;
+  add_round_key(output, round_keys + rounds * 16);
 }
 
-unsigned char *aes_decrypt_block(unsigned char *ciphertext,
-                                 unsigned char *key) {
-  unsigned char *output = malloc(sizeof(unsigned char) * BLOCK_SIZE);
-  if (!output) return NULL;
-  memcpy(output, ciphertext, BLOCK_SIZE);
-  unsigned char *round_keys = expand_key(key);
-  if (!round_keys) {
-    free(output);
-    return NULL;
-  }
+static void portable_decrypt_block(const aes_context *ctx,
+                                   const unsigned char *ciphertext,
+                                   unsigned char *output) {
+  const unsigned char *round_keys = ctx->round_keys;
+  const int rounds = ctx->rounds;
+  memmove(output, ciphertext, BLOCK_SIZE);
   /* Initial round */
-  add_round_key(output, round_keys + 160);
+  add_round_key(output, round_keys + rounds * 16);
   invert_shift_rows(output);
   invert_sub_bytes(output);
-  /* Main rounds (9 to 1) */
-  for (int round = 9; round > 0; round--) {
+  /* Main rounds (rounds - 1 to 1) */
+  for (int round = rounds - 1; round > 0; round--) {
     add_round_key(output, round_keys + round * 16);
     invert_mix_columns(output);
     invert_shift_rows(output);
@@ -281,6 +864,984 @@ unsigned char *aes_decrypt_block(unsigned char *ciphertext,
   }
   /* Final round */
   add_round_key(output, round_keys);
-  free(round_keys); /* Free internal allocation */
+}
+#else
+/*
+ * 32-bit T-tables: each combines SubBytes, one MixColumns column and the
+ * ShiftRows byte position, so a round is 16 lookups and XORs. Te[k] and
+ * Td[k] are Te[0] and Td[0] rotated right by 8 * k bits. They are built
+ * from sbox/inv_sbox and gf_mul once, the first time a key is set up.
+ */
+static uint32_t Te[4][256];
+static uint32_t Td[4][256];
+static pthread_once_t tables_once = PTHREAD_ONCE_INIT;
+
+static uint32_t rotr32(uint32_t x, int n) {
+  return n ? (x >> n) | (x << (32 - n)) : x;
+}
+
+static void build_tables(void) {
+  for (int x = 0; x < 256; x++) {
+    unsigned char s = sbox[x], i = inv_sbox[x];
+    /* Column [2, 1, 1, 3] * s and [0e, 09, 0d, 0b] * i, row 0 in the top
+     * byte */
+    uint32_t te = (uint32_t)gf_mul(0x02, s) << 24 | (uint32_t)s << 16 |
+                  (uint32_t)s << 8 | gf_mul(0x03, s);
+    uint32_t td = (uint32_t)gf_mul(0x0e, i) << 24 |
+                  (uint32_t)gf_mul(0x09, i) << 16 |
+                  (uint32_t)gf_mul(0x0d, i) << 8 | gf_mul(0x0b, i);
+    for (int k = 0; k < 4; k++) {
+      Te[k][x] = rotr32(te, 8 * k);
+      Td[k][x] = rotr32(td, 8 * k);
+    }
+  }
+}
+
+static uint32_t load_be32(const unsigned char *p) {
+  return (uint32_t)p[0] << 24 | (uint32_t)p[1] << 16 | (uint32_t)p[2] << 8 |
+         p[3];
+}
+
+static void store_be32(unsigned char *p, uint32_t x) {
+  p[0] = (unsigned char)(x >> 24);
+  p[1] = (unsigned char)(x >> 16);
+  p[2] = (unsigned char)(x >> 8);
+  p[3] = (unsigned char)x;
+}
+
+/*
+ * Packs the round keys as words. Decryption uses the equivalent inverse
+ * cipher (FIPS-197 Sec 5.3.5): round keys in reverse order, with
+ * InvMixColumns applied to all but the first and last. InvMixColumns(w) is
+ * computed as Td applied to sbox[w], since Td includes InvSubBytes.
+ */
+static void table_encryption_keys(aes_context *ctx) {
+  pthread_once(&tables_once, build_tables);
+  for (int i = 0; i < 4 * (ctx->rounds + 1); i++) {
+    ctx->enc_words[i] = load_be32(ctx->round_keys + 4 * i);
+  }
+}
+
+static void table_decryption_keys(aes_context *ctx) {
+  const int rounds = ctx->rounds;
+  pthread_once(&tables_once, build_tables);
+  for (int round = 0; round <= rounds; round++) {
+    for (int c = 0; c < 4; c++) {
+      uint32_t w = load_be32(ctx->round_keys + 16 * (rounds - round) + 4 * c);
+      if (round > 0 && round < rounds) {
+        w = Td[0][sbox[w >> 24]] ^ Td[1][sbox[(w >> 16) & 0xff]] ^
+            Td[2][sbox[(w >> 8) & 0xff]] ^ Td[3][sbox[w & 0xff]];
+      }
+      ctx->dec_words[4 * round + c] = w;
+    }
+  }
+}
+
+static void portable_encrypt_block(const aes_context *ctx,
+                                   const unsigned char *plaintext,
+                                   unsigned char *output) {
+  const uint32_t *rk = ctx->enc_words;
+  const int rounds = ctx->rounds;
+  uint32_t s0 = load_be32(plaintext) ^ rk[0];
+  uint32_t s1 = load_be32(plaintext + 4) ^ rk[1];
+  uint32_t s2 = load_be32(plaintext + 8) ^ rk[2];
+  uint32_t s3 = load_be32(plaintext + 12) ^ rk[3];
+  uint32_t t0, t1, t2, t3;
+  /* Column c takes row r from column c + r (ShiftRows) */
+  for (int round = 1; round < rounds; round++) {
+    rk += 4;
+    t0 = Te[0][s0 >> 24] ^ Te[1][(s1 >> 16) & 0xff] ^
+         Te[2][(s2 >> 8) & 0xff] ^ Te[3][s3 & 0xff] ^ rk[0];
+    t1 = Te[0][s1 >> 24] ^ Te[1][(s2 >> 16) & 0xff] ^
+         Te[2][(s3 >> 8) & 0xff] ^ Te[3][s0 & 0xff] ^ rk[1];
+    t2 = Te[0][s2 >> 24] ^ Te[1][(s3 >> 16) & 0xff] ^
+         Te[2][(s0 >> 8) & 0xff] ^ Te[3][s1 & 0xff] ^ rk[2];
+    t3 = Te[0][s3 >> 24] ^ Te[1][(s0 >> 16) & 0xff] ^
+         Te[2][(s1 >> 8) & 0xff] ^ Te[3][s2 & 0xff] ^ rk[3];
+    s0 = t0;
+    s1 = t1;
+    s2 = t2;
+    s3 = t3;
+  }
+  /* Final round: no MixColumns, so plain S-box lookups */
+  rk += 4;
+#define FINAL(a, b, c, d, k)                                          \
+  ((uint32_t)sbox[(a) >> 24] << 24 ^                                  \
+   (uint32_t)sbox[((b) >> 16) & 0xff] << 16 ^                         \
+   (uint32_t)sbox[((c) >> 8) & 0xff] << 8 ^ (uint32_t)sbox[(d) & 0xff] ^ (k))
+  store_be32(output, FINAL(s0, s1, s2, s3, rk[0]));
+  store_be32(output + 4, FINAL(s1, s2, s3, s0, rk[1]));
+  store_be32(output + 8, FINAL(s2, s3, s0, s1, rk[2]));
+  store_be32(output + 12, FINAL(s3, s0, s1, s2, rk[3]));
+#undef FINAL
+}
+
+static void portable_decrypt_block(const aes_context *ctx,
+                                   const unsigned char *ciphertext,
+                                   unsigned char *output) {
+  const uint32_t *rk = ctx->dec_words;
+  const int rounds = ctx->rounds;
+  uint32_t s0 = load_be32(ciphertext) ^ rk[0];
+  uint32_t s1 = load_be32(ciphertext + 4) ^ rk[1];
+  uint32_t s2 = load_be32(ciphertext + 8) ^ rk[2];
+  uint32_t s3 = load_be32(ciphertext + 12) ^ rk[3];
+  uint32_t t0, t1, t2, t3;
+  /* Column c takes row r from column c - r (InvShiftRows) */
+  for (int round = 1; round < rounds; round++) {
+    rk += 4;
+    t0 = Td[0][s0 >> 24] ^ Td[1][(s3 >> 16) & 0xff] ^
+         Td[2][(s2 >> 8) & 0xff] ^ Td[3][s1 & 0xff] ^ rk[0];
+    t1 = Td[0][s1 >> 24] ^ Td[1][(s0 >> 16) & 0xff] ^
+         Td[2][(s3 >> 8) & 0xff] ^ Td[3][s2 & 0xff] ^ rk[1];
+    t2 = Td[0][s2 >> 24] ^ Td[1][(s1 >> 16) & 0xff] ^
+         Td[2][(s0 >> 8) & 0xff] ^ Td[3][s3 & 0xff] ^ rk[2];
+    t3 = Td[0][s3 >> 24] ^ Td[1][(s2 >> 16) & 0xff] ^
+         Td[2][(s1 >> 8) & 0xff] ^ Td[3][s0 & 0xff] ^ rk[3];
+    s0 = t0;
+    s1 = t1;
+    s2 = t2;
+    s3 = t3;
+  }
+  rk += 4;
+#define FINAL(a, b, c, d, k)                                          \
+  ((uint32_t)inv_sbox[(a) >> 24] << 24 ^                              \
+   (uint32_t)inv_sbox[((b) >> 16) & 0xff] << 16 ^                     \
+   (uint32_t)inv_sbox[((c) >> 8) & 0xff] << 8 ^                       \
+   (uint32_t)inv_sbox[(d) & 0xff] ^ (k))
+  store_be32(output, FINAL(s0, s3, s2, s1, rk[0]));
+  store_be32(output + 4, FINAL(s1, s0, s3, s2, rk[1]));
+  store_be32(output + 8, FINAL(s2, s1, s0, s3, rk[2]));
+  store_be32(output + 12, FINAL(s3, s2, s1, s0, rk[3]));
+#undef FINAL
+}
+#endif
+
+/* Helpers for the block modes */
+static void xor_block(unsigned char *block, const unsigned char *other) {
+  for (int i = 0; i < BLOCK_SIZE; i++) {
+    block[i] ^= other[i];
+  }
+}
+
+/* Adds one to a 128-bit big-endian counter */
+static void increment_counter(unsigned char *counter) {
+  for (int i = BLOCK_SIZE - 1; i >= 0; i--) {
+    if (++counter[i] != 0) break;
+  }
+}
+
+#ifdef RIJNDAEL_CONSTANT_TIME
+static void portable_ecb_encrypt(const aes_context *ctx,
+                                 const unsigned char *input,
+                                 unsigned char *output, size_t blocks) {
+  bitslice_ecb(ctx, input, output, blocks, bitslice_encrypt8);
+}
+
+static void portable_ecb_decrypt(const aes_context *ctx,
+                                 const unsigned char *input,
+                                 unsigned char *output, size_t blocks) {
+  bitslice_ecb(ctx, input, output, blocks, bitslice_decrypt8);
+}
+#else
+static void portable_ecb_encrypt(const aes_context *ctx,
+                                 const unsigned char *input,
+                                 unsigned char *output, size_t blocks) {
+  for (size_t i = 0; i < blocks; i++) {
+    portable_encrypt_block(ctx, input + i * BLOCK_SIZE, output + i * BLOCK_SIZE);
+  }
+}
+
+static void portable_ecb_decrypt(const aes_context *ctx,
+                                 const unsigned char *input,
+                                 unsigned char *output, size_t blocks) {
+  for (size_t i = 0; i < blocks; i++) {
+    portable_decrypt_block(ctx, input + i * BLOCK_SIZE, output + i * BLOCK_SIZE);
+  }
+}
+#endif
+
+static void portable_cbc_encrypt(const aes_context *ctx, unsigned char *iv,
+                                 const unsigned char *input,
+                                 unsigned char *output, size_t blocks) {
+  unsigned char previous[BLOCK_SIZE];
+  memcpy(previous, iv, BLOCK_SIZE);
+  for (size_t i = 0; i < blocks; i++) {
+    /* encrypt(plaintext_block XOR previous) */
+    xor_block(previous, input + i * BLOCK_SIZE);
+    portable_encrypt_block(ctx, previous, previous);
+    memcpy(output + i * BLOCK_SIZE, previous, BLOCK_SIZE);
+  }
+  memcpy(iv, previous, BLOCK_SIZE);
+}
+
+#ifdef RIJNDAEL_CONSTANT_TIME
+static void portable_cbc_decrypt(const aes_context *ctx, unsigned char *iv,
+                                 const unsigned char *input,
+                                 unsigned char *output, size_t blocks) {
+  /* Chaining value followed by a group of ciphertext blocks, kept in case
+   * output overwrites input */
+  unsigned char saved[(BITSLICE_BLOCKS + 1) * BLOCK_SIZE];
+  unsigned char plain[BITSLICE_BLOCKS * BLOCK_SIZE];
+  memcpy(saved, iv, BLOCK_SIZE);
+  for (size_t i = 0; i < blocks; i += BITSLICE_BLOCKS) {
+    size_t count = blocks - i < BITSLICE_BLOCKS ? blocks - i : BITSLICE_BLOCKS;
+    memcpy(saved + BLOCK_SIZE, input + i * BLOCK_SIZE, count * BLOCK_SIZE);
+    /* previous XOR decrypt(ciphertext_block), 8 blocks at a time */
+    bitslice_ecb(ctx, saved + BLOCK_SIZE, plain, count, bitslice_decrypt8);
+    for (size_t k = 0; k < count; k++) {
+      xor_block(plain + k * BLOCK_SIZE, saved + k * BLOCK_SIZE);
+    }
+    memcpy(output + i * BLOCK_SIZE, plain, count * BLOCK_SIZE);
+    memcpy(saved, saved + count * BLOCK_SIZE, BLOCK_SIZE);
+  }
+  memcpy(iv, saved, BLOCK_SIZE);
+  memset(plain, 0, sizeof(plain));
+}
+
+static void portable_ctr_crypt(const aes_context *ctx, unsigned char *counter,
+                               const unsigned char *input,
+                               unsigned char *output, size_t blocks) {
+  unsigned char keystream[BITSLICE_BLOCKS * BLOCK_SIZE];
+  for (size_t i = 0; i < blocks; i += BITSLICE_BLOCKS) {
+    size_t count = blocks - i < BITSLICE_BLOCKS ? blocks - i : BITSLICE_BLOCKS;
+    /* block XOR encrypt(counter), 8 counter blocks at a time */
+    for (size_t k = 0; k < count; k++) {
+      memcpy(keystream + k * BLOCK_SIZE, counter, BLOCK_SIZE);
+      increment_counter(counter);
+    }
+    bitslice_ecb(ctx, keystream, keystream, count, bitslice_encrypt8);
+    memmove(output + i * BLOCK_SIZE, input + i * BLOCK_SIZE,
+            count * BLOCK_SIZE);
+    for (size_t k = 0; k < count; k++) {
+      xor_block(output + (i + k) * BLOCK_SIZE, keystream + k * BLOCK_SIZE);
+    }
+  }
+  memset(keystream, 0, sizeof(keystream));
+}
+#else
+static void portable_cbc_decrypt(const aes_context *ctx, unsigned char *iv,
+                                 const unsigned char *input,
+                                 unsigned char *output, size_t blocks) {
+  unsigned char previous[BLOCK_SIZE], saved[BLOCK_SIZE];
+  memcpy(previous, iv, BLOCK_SIZE);
+  for (size_t i = 0; i < blocks; i++) {
+    /* previous XOR decrypt(ciphertext_block); the ciphertext is kept in
+     * case output overwrites input */
+    memcpy(saved, input + i * BLOCK_SIZE, BLOCK_SIZE);
+    portable_decrypt_block(ctx, saved, output + i * BLOCK_SIZE);
+    xor_block(output + i * BLOCK_SIZE, previous);
+    memcpy(previous, saved, BLOCK_SIZE);
+  }
+  memcpy(iv, previous, BLOCK_SIZE);
+}
+
+static void portable_ctr_crypt(const aes_context *ctx, unsigned char *counter,
+                               const unsigned char *input,
+                               unsigned char *output, size_t blocks) {
+  unsigned char keystream[BLOCK_SIZE];
+  for (size_t i = 0; i < blocks; i++) {
+    /* block XOR encrypt(counter) */
+    portable_encrypt_block(ctx, counter, keystream);
+    increment_counter(counter);
+    for (int k = 0; k < BLOCK_SIZE; k++) {
+      output[i * BLOCK_SIZE + k] = input[i * BLOCK_SIZE + k] ^ keystream[k];
+    }
+  }
+  memset(keystream, 0, sizeof(keystream));
+}
+#endif
+
+
+/*
+ * AES-NI implementation, compiled on x86 with GCC or Clang and used only
+ * when the CPU reports support at run time. The parallel modes keep
+ * AESNI_LANES independent blocks in flight so that the pipelined AESENC
+ * units stay busy.
+ */
+#ifdef HAVE_AESNI
+#define AESNI_TARGET __attribute__((target("sse2,aes")))
+#define AESNI_LANES 8
+
+/* CPUID is slow (it traps under most hypervisors), so ask only once */
+static int aesni_supported = -1;
+
+static int cpu_has_aesni(void) {
+  if (aesni_supported < 0) {
+    unsigned int eax, ebx, ecx, edx;
+    aesni_supported = __get_cpuid(1, &eax, &ebx, &ecx, &edx) &&
+                      (ecx & bit_AES) && (edx & bit_SSE2);
+  }
+  return aesni_supported;
+}
+
+#define LOAD(p) _mm_loadu_si128((const __m128i *)(p))
+#define STORE(p, x) _mm_storeu_si128((__m128i *)(p), (x))
+
+/* Decryption round keys for AESDEC, in the order they are used */
+AESNI_TARGET static void aesni_prepare_decryption(aes_context *ctx) {
+  const int rounds = ctx->rounds;
+  const unsigned char *rk = ctx->round_keys;
+  unsigned char *dk = ctx->dec_round_keys;
+  memcpy(dk, rk + rounds * 16, 16);
+  for (int round = 1; round < rounds; round++) {
+    STORE(dk + round * 16, _mm_aesimc_si128(LOAD(rk + (rounds - round) * 16)));
+  }
+  memcpy(dk + rounds * 16, rk, 16);
+}
+
+AESNI_TARGET static __m128i aesni_encrypt(const unsigned char *rk, int rounds,
+                                          __m128i b) {
+  b = _mm_xor_si128(b, LOAD(rk));
+  for (int round = 1; round < rounds; round++) {
+    b = _mm_aesenc_si128(b, LOAD(rk + round * 16));
+  }
+  return _mm_aesenclast_si128(b, LOAD(rk + rounds * 16));
+}
+
+AESNI_TARGET static __m128i aesni_decrypt(const unsigned char *dk, int rounds,
+                                          __m128i b) {
+  b = _mm_xor_si128(b, LOAD(dk));
+  for (int round = 1; round < rounds; round++) {
+    b = _mm_aesdec_si128(b, LOAD(dk + round * 16));
+  }
+  return _mm_aesdeclast_si128(b, LOAD(dk + rounds * 16));
+}
+
+/* Encrypts AESNI_LANES blocks in registers, interleaving their rounds */
+AESNI_TARGET static void aesni_encrypt_lanes(const unsigned char *rk,
+                                             int rounds, __m128i *b) {
+  __m128i k = LOAD(rk);
+  for (int i = 0; i < AESNI_LANES; i++) b[i] = _mm_xor_si128(b[i], k);
+  for (int round = 1; round < rounds; round++) {
+    k = LOAD(rk + round * 16);
+    for (int i = 0; i < AESNI_LANES; i++) b[i] = _mm_aesenc_si128(b[i], k);
+  }
+  k = LOAD(rk + rounds * 16);
+  for (int i = 0; i < AESNI_LANES; i++) b[i] = _mm_aesenclast_si128(b[i], k);
+}
+
+AESNI_TARGET static void aesni_decrypt_lanes(const unsigned char *dk,
+                                             int rounds, __m128i *b) {
+  __m128i k = LOAD(dk);
+  for (int i = 0; i < AESNI_LANES; i++) b[i] = _mm_xor_si128(b[i], k);
+  for (int round = 1; round < rounds; round++) {
+    k = LOAD(dk + round * 16);
+    for (int i = 0; i < AESNI_LANES; i++) b[i] = _mm_aesdec_si128(b[i], k);
+  }
+  k = LOAD(dk + rounds * 16);
+  for (int i = 0; i < AESNI_LANES; i++) b[i] = _mm_aesdeclast_si128(b[i], k);
+}
+
+AESNI_TARGET static void aesni_encrypt_block(const aes_context *ctx,
+                                             const unsigned char *plaintext,
+                                             unsigned char *output) {
+  STORE(output, aesni_encrypt(ctx->round_keys, ctx->rounds, LOAD(plaintext)));
+}
+
+AESNI_TARGET static void aesni_decrypt_block(const aes_context *ctx,
+                                             const unsigned char *ciphertext,
+                                             unsigned char *output) {
+  STORE(output, aesni_decrypt(ctx->dec_round_keys, ctx->rounds, LOAD(ciphertext)));
+}
+
+AESNI_TARGET static void aesni_ecb_encrypt(const aes_context *ctx,
+                                           const unsigned char *input,
+                                           unsigned char *output,
+                                           size_t blocks) {
+  __m128i b[AESNI_LANES];
+  size_t i = 0;
+  for (; i + AESNI_LANES <= blocks; i += AESNI_LANES) {
+    for (int k = 0; k < AESNI_LANES; k++) b[k] = LOAD(input + (i + k) * 16);
+    aesni_encrypt_lanes(ctx->round_keys, ctx->rounds, b);
+    for (int k = 0; k < AESNI_LANES; k++) STORE(output + (i + k) * 16, b[k]);
+  }
+  for (; i < blocks; i++) {
+    STORE(output + i * 16, aesni_encrypt(ctx->round_keys, ctx->rounds, LOAD(input + i * 16)));
+  }
+}
+
+AESNI_TARGET static void aesni_ecb_decrypt(const aes_context *ctx,
+                                           const unsigned char *input,
+                                           unsigned char *output,
+                                           size_t blocks) {
+  __m128i b[AESNI_LANES];
+  size_t i = 0;
+  for (; i + AESNI_LANES <= blocks; i += AESNI_LANES) {
+    for (int k = 0; k < AESNI_LANES; k++) b[k] = LOAD(input + (i + k) * 16);
+    aesni_decrypt_lanes(ctx->dec_round_keys, ctx->rounds, b);
+    for (int k = 0; k < AESNI_LANES; k++) STORE(output + (i + k) * 16, b[k]);
+  }
+  for (; i < blocks; i++) {
+    STORE(output + i * 16,
+          aesni_decrypt(ctx->dec_round_keys, ctx->rounds, LOAD(input + i * 16)));
+  }
+}
+
+AESNI_TARGET static void aesni_cbc_encrypt(const aes_context *ctx,
+                                           unsigned char *iv,
+                                           const unsigned char *input,
+                                           unsigned char *output,
+                                           size_t blocks) {
+  /* Each block depends on the previous one, so there is nothing to
+   * interleave here */
+  __m128i previous = LOAD(iv);
+  for (size_t i = 0; i < blocks; i++) {
+    previous = aesni_encrypt(ctx->round_keys, ctx->rounds,
+                             _mm_xor_si128(LOAD(input + i * 16), previous));
+    STORE(output + i * 16, previous);
+  }
+  STORE(iv, previous);
+}
+
+AESNI_TARGET static void aesni_cbc_decrypt(const aes_context *ctx,
+                                           unsigned char *iv,
+                                           const unsigned char *input,
+                                           unsigned char *output,
+                                           size_t blocks) {
+  /* Ciphertext is read into registers before any output is written, so
+   * in-place operation is safe */
+  __m128i previous = LOAD(iv);
+  __m128i c[AESNI_LANES], b[AESNI_LANES];
+  size_t i = 0;
+  for (; i + AESNI_LANES <= blocks; i += AESNI_LANES) {
+    for (int k = 0; k < AESNI_LANES; k++) {
+      c[k] = LOAD(input + (i + k) * 16);
+      b[k] = c[k];
+    }
+    aesni_decrypt_lanes(ctx->dec_round_keys, ctx->rounds, b);
+    STORE(output + i * 16, _mm_xor_si128(b[0], previous));
+    for (int k = 1; k < AESNI_LANES; k++) {
+      STORE(output + (i + k) * 16, _mm_xor_si128(b[k], c[k - 1]));
+    }
+    previous = c[AESNI_LANES - 1];
+  }
+  for (; i < blocks; i++) {
+    __m128i ciphertext = LOAD(input + i * 16);
+    STORE(output + i * 16,
+          _mm_xor_si128(aesni_decrypt(ctx->dec_round_keys, ctx->rounds, ciphertext),
+                        previous));
+    previous = ciphertext;
+  }
+  STORE(iv, previous);
+}
+
+AESNI_TARGET static void aesni_ctr_crypt(const aes_context *ctx,
+                                         unsigned char *counter,
+                                         const unsigned char *input,
+                                         unsigned char *output,
+                                         size_t blocks) {
+  __m128i b[AESNI_LANES];
+  for (size_t i = 0; i < blocks; i += AESNI_LANES) {
+    size_t count = blocks - i < AESNI_LANES ? blocks - i : AESNI_LANES;
+    for (size_t k = 0; k < count; k++) {
+      b[k] = LOAD(counter);
+      increment_counter(counter);
+    }
+    /* A short last group fills the unused lanes with a copy, which keeps
+     * the loop simple; those results are discarded */
+    for (size_t k = count; k < AESNI_LANES; k++) b[k] = b[0];
+    aesni_encrypt_lanes(ctx->round_keys, ctx->rounds, b);
+    for (size_t k = 0; k < count; k++) {
+      STORE(output + (i + k) * 16,
+            _mm_xor_si128(LOAD(input + (i + k) * 16), b[k]));
+    }
+  }
+}
+
+#undef LOAD
+#undef STORE
+#endif
+
+/*
+ * Run-time dispatch. The implementation is chosen once when the library is
+ * loaded: AES-NI if the CPU has it, unless RIJNDAEL_FORCE_PORTABLE is set in
+ * the environment. aes_force_portable switches it afterwards, which lets
+ * tests compare both implementations in one process.
+ */
+struct aes_implementation {
+  const char *name;
+  void (*encrypt_block)(const aes_context *, const unsigned char *,
+                        unsigned char *);
+  void (*decrypt_block)(const aes_context *, const unsigned char *,
+                        unsigned char *);
+  void (*ecb_encrypt)(const aes_context *, const unsigned char *,
+                      unsigned char *, size_t);
+  void (*ecb_decrypt)(const aes_context *, const unsigned char *,
+                      unsigned char *, size_t);
+  void (*cbc_encrypt)(const aes_context *, unsigned char *,
+                      const unsigned char *, unsigned char *, size_t);
+  void (*cbc_decrypt)(const aes_context *, unsigned char *,
+                      const unsigned char *, unsigned char *, size_t);
+  void (*ctr_crypt)(const aes_context *, unsigned char *,
+                    const unsigned char *, unsigned char *, size_t);
+};
+
+static const struct aes_implementation portable_implementation = {
+    "portable",           portable_encrypt_block, portable_decrypt_block,
+    portable_ecb_encrypt, portable_ecb_decrypt,   portable_cbc_encrypt,
+    portable_cbc_decrypt, portable_ctr_crypt};
+
+#ifdef HAVE_AESNI
+static const struct aes_implementation aesni_implementation = {
+    "aesni",           aesni_encrypt_block, aesni_decrypt_block,
+    aesni_ecb_encrypt, aesni_ecb_decrypt,   aesni_cbc_encrypt,
+    aesni_cbc_decrypt, aesni_ctr_crypt};
+#endif
+
+static const struct aes_implementation *implementation =
+    &portable_implementation;
+
+int aes_force_portable(int force) {
+#ifdef HAVE_AESNI
+  if (!force && cpu_has_aesni()) {
+    implementation = &aesni_implementation;
+    return 1;
+  }
+#endif
+  implementation = &portable_implementation;
+  return 0;
+}
+
+const char *aes_implementation(void) { return implementation->name; }
+
+int aes_stats_enabled(void) {
+#ifdef RIJNDAEL_STATS
+  return 1;
+#else
+  return 0;
+#endif
+}
+
+size_t aes_stats_count(void) {
+#ifdef RIJNDAEL_STATS
+  return STAT_COUNT;
+#else
+  return 0;
+#endif
+}
+
+const char *aes_stats_name(size_t index) {
+#ifdef RIJNDAEL_STATS
+  if (index < STAT_COUNT) return stat_names[index];
+#endif
+  (void)index;
+  return NULL;
+}
+
+unsigned long long aes_stats_value(size_t index) {
+#ifdef RIJNDAEL_STATS
+  if (index < STAT_COUNT)
+    return __atomic_load_n(&stats[index], __ATOMIC_RELAXED);
+#endif
+  (void)index;
+  return 0;
+}
+
+void aes_stats_reset(void) {
+#ifdef RIJNDAEL_STATS
+  for (size_t i = 0; i < STAT_COUNT; i++)
+    __atomic_store_n(&stats[i], 0, __ATOMIC_RELAXED);
+#endif
+}
+
+#if defined(__GNUC__) || defined(__clang__)
+__attribute__((constructor))
+#endif
+static void select_implementation(void) {
+  const char *force = getenv("RIJNDAEL_FORCE_PORTABLE");
+  aes_force_portable(force && *force && strcmp(force, "0") != 0);
+}
+
+/*
+ * Context lifecycle: the key schedule is expanded once here and reused by
+ * every block operation on the context.
+ */
+static void context_expand(aes_context *ctx, const unsigned char *key,
+                           size_t key_length) {
+  ctx->rounds = rounds_for_key_length(key_length);
+  expand_key_into(key, key_length, ctx->round_keys);
+}
+
+static void context_init(aes_context *ctx, const unsigned char *key,
+                         size_t key_length) {
+  STAT_TIMER_START();
+  context_expand(ctx, key, key_length);
+#ifdef RIJNDAEL_CONSTANT_TIME
+  bitslice_context_keys(ctx);
+#endif
+#ifdef RIJNDAEL_TTABLES
+  table_encryption_keys(ctx);
+  table_decryption_keys(ctx);
+#endif
+#ifdef HAVE_AESNI
+  /* Prepared whenever the CPU can use them, so that switching between
+   * implementations never invalidates an existing context */
+  if (cpu_has_aesni()) aesni_prepare_decryption(ctx);
+#endif
+  STAT_TIMER_STOP(STAT_KEY_EXPANSION_NS);
+  STAT_ADD(STAT_KEY_EXPANSIONS, 1);
+}
+
+aes_context *aes_context_new_keylen(const unsigned char *key,
+                                    size_t key_length) {
+  if (!rounds_for_key_length(key_length)) return NULL;
+  aes_context *ctx = malloc(sizeof(aes_context));
+  if (!ctx) return NULL;
+  context_init(ctx, key, key_length);
+  return ctx;
+}
+
+aes_context *aes_context_new(const unsigned char *key) {
+  return aes_context_new_keylen(key, 16);
+}
+
+int aes_context_rounds(const aes_context *ctx) { return ctx->rounds; }
+
+void aes_context_free(aes_context *ctx) {
+  if (!ctx) return;
+  /* Do not leave key material behind in freed memory */
+  memset(ctx, 0, sizeof(aes_context));
+  free(ctx);
+}
+
+void aes_context_encrypt_block(const aes_context *ctx,
+                               const unsigned char *plaintext,
+                               unsigned char *output) {
+  STAT_TIMER_START();
+  implementation->encrypt_block(ctx, plaintext, output);
+  STAT_TIMER_STOP(STAT_CIPHER_NS);
+  STAT_ADD(STAT_ENCRYPT_BLOCK_CALLS, 1);
+}
+
+void aes_context_decrypt_block(const aes_context *ctx,
+                               const unsigned char *ciphertext,
+                               unsigned char *output) {
+  STAT_TIMER_START();
+  implementation->decrypt_block(ctx, ciphertext, output);
+  STAT_TIMER_STOP(STAT_CIPHER_NS);
+  STAT_ADD(STAT_DECRYPT_BLOCK_CALLS, 1);
+}
+
+/*
+ * Bulk modes over caller-owned buffers
+ */
+void aes_ecb_encrypt(const aes_context *ctx, const unsigned char *input,
+                     unsigned char *output, size_t blocks) {
+  STAT_TIMER_START();
+  implementation->ecb_encrypt(ctx, input, output, blocks);
+  STAT_TIMER_STOP(STAT_CIPHER_NS);
+  STAT_ADD(STAT_ECB_ENCRYPT_CALLS, 1);
+  STAT_ADD(STAT_ECB_ENCRYPT_BLOCKS, blocks);
+}
+
+void aes_ecb_decrypt(const aes_context *ctx, const unsigned char *input,
+                     unsigned char *output, size_t blocks) {
+  STAT_TIMER_START();
+  implementation->ecb_decrypt(ctx, input, output, blocks);
+  STAT_TIMER_STOP(STAT_CIPHER_NS);
+  STAT_ADD(STAT_ECB_DECRYPT_CALLS, 1);
+  STAT_ADD(STAT_ECB_DECRYPT_BLOCKS, blocks);
+}
+
+void aes_cbc_encrypt(const aes_context *ctx, unsigned char *iv,
+                     const unsigned char *input, unsigned char *output,
+                     size_t blocks) {
+  STAT_TIMER_START();
+  implementation->cbc_encrypt(ctx, iv, input, output, blocks);
+  STAT_TIMER_STOP(STAT_CIPHER_NS);
+  STAT_ADD(STAT_CBC_ENCRYPT_CALLS, 1);
+  STAT_ADD(STAT_CBC_ENCRYPT_BLOCKS, blocks);
+}
+
+void aes_cbc_decrypt(const aes_context *ctx, unsigned char *iv,
+                     const unsigned char *input, unsigned char *output,
+                     size_t blocks) {
+  STAT_TIMER_START();
+  implementation->cbc_decrypt(ctx, iv, input, output, blocks);
+  STAT_TIMER_STOP(STAT_CIPHER_NS);
+  STAT_ADD(STAT_CBC_DECRYPT_CALLS, 1);
+  STAT_ADD(STAT_CBC_DECRYPT_BLOCKS, blocks);
+}
+
+void aes_ctr_crypt(const aes_context *ctx, unsigned char *counter,
+                   const unsigned char *input, unsigned char *output,
+                   size_t blocks) {
+  STAT_TIMER_START();
+  implementation->ctr_crypt(ctx, counter, input, output, blocks);
+  STAT_TIMER_STOP(STAT_CIPHER_NS);
+  STAT_ADD(STAT_CTR_CALLS, 1);
+  STAT_ADD(STAT_CTR_BLOCKS, blocks);
+}
+
+/*
+ * PCBC, CFB and OFB chain every block to the previous one, so they loop over
+ * the single-block kernel of the implementation in use. Each input block is
+ * read before its output is written, so input and output may be the same.
+ */
+void aes_pcbc_encrypt(const aes_context *ctx, unsigned char *iv,
+                      const unsigned char *input, unsigned char *output,
+                      size_t blocks) {
+  STAT_TIMER_START();
+  unsigned char plain[BLOCK_SIZE], block[BLOCK_SIZE];
+  for (size_t i = 0; i < blocks; i++) {
+    /* encrypt(plaintext_block XOR (prev_ciphertext XOR prev_plaintext)) */
+    memcpy(plain, input + i * BLOCK_SIZE, BLOCK_SIZE);
+    memcpy(block, plain, BLOCK_SIZE);
+    xor_block(block, iv);
+    implementation->encrypt_block(ctx, block, block);
+    memcpy(output + i * BLOCK_SIZE, block, BLOCK_SIZE);
+    memcpy(iv, block, BLOCK_SIZE);
+    xor_block(iv, plain);
+  }
+  memset(plain, 0, sizeof(plain));
+  STAT_TIMER_STOP(STAT_CIPHER_NS);
+  STAT_ADD(STAT_PCBC_ENCRYPT_CALLS, 1);
+  STAT_ADD(STAT_PCBC_ENCRYPT_BLOCKS, blocks);
+}
+
+void aes_pcbc_decrypt(const aes_context *ctx, unsigned char *iv,
+                      const unsigned char *input, unsigned char *output,
+                      size_t blocks) {
+  STAT_TIMER_START();
+  unsigned char cipher[BLOCK_SIZE], block[BLOCK_SIZE];
+  for (size_t i = 0; i < blocks; i++) {
+    /* (prev_plaintext XOR prev_ciphertext) XOR decrypt(ciphertext_block) */
+    memcpy(cipher, input + i * BLOCK_SIZE, BLOCK_SIZE);
+    implementation->decrypt_block(ctx, cipher, block);
+    xor_block(block, iv);
+    memcpy(output + i * BLOCK_SIZE, block, BLOCK_SIZE);
+    memcpy(iv, block, BLOCK_SIZE);
+    xor_block(iv, cipher);
+  }
+  memset(block, 0, sizeof(block));
+  STAT_TIMER_STOP(STAT_CIPHER_NS);
+  STAT_ADD(STAT_PCBC_DECRYPT_CALLS, 1);
+  STAT_ADD(STAT_PCBC_DECRYPT_BLOCKS, blocks);
+}
+
+void aes_cfb_encrypt(const aes_context *ctx, unsigned char *iv,
+                     const unsigned char *input, unsigned char *output,
+                     size_t blocks) {
+  STAT_TIMER_START();
+  for (size_t i = 0; i < blocks; i++) {
+    /* plaintext_block XOR encrypt(prev_ciphertext) */
+    implementation->encrypt_block(ctx, iv, iv);
+    xor_block(iv, input + i * BLOCK_SIZE);
+    memcpy(output + i * BLOCK_SIZE, iv, BLOCK_SIZE);
+  }
+  STAT_TIMER_STOP(STAT_CIPHER_NS);
+  STAT_ADD(STAT_CFB_ENCRYPT_CALLS, 1);
+  STAT_ADD(STAT_CFB_ENCRYPT_BLOCKS, blocks);
+}
+
+void aes_cfb_decrypt(const aes_context *ctx, unsigned char *iv,
+                     const unsigned char *input, unsigned char *output,
+                     size_t blocks) {
+  STAT_TIMER_START();
+  unsigned char keystream[BLOCK_SIZE];
+  for (size_t i = 0; i < blocks; i++) {
+    /* ciphertext_block XOR encrypt(prev_ciphertext) */
+    implementation->encrypt_block(ctx, iv, keystream);
+    memcpy(iv, input + i * BLOCK_SIZE, BLOCK_SIZE);
+    xor_block(keystream, iv);
+    memcpy(output + i * BLOCK_SIZE, keystream, BLOCK_SIZE);
+  }
+  memset(keystream, 0, sizeof(keystream));
+  STAT_TIMER_STOP(STAT_CIPHER_NS);
+  STAT_ADD(STAT_CFB_DECRYPT_CALLS, 1);
+  STAT_ADD(STAT_CFB_DECRYPT_BLOCKS, blocks);
+}
+
+void aes_ofb_crypt(const aes_context *ctx, unsigned char *iv,
+                   const unsigned char *input, unsigned char *output,
+                   size_t blocks) {
+  STAT_TIMER_START();
+  for (size_t i = 0; i < blocks; i++) {
+    /* block XOR encrypt(previous keystream block) */
+    implementation->encrypt_block(ctx, iv, iv);
+    memmove(output + i * BLOCK_SIZE, input + i * BLOCK_SIZE, BLOCK_SIZE);
+    xor_block(output + i * BLOCK_SIZE, iv);
+  }
+  STAT_TIMER_STOP(STAT_CIPHER_NS);
+  STAT_ADD(STAT_OFB_CALLS, 1);
+  STAT_ADD(STAT_OFB_BLOCKS, blocks);
+}
+
+/*
+ * Multi-threaded CTR. Keystream blocks are independent, so segment k simply
+ * starts from counter + (first block of k).
+ */
+
+/* Smallest segment worth handing to a thread (4 KiB of data) */
+#define CTR_MIN_BLOCKS_PER_THREAD 256
+
+/* Adds n to a 128-bit big-endian counter */
+static void add_to_counter(unsigned char *counter, size_t n) {
+  unsigned long long carry = n;
+  for (int i = BLOCK_SIZE - 1; i >= 0 && carry; i--) {
+    carry += counter[i];
+    counter[i] = (unsigned char)(carry & 0xff);
+    carry >>= 8;
+  }
+}
+
+struct ctr_segment {
+  const aes_context *ctx;
+  unsigned char counter[BLOCK_SIZE];
+  const unsigned char *input;
+  unsigned char *output;
+  size_t blocks;
+};
+
+static void *ctr_segment_worker(void *arg) {
+  struct ctr_segment *segment = arg;
+  aes_ctr_crypt(segment->ctx, segment->counter, segment->input,
+                segment->output, segment->blocks);
+  return NULL;
+}
+
+static int online_cpus(void) {
+#ifdef _SC_NPROCESSORS_ONLN
+  long cpus = sysconf(_SC_NPROCESSORS_ONLN);
+  if (cpus > 0) return (int)cpus;
+#endif
+  return 1;
+}
+
+void aes_ctr_crypt_parallel(const aes_context *ctx, unsigned char *counter,
+                            const unsigned char *input, unsigned char *output,
+                            size_t blocks, int threads) {
+  /* Segments go through aes_ctr_crypt, which counts their blocks and time */
+  STAT_ADD(STAT_CTR_PARALLEL_CALLS, 1);
+  if (threads <= 0) threads = online_cpus();
+  /* Do not split work into segments too small to pay for a thread */
+  size_t max_threads = blocks / CTR_MIN_BLOCKS_PER_THREAD;
+  if ((size_t)threads > max_threads) threads = (int)max_threads;
+  if (threads <= 1) {
+    aes_ctr_crypt(ctx, counter, input, output, blocks);
+    return;
+  }
+
+  struct ctr_segment *segments = malloc(threads * sizeof(*segments));
+  pthread_t *handles = malloc(threads * sizeof(*handles));
+  int *started = calloc(threads, sizeof(*started));
+  if (!segments || !handles || !started) {
+    free(segments);
+    free(handles);
+    free(started);
+    aes_ctr_crypt(ctx, counter, input, output, blocks);
+    return;
+  }
+
+  size_t per_thread = (blocks + threads - 1) / threads;
+  size_t offset = 0;
+  for (int t = 0; t < threads; t++) {
+    size_t count = blocks - offset < per_thread ? blocks - offset : per_thread;
+    segments[t].ctx = ctx;
+    memcpy(segments[t].counter, counter, BLOCK_SIZE);
+    add_to_counter(segments[t].counter, offset);
+    segments[t].input = input + offset * BLOCK_SIZE;
+    segments[t].output = output + offset * BLOCK_SIZE;
+    segments[t].blocks = count;
+    offset += count;
+  }
+
+  /* The calling thread takes the last segment itself */
+  for (int t = 0; t < threads - 1; t++) {
+    started[t] = pthread_create(&handles[t], NULL, ctr_segment_worker,
+                                &segments[t]) == 0;
+  }
+  ctr_segment_worker(&segments[threads - 1]);
+  for (int t = 0; t < threads - 1; t++) {
+    if (started[t]) {
+      pthread_join(handles[t], NULL);
+    } else {
+      /* Thread could not be created, so do its share here */
+      ctr_segment_worker(&segments[t]);
+    }
+  }
+
+  add_to_counter(counter, blocks);
+  free(segments);
+  free(handles);
+  free(started);
+}
+
+/*
+ * The implementations of the functions declared in the
+ * header file should go here. These one-shot versions expand the key on
+ * the stack and return a malloc'ed block that the caller must free. Only
+ * the schedule that the implementation in use needs for the one direction
+ * is prepared, not a full context.
+ */
+static void one_shot_prepare(aes_context *ctx,
+                             const struct aes_implementation *impl,
+                             const unsigned char *key, size_t key_length,
+                             int decrypt) {
+  STAT_TIMER_START();
+  context_expand(ctx, key, key_length);
+#ifdef HAVE_AESNI
+  if (impl == &aesni_implementation) {
+    /* AESENC uses the expanded key as it is */
+    if (decrypt) aesni_prepare_decryption(ctx);
+  } else
+#endif
+  {
+#if defined(RIJNDAEL_TTABLES)
+    if (decrypt) {
+      table_decryption_keys(ctx);
+    } else {
+      table_encryption_keys(ctx);
+    }
+#elif defined(RIJNDAEL_CONSTANT_TIME)
+    bitslice_context_keys(ctx);
+#endif
+  }
+  (void)impl;
+  STAT_TIMER_STOP(STAT_KEY_EXPANSION_NS);
+  STAT_ADD(STAT_KEY_EXPANSIONS, 1);
+}
+
+static unsigned char *one_shot_block(const unsigned char *input,
+                                     const unsigned char *key,
+                                     size_t key_length, int decrypt) {
+  if (!rounds_for_key_length(key_length)) return NULL;
+  unsigned char *output = malloc(sizeof(unsigned char) * BLOCK_SIZE);
+  if (!output) return NULL;
+  /* The implementation is read once, so the context matches it even if
+   * another thread switches implementations meanwhile */
+  const struct aes_implementation *impl = implementation;
+  aes_context ctx;
+  one_shot_prepare(&ctx, impl, key, key_length, decrypt);
+  STAT_TIMER_START();
+  if (decrypt) {
+    impl->decrypt_block(&ctx, input, output);
+  } else {
+    impl->encrypt_block(&ctx, input, output);
+  }
+  STAT_TIMER_STOP(STAT_CIPHER_NS);
+  STAT_ADD(decrypt ? STAT_DECRYPT_BLOCK_CALLS : STAT_ENCRYPT_BLOCK_CALLS, 1);
+  memset(&ctx, 0, sizeof(ctx));
   return output;
-}
\ No newline at end of file
+}
+
+unsigned char *aes_encrypt_block_keylen(const unsigned char *plaintext,
+                                        const unsigned char *key,
+                                        size_t key_length) {
+  return one_shot_block(plaintext, key, key_length, 0);
+}
+
+unsigned char *aes_decrypt_block_keylen(const unsigned char *ciphertext,
+                                        const unsigned char *key,
+                                        size_t key_length) {
+  return one_shot_block(ciphertext, key, key_length, 1);
+}
+
+unsigned char *aes_encrypt_block(unsigned char *plaintext, unsigned char *key) {
+  return aes_encrypt_block_keylen(plaintext, key, 16);
+}
+
+unsigned char *aes_decrypt_block(unsigned char *ciphertext,
+                                 unsigned char *key) {
+  return aes_decrypt_block_keylen(ciphertext, key, 16);
+}
@@ -1,5 +1,5 @@
 /*
- * TODO: Denis Muriuki D22127693,The Header file below is a AES-128
+ * TODO: Denis Muriuki D22127693,The Header file below is a AES-128/192/256
  * implementation, which defines macros for block access and size, and function
  * prototypes for encrypting and decrypting 16-byte blocks.
  */
@@ -7,6 +7,8 @@
 #ifndef RIJNDAEL_H
 #define RIJNDAEL_H
 
+#include <stddef.h>
+
 #define BLOCK_ACCESS(block, row, col) (block[(row * 4) + col])
 #define BLOCK_SIZE 16
 
@@ -18,4 +20,126 @@
 unsigned char *aes_encrypt_block(unsigned char *plaintext, unsigned char *key);
 unsigned char *aes_decrypt_block(unsigned char *ciphertext, unsigned char *key);
 
+/*
+ * The functions above take a 16-byte (AES-128) key. These variants accept
+ * key_length 16, 24 or 32 for AES-128, AES-192 or AES-256, and return NULL
+ * for any other length.
+ */
+unsigned char *aes_encrypt_block_keylen(const unsigned char *plaintext,
+                                        const unsigned char *key,
+                                        size_t key_length);
+unsigned char *aes_decrypt_block_keylen(const unsigned char *ciphertext,
+                                        const unsigned char *key,
+                                        size_t key_length);
+
+/*
+ * Reusable key schedule. Create a context once per key, use it for any
+ * number of blocks and release it with aes_context_free. The block
+ * functions write into a caller-owned 16-byte output buffer (which may be
+ * the same as the input) and never allocate.
+ */
+typedef struct aes_context aes_context;
+
+aes_context *aes_context_new(const unsigned char *key);
+void aes_context_free(aes_context *ctx);
+
+/*
+ * Creates a context for a key of key_length bytes (16, 24 or 32), or
+ * returns NULL for an unsupported length. aes_context_new(key) is the same
+ * as aes_context_new_keylen(key, 16). Every function taking a context
+ * works with all three key sizes. aes_context_rounds returns 10, 12 or 14.
+ */
+aes_context *aes_context_new_keylen(const unsigned char *key,
+                                    size_t key_length);
+int aes_context_rounds(const aes_context *ctx);
+void aes_context_encrypt_block(const aes_context *ctx,
+                               const unsigned char *plaintext,
+                               unsigned char *output);
+void aes_context_decrypt_block(const aes_context *ctx,
+                               const unsigned char *ciphertext,
+                               unsigned char *output);
+
+/*
+ * Bulk entry points processing `blocks` consecutive 16-byte blocks from
+ * `input` into `output`. Buffers are owned by the caller, may be the same
+ * buffer for in-place operation, and nothing is allocated. The 16-byte
+ * `iv`/`counter` is updated on return so that a long message can be
+ * processed across several calls. CTR increments the whole counter as a
+ * 128-bit big-endian integer, and is its own inverse.
+ */
+void aes_ecb_encrypt(const aes_context *ctx, const unsigned char *input,
+                     unsigned char *output, size_t blocks);
+void aes_ecb_decrypt(const aes_context *ctx, const unsigned char *input,
+                     unsigned char *output, size_t blocks);
+void aes_cbc_encrypt(const aes_context *ctx, unsigned char *iv,
+                     const unsigned char *input, unsigned char *output,
+                     size_t blocks);
+void aes_cbc_decrypt(const aes_context *ctx, unsigned char *iv,
+                     const unsigned char *input, unsigned char *output,
+                     size_t blocks);
+void aes_ctr_crypt(const aes_context *ctx, unsigned char *counter,
+                   const unsigned char *input, unsigned char *output,
+                   size_t blocks);
+
+/*
+ * PCBC, CFB and OFB over whole blocks, with the same conventions. `iv` is
+ * left holding the next chaining value: prev_ciphertext XOR prev_plaintext
+ * for PCBC, the last ciphertext block for CFB and the last keystream block
+ * for OFB. OFB is its own inverse. These modes are serial, so they run one
+ * block at a time on the single-block kernel.
+ */
+void aes_pcbc_encrypt(const aes_context *ctx, unsigned char *iv,
+                      const unsigned char *input, unsigned char *output,
+                      size_t blocks);
+void aes_pcbc_decrypt(const aes_context *ctx, unsigned char *iv,
+                      const unsigned char *input, unsigned char *output,
+                      size_t blocks);
+void aes_cfb_encrypt(const aes_context *ctx, unsigned char *iv,
+                     const unsigned char *input, unsigned char *output,
+                     size_t blocks);
+void aes_cfb_decrypt(const aes_context *ctx, unsigned char *iv,
+                     const unsigned char *input, unsigned char *output,
+                     size_t blocks);
+void aes_ofb_crypt(const aes_context *ctx, unsigned char *iv,
+                   const unsigned char *input, unsigned char *output,
+                   size_t blocks);
+
+/*
+ * Same result as aes_ctr_crypt, byte for byte, but the blocks are split
+ * into contiguous segments encrypted by up to `threads` POSIX threads. Each
+ * thread computes its starting counter directly from the block offset.
+ * Passing threads <= 0 uses one thread per online CPU.
+ */
+void aes_ctr_crypt_parallel(const aes_context *ctx, unsigned char *counter,
+                            const unsigned char *input, unsigned char *output,
+                            size_t blocks, int threads);
+
+/*
+ * Every function above runs on AES-NI when the CPU supports it, and on the
+ * portable C code otherwise; the choice is made when the library is loaded.
+ * Setting RIJNDAEL_FORCE_PORTABLE=1 in the environment, or calling
+ * aes_force_portable(1), selects the portable code even on AES-NI hardware
+ * (aes_force_portable(0) goes back to automatic selection). It returns 1 if
+ * AES-NI is in use afterwards. Switching is not thread-safe: do it while no
+ * other thread is using the library. aes_implementation returns the name
+ * of the code in use, "aesni" or "portable".
+ */
+int aes_force_portable(int force);
+const char *aes_implementation(void);
+
+/*
+ * Instrumentation. A library built with -DRIJNDAEL_STATS (make stats)
+ * keeps counters of calls and blocks per entry point, of key expansions,
+ * and of the nanoseconds spent expanding keys and running cipher rounds.
+ * Counter `index` (0 <= index < aes_stats_count()) is named by
+ * aes_stats_name and read with aes_stats_value; aes_stats_reset sets them
+ * all to zero. In a normal build aes_stats_enabled returns 0, there are no
+ * counters and nothing is measured.
+ */
+int aes_stats_enabled(void);
+size_t aes_stats_count(void);
+const char *aes_stats_name(size_t index);
+unsigned long long aes_stats_value(size_t index);
+void aes_stats_reset(void);
+
 #endif
@@ -0,0 +1,76 @@
+# Import required modules for unit testing and path handling
+import unittest  # Framework for writing and running unit tests
+import json  # For reading the machine-readable output
+import os  # For path manipulation and temporary files
+import sys  # For modifying Python's module search path
+import tempfile  # For a scratch JSON file
+import time  # For cases with a known cost
+
+# Make the project root (benchmark.py, aes_native.py) importable
+project_root = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+sys.path.insert(0, project_root)
+
+import benchmark
+
+# Define the test class for the benchmark runner, on tiny sizes and time limits
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        # One Python backend plus whatever native backends are available
+        self.backends = [b for b in benchmark.available_backends()
+                         if b.name == 'python-table' or b.name.startswith('native')]
+
+    def test_results(self):
+        # Every case produces a record with the reported statistics
+        results = benchmark.run_suite([16, 64], self.backends, min_time=0.001, workload=10)
+        cases = {(r['case'], r['backend'], r['size']) for r in results}
+        for backend in self.backends:
+            for case in ('block-encrypt', 'block-decrypt', 'ctr-encrypt', 'pcbc-decrypt'):
+                self.assertIn((case, backend.name, 16), cases)
+        self.assertIn(('envelope-decrypt', 'python-matrix', 64), cases)
+        for result in results:
+            self.assertGreater(result['mb_per_s'], 0)
+            self.assertLessEqual(result['p50_ns'], result['p99_ns'])
+
+    def test_budget(self):
+        # Sizes predicted to exceed the time budget are recorded as skipped
+        results = benchmark.run_suite([16, 1 << 20], self.backends[:1], min_time=0.001,
+                                      budget=1e-9, envelope=False)
+        skipped = [r for r in results if r.get('skipped')]
+        self.assertTrue(skipped)
+        self.assertTrue(all(r['size'] == 1 << 20 for r in skipped))
+
+    def test_fixed_cost_budget(self):
+        # A case dominated by a fixed cost (like the envelope's key stretch)
+        # still runs at larger sizes, while a per-byte case is skipped
+        results = []
+        cases = [('fixed', lambda m: time.sleep(0.01) or m, lambda c: time.sleep(0.01)),
+                 ('per-byte', lambda m: time.sleep(len(m) * 1e-6) or m, lambda c: None)]
+        benchmark._size_cases(results.append, 'test', [16, 1 << 10, 1 << 16], cases,
+                              min_time=0.001, budget=0.05)
+        skipped = {(r['case'], r['size']) for r in results if r.get('skipped')}
+        self.assertEqual(skipped, {('per-byte-encrypt', 1 << 16)})
+
+    def test_baseline(self):
+        # Throughput drops beyond the tolerance are reported as regressions
+        results = benchmark.run_suite([16], self.backends[:1], min_time=0.001, envelope=False)
+        baseline = [dict(r, mb_per_s=r['mb_per_s'] * 2) for r in results]
+        self.assertEqual(len(benchmark.compare(results, baseline, 0.10)), len(results))
+        self.assertEqual(benchmark.compare(results, results, 0.10), [])
+
+    def test_json_output(self):
+        # The command line writes JSON and exits with 1 on a regression
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'results.json')
+            args = ['--sizes', '16', '--backends', 'python-table', '--min-time', '0.001', '--no-envelope']
+            self.assertEqual(benchmark.main(args + ['--json', path]), 0)
+            with open(path) as f:
+                data = json.load(f)
+            self.assertIn('environment', data)
+            for result in data['results']:
+                result['mb_per_s'] *= 100
+            with open(path, 'w') as f:
+                json.dump(data, f)
+            self.assertEqual(benchmark.main(args + ['--baseline', path]), 1)
+
+if __name__ == '__main__':
+    unittest.main()  # Run all tests
@@ -0,0 +1,141 @@
+# Import required modules for unit testing and path handling
+import unittest  # Framework for writing and running unit tests
+import os  # For path manipulation and random byte generation
+import sys  # For modifying Python's module search path
+
+# Make the project root (aes_native.py) importable
+project_root = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+sys.path.insert(0, project_root)
+
+import aes_native  # Loads the shared library once and adds aes/ to the path
+from aes import AES as PyAES  # Pure-Python reference implementation
+
+# Define the test class comparing the native-backed class with aes.AES
+class TestNativeAES(unittest.TestCase):
+    def setUp(self):
+        # The library is loaded once per process, so this is only a lookup
+        if not aes_native.available():
+            self.fail(f"Failed to load {aes_native.LIBRARY_NAME}")
+        self.key = os.urandom(16)
+        self.iv = os.urandom(16)
+        self.native = aes_native.AES(self.key)
+        self.python = PyAES(self.key)
+
+    def test_library_cached(self):
+        # Loading again should return the same library object
+        self.assertIs(aes_native.load_library(), aes_native.load_library())
+        self.assertTrue(self.native.native)
+
+    def test_blocks(self):
+        # Single blocks should match aes.py in both directions
+        for i in range(3):
+            block = os.urandom(16)
+            self.assertEqual(self.native.encrypt_block(block), self.python.encrypt_block(block))
+            self.assertEqual(self.native.decrypt_block(block), self.python.decrypt_block(block))
+        # Writable buffers are accepted as well as bytes
+        self.assertEqual(self.native.encrypt_block(bytearray(16)), self.python.encrypt_block(bytes(16)))
+
+    def test_ecb(self):
+        # Multi-block ECB should match block-by-block encryption
+        message = os.urandom(16 * 8)
+        ciphertext = self.native.encrypt_ecb(message)
+        expected = b''.join(self.python.encrypt_block(message[i:i+16]) for i in range(0, len(message), 16))
+        self.assertEqual(ciphertext, expected)
+        self.assertEqual(self.native.decrypt_ecb(ciphertext), message)
+
+    def test_modes(self):
+        # Every mode should produce the same output as aes.py, including
+        # messages that are not a multiple of the block size
+        for length in (0, 1, 15, 16, 17, 100, 1000):
+            message = os.urandom(length)
+            for mode in ('cbc', 'pcbc', 'cfb', 'ofb', 'ctr'):
+                encrypt = getattr(self.native, 'encrypt_' + mode)
+                decrypt = getattr(self.native, 'decrypt_' + mode)
+                expected = getattr(self.python, 'encrypt_' + mode)(message, self.iv)
+                ciphertext = encrypt(message, self.iv)
+                self.assertEqual(ciphertext, expected, f"{mode} mismatch for length {length}")
+                self.assertEqual(decrypt(ciphertext, self.iv), message, f"{mode} roundtrip for length {length}")
+
+    def test_ctr_threads(self):
+        # Threaded CTR should produce the same bytes as single-threaded CTR
+        message = os.urandom(16 * 2000 + 5)
+        threaded = aes_native.AES(self.key, threads=4)
+        self.assertEqual(threaded.encrypt_ctr(message, self.iv), self.native.encrypt_ctr(message, self.iv))
+
+    def test_implementations(self):
+        # AES-NI (when the CPU has it) and the portable code must agree on
+        # every native path. Several lengths cover partial pipeline groups
+        messages = [os.urandom(16 * n + 5) for n in (1, 7, 8, 9, 33)]
+        outputs = {}
+        try:
+            for force in (True, False):
+                aes_native.force_portable(force)
+                name = aes_native.implementation()
+                outputs[name] = [(self.native.encrypt_ecb(m[:-5]), self.native.encrypt_cbc(m, self.iv),
+                                  self.native.encrypt_ctr(m, self.iv), self.native.encrypt_block(m[:16]),
+                                  self.native.encrypt_pcbc(m, self.iv), self.native.encrypt_cfb(m, self.iv),
+                                  self.native.encrypt_ofb(m, self.iv))
+                                 for m in messages]
+                for m, (ecb, cbc, ctr, block, pcbc, cfb, ofb) in zip(messages, outputs[name]):
+                    self.assertEqual(self.native.decrypt_ecb(ecb), m[:-5], name)
+                    self.assertEqual(self.native.decrypt_cbc(cbc, self.iv), m, name)
+                    self.assertEqual(ctr, self.python.encrypt_ctr(m, self.iv), name)
+                    self.assertEqual(self.native.decrypt_block(block), m[:16], name)
+                    self.assertEqual(self.native.decrypt_pcbc(pcbc, self.iv), m, name)
+                    self.assertEqual(cfb, self.python.encrypt_cfb(m, self.iv), name)
+                    self.assertEqual(self.native.decrypt_cfb(cfb, self.iv), m, name)
+                    self.assertEqual(ofb, self.python.encrypt_ofb(m, self.iv), name)
+        finally:
+            # Back to automatic selection for the other tests
+            aes_native.force_portable(False)
+        self.assertIn('portable', outputs)
+        if 'aesni' in outputs:
+            self.assertEqual(outputs['aesni'], outputs['portable'])
+
+    def test_key_sizes(self):
+        # AES-192 and AES-256 keys also run natively and match aes.py
+        for key_size in (24, 32):
+            key = os.urandom(key_size)
+            native = aes_native.AES(key)
+            self.assertTrue(native.native)
+            self.assertEqual(native.n_rounds, PyAES(key).n_rounds)
+            message = os.urandom(16 * 9 + 3)
+            for mode in ('cbc', 'pcbc', 'cfb', 'ofb', 'ctr'):
+                expected = getattr(PyAES(key), 'encrypt_' + mode)(message, self.iv)
+                self.assertEqual(getattr(native, 'encrypt_' + mode)(message, self.iv), expected)
+                self.assertEqual(getattr(native, 'decrypt_' + mode)(expected, self.iv), message)
+
+    def test_output_buffers(self):
+        # Results can be written into a caller's buffer, including in place
+        message = os.urandom(16 * 9 + 3)
+        for mode in ('cbc', 'pcbc', 'cfb', 'ofb', 'ctr'):
+            expected = getattr(self.python, 'encrypt_' + mode)(message, self.iv)
+            out = bytearray(len(expected) + 16)
+            written = getattr(self.native, 'encrypt_' + mode)(message, self.iv, out=out)
+            self.assertEqual(out[:written], expected, mode)
+            written = getattr(self.native, 'decrypt_' + mode)(bytes(out[:written]), self.iv, out=out)
+            self.assertEqual(out[:written], message, mode)
+        buffer = bytearray(message[:144])
+        self.assertEqual(self.native.encrypt_ecb(buffer, out=buffer), 144)
+        self.assertEqual(buffer, self.python.encrypt_ecb(message[:144]))
+        # Unpadded CBC pieces, in place
+        self.assertEqual(self.native.decrypt_cbc_blocks(buffer, self.iv, out=buffer), 144)
+        self.assertEqual(buffer, self.python.decrypt_cbc_blocks(self.python.encrypt_ecb(message[:144]), self.iv))
+
+    def test_fallback(self):
+        # Without the library every method uses the Python implementation
+        key = os.urandom(32)
+        load_library = aes_native.load_library
+        aes_native.load_library = lambda path=None: None
+        try:
+            fallback = aes_native.AES(key)
+        finally:
+            aes_native.load_library = load_library
+        self.assertFalse(fallback.native)
+        block = os.urandom(16)
+        self.assertEqual(fallback.encrypt_block(block), PyAES(key).encrypt_block(block))
+        self.assertEqual(fallback.encrypt_ctr(block * 3, self.iv), PyAES(key).encrypt_ctr(block * 3, self.iv))
+        self.assertEqual(fallback.encrypt_ofb(block * 3, self.iv), PyAES(key).encrypt_ofb(block * 3, self.iv))
+
+if __name__ == '__main__':
+    unittest.main()  # Run all tests
@@ -4,6 +4,9 @@ import ctypes  # For interfacing with rijndael.dll (C implementation)
 import os  # For path manipulation and random byte generation
 import sys  # For modifying Python's module search path
 import platform  # For detecting the operating system
+import shutil  # For finding a C compiler
+import subprocess  # For building an instrumented copy of the library
+import tempfile  # For a scratch build directory
 
 # Ensure the aes submodule is accessible
 project_root = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
@@ -42,6 +45,53 @@ class TestRijndael(unittest.TestCase):
         ]
         self.lib.aes_encrypt_block.restype = ctypes.POINTER(ctypes.c_ubyte)
 
+        # Define the context API: a key schedule created once and reused
+        # Context pointers are opaque, so they are handled as void pointers
+        self.lib.aes_context_new.argtypes = [ctypes.POINTER(ctypes.c_ubyte * 16)]
+        self.lib.aes_context_new.restype = ctypes.c_void_p
+        self.lib.aes_context_free.argtypes = [ctypes.c_void_p]
+        self.lib.aes_context_free.restype = None
+        for name in ('aes_context_encrypt_block', 'aes_context_decrypt_block'):
+            func = getattr(self.lib, name)
+            func.argtypes = [
+                ctypes.c_void_p,
+                ctypes.POINTER(ctypes.c_ubyte * 16),
+                ctypes.POINTER(ctypes.c_ubyte * 16)
+            ]
+            func.restype = None
+
+        # Variants taking any AES key length (16, 24 or 32 bytes)
+        for name in ('aes_encrypt_block_keylen', 'aes_decrypt_block_keylen'):
+            func = getattr(self.lib, name)
+            func.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+            func.restype = ctypes.c_void_p
+        self.lib.aes_context_new_keylen.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        self.lib.aes_context_new_keylen.restype = ctypes.c_void_p
+        self.lib.aes_context_rounds.argtypes = [ctypes.c_void_p]
+        self.lib.aes_context_rounds.restype = ctypes.c_int
+
+        # Define the bulk mode functions, which work on caller-owned buffers
+        # Buffers are passed as void pointers so that ctypes arrays created
+        # with from_buffer (zero-copy views of bytearrays) can be used directly
+        for name in ('aes_ecb_encrypt', 'aes_ecb_decrypt'):
+            func = getattr(self.lib, name)
+            func.argtypes = [
+                ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t
+            ]
+            func.restype = None
+        for name in ('aes_cbc_encrypt', 'aes_cbc_decrypt', 'aes_ctr_crypt'):
+            func = getattr(self.lib, name)
+            func.argtypes = [
+                ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+                ctypes.c_void_p, ctypes.c_size_t
+            ]
+            func.restype = None
+        self.lib.aes_ctr_crypt_parallel.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int
+        ]
+        self.lib.aes_ctr_crypt_parallel.restype = None
+
         # Access the platform-specific free function to clean up malloc'ed memory
         try:
             if platform.system() == 'Windows':
@@ -108,5 +158,345 @@ class TestRijndael(unittest.TestCase):
             # Verify that Python and C outputs match for this random input
             self.assertEqual(py_result, c_result, f"encrypt_block mismatch for random input {i+1}")
 
+    def test_context_reuse(self):
+        # Test that one context encrypts and decrypts many blocks correctly
+        key = os.urandom(16)
+        aes = AES(key)
+        c_key = (ctypes.c_ubyte * 16)(*key)
+        ctx = self.lib.aes_context_new(c_key)
+        if not ctx:
+            self.fail("aes_context_new returned NULL")
+        try:
+            for i in range(5):
+                plaintext = os.urandom(16)
+                c_in = (ctypes.c_ubyte * 16)(*plaintext)
+                c_out = (ctypes.c_ubyte * 16)()
+
+                # Encrypt with the shared context and compare with Python
+                self.lib.aes_context_encrypt_block(ctx, c_in, c_out)
+                self.assertEqual(bytes(c_out), aes.encrypt_block(plaintext),
+                                 f"context encrypt mismatch for block {i+1}")
+
+                # Decrypt in place (input and output are the same buffer)
+                self.lib.aes_context_decrypt_block(ctx, c_out, c_out)
+                self.assertEqual(bytes(c_out), plaintext,
+                                 f"context decrypt mismatch for block {i+1}")
+        finally:
+            # Release the context and its key schedule
+            self.lib.aes_context_free(ctx)
+
+    def test_bulk_modes(self):
+        # Test the multi-block ECB, CBC and CTR functions against aes.py
+        key = os.urandom(16)
+        iv = os.urandom(16)
+        aes = AES(key)
+        # A whole number of blocks, as the C functions take a block count
+        message = os.urandom(16 * 20)
+        blocks = len(message) // 16
+        ctx = self.lib.aes_context_new((ctypes.c_ubyte * 16)(*key))
+        if not ctx:
+            self.fail("aes_context_new returned NULL")
+        try:
+            # ECB, in place over a bytearray with no copies on the way in
+            buffer = bytearray(message)
+            view = (ctypes.c_ubyte * len(buffer)).from_buffer(buffer)
+            self.lib.aes_ecb_encrypt(ctx, view, view, blocks)
+            expected = b''.join(aes.encrypt_block(message[i:i+16])
+                                for i in range(0, len(message), 16))
+            self.assertEqual(bytes(buffer), expected, "ECB mismatch")
+
+            # CBC: aes.py pads, so feed the same padded message to C
+            padded = message + bytes([16] * 16)
+            c_out = bytearray(len(padded))
+            c_iv = bytearray(iv)
+            self.lib.aes_cbc_encrypt(
+                ctx, (ctypes.c_ubyte * 16).from_buffer(c_iv), padded,
+                (ctypes.c_ubyte * len(c_out)).from_buffer(c_out), len(padded) // 16)
+            self.assertEqual(bytes(c_out), aes.encrypt_cbc(message, iv), "CBC encrypt mismatch")
+            # The IV is updated to the last ciphertext block for chaining
+            self.assertEqual(bytes(c_iv), bytes(c_out[-16:]))
+
+            # CBC decrypt in place, split across two calls to test chaining
+            c_iv = bytearray(iv)
+            iv_view = (ctypes.c_ubyte * 16).from_buffer(c_iv)
+            out_view = (ctypes.c_ubyte * len(c_out)).from_buffer(c_out)
+            self.lib.aes_cbc_decrypt(ctx, iv_view, out_view, out_view, 5)
+            rest = ctypes.addressof(out_view) + 5 * 16
+            self.lib.aes_cbc_decrypt(ctx, iv_view, rest, rest, len(padded) // 16 - 5)
+            self.assertEqual(bytes(c_out), padded, "CBC decrypt mismatch")
+
+            # CTR from bytes input into a bytearray output
+            c_out = bytearray(len(message))
+            c_counter = bytearray(iv)
+            self.lib.aes_ctr_crypt(
+                ctx, (ctypes.c_ubyte * 16).from_buffer(c_counter), message,
+                (ctypes.c_ubyte * len(c_out)).from_buffer(c_out), blocks)
+            self.assertEqual(bytes(c_out), aes.encrypt_ctr(message, iv), "CTR mismatch")
+        finally:
+            self.lib.aes_context_free(ctx)
+
+    def test_bitsliced_groups(self):
+        # In a constant-time build the bulk functions run 8 blocks at a time
+        # through the bitsliced kernel and pad a shorter last group, so try
+        # every remainder; the default T-table build must agree, on both
+        # the portable and (where available) AES-NI code
+        self.lib.aes_force_portable.argtypes = [ctypes.c_int]
+        try:
+            for force in (1, 0):
+                self.lib.aes_force_portable(force)
+                self.check_groups(self.lib)
+        finally:
+            # Back to automatic selection for the other tests
+            self.lib.aes_force_portable(0)
+
+    def test_constant_time_build(self):
+        # Build a copy of the library with the bitsliced kernel (same as
+        # `make constant-time`)
+        compiler = shutil.which('gcc') or shutil.which('cc')
+        if compiler is None or platform.system() == 'Windows':
+            self.skipTest("no C compiler to build the constant-time library")
+        with tempfile.TemporaryDirectory() as build_dir:
+            lib_path = os.path.join(build_dir, 'rijndael_ct.so')
+            subprocess.run([compiler, '-O2', '-fPIC', '-shared', '-pthread', '-DRIJNDAEL_CONSTANT_TIME',
+                            '-o', lib_path, os.path.join(project_root, 'rijndael.c')], check=True)
+            lib = ctypes.cdll.LoadLibrary(lib_path)
+
+        # Same signatures as in setUp, with buffers as void pointers
+        lib.aes_context_new.argtypes = [ctypes.c_void_p]
+        lib.aes_context_new.restype = ctypes.c_void_p
+        lib.aes_context_free.argtypes = [ctypes.c_void_p]
+        for name in ('aes_ecb_encrypt', 'aes_ecb_decrypt'):
+            getattr(lib, name).argtypes = [ctypes.c_void_p] * 3 + [ctypes.c_size_t]
+        for name in ('aes_cbc_decrypt', 'aes_ctr_crypt'):
+            getattr(lib, name).argtypes = [ctypes.c_void_p] * 4 + [ctypes.c_size_t]
+        for name in ('aes_encrypt_block_keylen', 'aes_decrypt_block_keylen'):
+            getattr(lib, name).argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+            getattr(lib, name).restype = ctypes.c_void_p
+        lib.aes_force_portable.argtypes = [ctypes.c_int]
+
+        # AES-NI would bypass the portable code entirely
+        lib.aes_force_portable(1)
+        self.check_groups(lib)
+
+        # Single blocks go through the kernel too, as a padded group
+        for key_size in (16, 24, 32):
+            key = os.urandom(key_size)
+            plaintext = os.urandom(16)
+            ciphertext = AES(key).encrypt_block(plaintext)
+            c_result_ptr = lib.aes_encrypt_block_keylen(plaintext, key, key_size)
+            self.assertEqual(ctypes.string_at(c_result_ptr, 16), ciphertext,
+                             f"constant-time encrypt mismatch for {key_size}-byte key")
+            self.c_free(c_result_ptr)
+            c_result_ptr = lib.aes_decrypt_block_keylen(ciphertext, key, key_size)
+            self.assertEqual(ctypes.string_at(c_result_ptr, 16), plaintext,
+                             f"constant-time decrypt mismatch for {key_size}-byte key")
+            self.c_free(c_result_ptr)
+
+    def check_groups(self, lib):
+        # ECB, CBC decryption and CTR over 1 to 17 blocks, against aes.py
+        key = os.urandom(16)
+        aes = AES(key)
+        ctx = lib.aes_context_new((ctypes.c_ubyte * 16)(*key))
+        if not ctx:
+            self.fail("aes_context_new returned NULL")
+        try:
+            for blocks in range(1, 18):
+                message = os.urandom(16 * blocks)
+                expected = b''.join(aes.encrypt_block(message[i:i+16])
+                                    for i in range(0, len(message), 16))
+
+                # ECB encrypt must match the one-block-at-a-time Python result
+                buffer = bytearray(message)
+                view = (ctypes.c_ubyte * len(buffer)).from_buffer(buffer)
+                lib.aes_ecb_encrypt(ctx, view, view, blocks)
+                self.assertEqual(bytes(buffer), expected,
+                                 f"ECB encrypt mismatch for {blocks} blocks")
+
+                # ECB decrypt in place gives the message back
+                lib.aes_ecb_decrypt(ctx, view, view, blocks)
+                self.assertEqual(bytes(buffer), message,
+                                 f"ECB decrypt mismatch for {blocks} blocks")
+
+                # CBC decrypt in place, against aes.py's CBC encryption
+                iv = os.urandom(16)
+                ciphertext = aes.encrypt_cbc(message, iv)[:len(message)]
+                buffer = bytearray(ciphertext)
+                view = (ctypes.c_ubyte * len(buffer)).from_buffer(buffer)
+                lib.aes_cbc_decrypt(ctx, (ctypes.c_ubyte * 16).from_buffer(bytearray(iv)),
+                                    view, view, blocks)
+                self.assertEqual(bytes(buffer), message,
+                                 f"CBC decrypt mismatch for {blocks} blocks")
+
+                # CTR with the counter about to carry into the next byte
+                iv = os.urandom(12) + b'\x00\x00\x00\xfd'
+                c_out = bytearray(len(message))
+                lib.aes_ctr_crypt(
+                    ctx, (ctypes.c_ubyte * 16).from_buffer(bytearray(iv)), message,
+                    (ctypes.c_ubyte * len(c_out)).from_buffer(c_out), blocks)
+                self.assertEqual(bytes(c_out), aes.encrypt_ctr(message, iv),
+                                 f"CTR mismatch for {blocks} blocks")
+        finally:
+            lib.aes_context_free(ctx)
+
+    def test_fips197_key_sizes(self):
+        # FIPS-197 Appendix C example vectors for AES-128, AES-192 and AES-256
+        plaintext = bytes.fromhex('00112233445566778899aabbccddeeff')
+        expected = {
+            16: '69c4e0d86a7b0430d8cdb78070b4c55a',
+            24: 'dda97ca4864cdfe06eaf70a0ec0d7191',
+            32: '8ea2b7ca516745bfeafc49904b496089',
+        }
+        for key_size, ciphertext in expected.items():
+            key = bytes(range(key_size))
+            ciphertext = bytes.fromhex(ciphertext)
+
+            # One-shot functions with an explicit key length
+            c_result_ptr = self.lib.aes_encrypt_block_keylen(plaintext, key, key_size)
+            if not c_result_ptr:
+                self.fail(f"aes_encrypt_block_keylen returned NULL for {key_size}-byte key")
+            self.assertEqual(ctypes.string_at(c_result_ptr, 16), ciphertext,
+                             f"encrypt mismatch for {key_size}-byte key")
+            self.c_free(c_result_ptr)
+            c_result_ptr = self.lib.aes_decrypt_block_keylen(ciphertext, key, key_size)
+            self.assertEqual(ctypes.string_at(c_result_ptr, 16), plaintext,
+                             f"decrypt mismatch for {key_size}-byte key")
+            self.c_free(c_result_ptr)
+
+            # Contexts and the bulk functions, against aes.py over many blocks
+            ctx = self.lib.aes_context_new_keylen(key, key_size)
+            if not ctx:
+                self.fail(f"aes_context_new_keylen returned NULL for {key_size}-byte key")
+            try:
+                self.assertEqual(self.lib.aes_context_rounds(ctx), AES(key).n_rounds)
+                message = os.urandom(16 * 19)
+                c_out = bytearray(len(message))
+                out_view = (ctypes.c_ubyte * len(c_out)).from_buffer(c_out)
+                self.lib.aes_ecb_encrypt(ctx, message, out_view, 19)
+                self.assertEqual(bytes(c_out[:16]), AES(key).encrypt_block(message[:16]))
+                self.lib.aes_ecb_decrypt(ctx, out_view, out_view, 19)
+                self.assertEqual(bytes(c_out), message)
+                self.lib.aes_ctr_crypt(ctx, bytes(16), message, out_view, 19)
+                self.assertEqual(bytes(c_out), AES(key).encrypt_ctr(message, bytes(16)))
+            finally:
+                self.lib.aes_context_free(ctx)
+
+        # Any other key length is rejected
+        self.assertFalse(self.lib.aes_context_new_keylen(bytes(20), 20))
+        self.assertFalse(self.lib.aes_encrypt_block_keylen(plaintext, bytes(20), 20))
+
+    def test_one_shot_implementations(self):
+        # One-shot calls only prepare the schedule of the code in use, so
+        # check them on both the portable and (where available) AES-NI code
+        self.lib.aes_force_portable.argtypes = [ctypes.c_int]
+        self.lib.aes_force_portable.restype = ctypes.c_int
+        try:
+            for force in (1, 0):
+                self.lib.aes_force_portable(force)
+                for key_size in (16, 24, 32):
+                    key = os.urandom(key_size)
+                    plaintext = os.urandom(16)
+                    ciphertext = AES(key).encrypt_block(plaintext)
+                    c_result_ptr = self.lib.aes_encrypt_block_keylen(plaintext, key, key_size)
+                    self.assertEqual(ctypes.string_at(c_result_ptr, 16), ciphertext,
+                                     f"one-shot encrypt mismatch (force_portable={force}, {key_size}-byte key)")
+                    self.c_free(c_result_ptr)
+                    c_result_ptr = self.lib.aes_decrypt_block_keylen(ciphertext, key, key_size)
+                    self.assertEqual(ctypes.string_at(c_result_ptr, 16), plaintext,
+                                     f"one-shot decrypt mismatch (force_portable={force}, {key_size}-byte key)")
+                    self.c_free(c_result_ptr)
+        finally:
+            # Back to automatic selection for the other tests
+            self.lib.aes_force_portable(0)
+
+    def test_ctr_parallel(self):
+        # Test that threaded CTR matches the single-threaded result exactly
+        key = os.urandom(16)
+        # Start close to the top of the low bytes so segment counters carry
+        iv = os.urandom(8) + b'\xff' * 7 + b'\xf0'
+        # Not a multiple of the thread count, so segments are uneven
+        message = os.urandom(16 * 4099)
+        blocks = len(message) // 16
+        ctx = self.lib.aes_context_new((ctypes.c_ubyte * 16)(*key))
+        if not ctx:
+            self.fail("aes_context_new returned NULL")
+        try:
+            serial = bytearray(len(message))
+            serial_counter = bytearray(iv)
+            self.lib.aes_ctr_crypt(
+                ctx, (ctypes.c_ubyte * 16).from_buffer(serial_counter), message,
+                (ctypes.c_ubyte * len(serial)).from_buffer(serial), blocks)
+
+            for threads in (0, 1, 3, 8):
+                parallel = bytearray(len(message))
+                parallel_counter = bytearray(iv)
+                self.lib.aes_ctr_crypt_parallel(
+                    ctx, (ctypes.c_ubyte * 16).from_buffer(parallel_counter), message,
+                    (ctypes.c_ubyte * len(parallel)).from_buffer(parallel), blocks, threads)
+                self.assertEqual(parallel, serial, f"parallel CTR mismatch with {threads} threads")
+                # The counter should end where the serial version left it
+                self.assertEqual(parallel_counter, serial_counter)
+        finally:
+            self.lib.aes_context_free(ctx)
+
+    def test_stats(self):
+        # A normal build has no instrumentation: no counters, nothing measured
+        self.lib.aes_stats_enabled.restype = ctypes.c_int
+        self.lib.aes_stats_count.restype = ctypes.c_size_t
+        self.assertEqual(self.lib.aes_stats_enabled(), 0)
+        self.assertEqual(self.lib.aes_stats_count(), 0)
+
+        # Build an instrumented copy of the library (same as `make stats`)
+        compiler = shutil.which('gcc') or shutil.which('cc')
+        if compiler is None or platform.system() == 'Windows':
+            self.skipTest("no C compiler to build the instrumented library")
+        with tempfile.TemporaryDirectory() as build_dir:
+            lib_path = os.path.join(build_dir, 'rijndael_stats.so')
+            subprocess.run([compiler, '-O2', '-fPIC', '-shared', '-pthread', '-DRIJNDAEL_STATS',
+                            '-o', lib_path, os.path.join(project_root, 'rijndael.c')], check=True)
+            lib = ctypes.cdll.LoadLibrary(lib_path)
+
+        # Counters are looked up by name, as aes_native.stats() does
+        lib.aes_stats_count.restype = ctypes.c_size_t
+        lib.aes_stats_name.argtypes = [ctypes.c_size_t]
+        lib.aes_stats_name.restype = ctypes.c_char_p
+        lib.aes_stats_value.argtypes = [ctypes.c_size_t]
+        lib.aes_stats_value.restype = ctypes.c_ulonglong
+        lib.aes_context_new_keylen.argtypes = [ctypes.c_char_p, ctypes.c_size_t]
+        lib.aes_context_new_keylen.restype = ctypes.c_void_p
+        lib.aes_context_free.argtypes = [ctypes.c_void_p]
+        lib.aes_ctr_crypt.argtypes = [ctypes.c_void_p] + [ctypes.c_char_p] * 3 + [ctypes.c_size_t]
+        lib.aes_ctr_crypt_parallel.argtypes = lib.aes_ctr_crypt.argtypes + [ctypes.c_int]
+        lib.aes_context_encrypt_block.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+
+        def read_stats():
+            return {lib.aes_stats_name(i).decode(): lib.aes_stats_value(i)
+                    for i in range(lib.aes_stats_count())}
+
+        self.assertEqual(lib.aes_stats_enabled(), 1)
+        lib.aes_stats_reset()
+        self.assertFalse(any(read_stats().values()))
+
+        ctx = lib.aes_context_new_keylen(os.urandom(32), 32)
+        try:
+            output = ctypes.create_string_buffer(16 * 1000)
+            lib.aes_context_encrypt_block(ctx, bytes(16), output)
+            lib.aes_ctr_crypt(ctx, ctypes.create_string_buffer(16), bytes(16 * 10), output, 10)
+            lib.aes_ctr_crypt_parallel(ctx, ctypes.create_string_buffer(16), bytes(16 * 1000), output, 1000, 4)
+        finally:
+            lib.aes_context_free(ctx)
+
+        stats = read_stats()
+        self.assertEqual(stats['key_expansions'], 1)
+        self.assertEqual(stats['encrypt_block_calls'], 1)
+        self.assertEqual(stats['ctr_parallel_calls'], 1)
+        # Parallel segments are counted as ordinary CTR calls
+        self.assertEqual(stats['ctr_blocks'], 1010)
+        self.assertGreaterEqual(stats['ctr_calls'], 2)
+        self.assertGreater(stats['key_expansion_ns'], 0)
+        self.assertGreater(stats['cipher_ns'], 0)
+
+        lib.aes_stats_reset()
+        self.assertFalse(any(read_stats().values()))
+
 if __name__ == '__main__':
     unittest.main()  # Run all tests
\ No newline at end of file